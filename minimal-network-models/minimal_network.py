@@ -0,0 +1,325 @@
+"""
+Batch runner for the minimal network models.
+
+The minimal models of the notebooks ``all7-test-10h.ipynb``,
+``all7-test-3M.ipynb`` and ``all7-test-10h+3M.ipynb`` consist of a single
+``Main`` bus with a constant load and a generator whose availability follows a
+half cosine, and a ``StoreIsland`` bus with one storage technology: a charging
+link ``Link2Store``, a discharging link ``Link2Main`` and an extendable store
+``TheStorage``.
+
+This module builds these models for a grid of
+
+- storage technologies (Lithium, H2, CAES, LAES, ETES, NaS, FeFlow),
+- horizons (e.g. ``10h``, ``3M``; hours ``h``, days ``d`` or months ``M`` of
+  30 days),
+- cost scenarios (``cost-data/costs-*.csv``),
+
+solves the grid in a pool of worker processes and returns one tidy frame with
+a row per model.
+
+Costs of CAES, LAES, ETES, NaS and FeFlow are read from the cost scenario
+files. As in the notebooks, capital costs are the investment costs converted
+to USD/MW and USD/MWh (not annualised), the investment of a shared power unit
+(``Power``, ``Inverter``) is split equally between charging and discharging
+link, and every link carries the efficiency given in the file. The
+``realistic`` scenario agrees with the notebooks' ``parameterBank`` except for
+the CAES turbine, which costs 0.600744 MUSD/MW in the cost data and 0.633112
+MUSD/MW in the notebooks. Lithium and H2 are not part of the cost data and
+keep the values of ``parameterBank`` in every scenario.
+
+The fixed energy-to-power coupling of Lithium, NaS and FeFlow
+(``Link2Store == Link2Main * efficiency``) is written with :mod:`pypsa.linopt`,
+as in ``solve_network.add_battery_constraints``, and all models are solved
+with ``pyomo=False``. :func:`benchmark_build` compares the time to build the
+optimisation problem through Pyomo and through :mod:`pypsa.linopf`.
+
+Usage::
+
+    python minimal_network.py --horizons 10h 3M --workers 4 -o results.csv
+    python minimal_network.py --benchmark --horizons 10h 3M -o benchmark.csv
+
+or, from Python::
+
+    from minimal_network import solve_grid
+    results = solve_grid(horizons=['10h', '3M'])
+"""
+
+import logging
+import argparse
+import re
+import os
+import time
+import numpy as np
+import pandas as pd
+
+import pypsa
+from pypsa.linopf import get_var, define_constraints, linexpr, prepare_lopf
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+COST_DIR = Path(__file__).resolve().parent.parent / 'cost-data'
+SCENARIOS = ['optimistic', 'realistic', 'pessimistic']
+
+# rows of the cost data describing each technology: storage, charging and
+# discharging unit; a shared power unit is given as both charger and discharger
+TECHNOLOGIES = {
+    'Lithium': None,
+    'H2': None,
+    'CAES': dict(store='CAES Storage', charger='CAES Compressor', discharger='CAES Turbine'),
+    'LAES': dict(store='LAES Energy', charger='LAES Power', discharger='LAES Power'),
+    'ETES': dict(store='ETES Energy', charger='ETES Power', discharger='ETES Power'),
+    'NaS': dict(store='NaS Energy', charger='NaS Inverter', discharger='NaS Inverter'),
+    'FeFlow': dict(store='FeFlow Energy', charger='FeFlow Inverter', discharger='FeFlow Inverter'),
+}
+
+# values of the notebooks' parameterBank, used for technologies without cost data
+# [charger capital cost, charger efficiency, discharger capital cost,
+#  discharger efficiency, store capital cost] in MUSD/MW, MUSD/MWh
+DEFAULTS = {
+    'Lithium': [0.2055, 0.9, 0.2055, 0.9, 0.192],
+    'H2': [0.35, 0.8, 0.35, 0.58, 0.01064],
+}
+
+# technologies whose charging and discharging power are coupled (one inverter)
+FIXED_RATIO = ['Lithium', 'NaS', 'FeFlow']
+
+PARAMETERS = ['charger_capital_cost', 'charger_efficiency', 'discharger_capital_cost',
+              'discharger_efficiency', 'store_capital_cost']
+
+
+def read_cost_data(fn):
+    """Read a cost scenario file into a frame indexed by technology with one column per parameter."""
+    costs = pd.read_csv(fn, encoding='utf-8-sig', usecols=['technology', 'parameter', 'value', 'unit'])
+    costs['technology'] = costs.technology.str.strip()
+    costs.loc[costs.unit.str.contains('/kW'), 'value'] *= 1e3
+    # keep the first entry of technologies listed several times (e.g. literature ranges)
+    costs = costs.drop_duplicates(['technology', 'parameter'])
+    return costs.set_index(['technology', 'parameter']).value.unstack()
+
+
+def technology_parameters(costs):
+    """Link and store parameters of all technologies for one cost scenario."""
+    parameters = {}
+    for tech, rows in TECHNOLOGIES.items():
+        if rows is None:
+            values = DEFAULTS[tech]
+            parameters[tech] = dict(zip(PARAMETERS, [values[0] * 1e6, values[1], values[2] * 1e6,
+                                                     values[3], values[4] * 1e6]))
+            continue
+        try:
+            shared = rows['charger'] == rows['discharger']
+            power = costs.at[rows['charger'], 'investment'] / (2 if shared else 1)
+            parameters[tech] = {
+                'charger_capital_cost': power,
+                'charger_efficiency': costs.at[rows['charger'], 'efficiency'],
+                'discharger_capital_cost': (power if shared else
+                                            costs.at[rows['discharger'], 'investment']),
+                'discharger_efficiency': costs.at[rows['discharger'], 'efficiency'],
+                'store_capital_cost': costs.at[rows['store'], 'investment'],
+            }
+        except KeyError as e:
+            logger.warning(f"Skipping {tech}: no cost data for {e}.")
+            continue
+        if any(pd.isnull(v) for v in parameters[tech].values()):
+            logger.warning(f"Skipping {tech}: incomplete cost data.")
+            del parameters[tech]
+    return pd.DataFrame(parameters).T
+
+
+def parse_horizon(horizon):
+    """Number of hourly snapshots of a horizon such as ``10h``, ``30d`` or ``3M``."""
+    match = re.fullmatch(r'(\d+)([hdM])', horizon)
+    if match is None:
+        raise ValueError(f"Invalid horizon '{horizon}'; expected e.g. '10h', '30d' or '3M'.")
+    number, unit = match.groups()
+    return int(number) * {'h': 1, 'd': 24, 'M': 720}[unit]
+
+
+def build_grid(technologies=None, horizons=('10h', '3M'), scenarios=None, cost_dir=COST_DIR):
+    """
+    Tidy frame of all model runs with the technology, horizon, scenario and
+    link and store parameters of each run.
+    """
+    technologies = list(TECHNOLOGIES) if technologies is None else technologies
+    scenarios = SCENARIOS if scenarios is None else scenarios
+
+    parameters = pd.concat({scenario: technology_parameters(
+                                read_cost_data(Path(cost_dir) / f'costs-{scenario}.csv'))
+                            for scenario in scenarios}, names=['scenario', 'technology'])
+    grid = pd.DataFrame(list(product(technologies, horizons, scenarios)),
+                        columns=['technology', 'horizon', 'scenario'])
+    grid = grid.join(parameters, on=['scenario', 'technology'], how='inner')
+    return grid.reset_index(drop=True)
+
+
+def extra_functionality(n, snapshots):
+    link_p_nom = get_var(n, "Link", "p_nom")
+    lhs = linexpr((1, link_p_nom[["Link2Store"]]),
+                  (-n.links.loc[["Link2Main"], "efficiency"].values,
+                   link_p_nom[["Link2Main"]].values))
+    define_constraints(n, lhs, "=", 0, 'Link', 'link_fix')
+
+
+def pyomo_extra_functionality(network, snapshots):
+    from pyomo.environ import Constraint
+    model = network.model
+    model.link_fix = Constraint(
+        rule=lambda model: model.link_p_nom["Link2Store"]
+        == model.link_p_nom["Link2Main"] * network.links.loc['Link2Main', 'efficiency'])
+
+
+def build_network(technology, horizon, charger_capital_cost, charger_efficiency,
+                  discharger_capital_cost, discharger_efficiency, store_capital_cost):
+    """Build the minimal network of the notebooks for one storage technology."""
+    nhours = parse_horizon(horizon)
+
+    n = pypsa.Network()
+    n.set_snapshots(pd.date_range("2020-01-01 00:00", periods=nhours, freq="H"))
+
+    n.add("Bus", "Main", v_nom=380)
+    n.add("Load", "TotalLoads", bus="Main", p_set=23000)
+    n.add("Generator", "TotalGenerators", bus="Main", p_nom=32500,
+          p_max_pu=(6250*np.cos(np.linspace(0, 9, num=nhours)*(np.pi/9))+26250)/32500,
+          capital_cost=1.04*10**6, efficiency=1, marginal_cost=2.3, carrier="AC")
+
+    n.add("Bus", "StoreIsland", carrier="AC")
+    n.add("Link", "Link2Store", bus0="Main", bus1="StoreIsland",
+          capital_cost=charger_capital_cost, p_nom_extendable=True,
+          efficiency=charger_efficiency)
+    n.add("Link", "Link2Main", bus0="StoreIsland", bus1="Main",
+          capital_cost=discharger_capital_cost, p_nom_extendable=True,
+          efficiency=discharger_efficiency)
+    n.add("Store", "TheStorage", bus="StoreIsland", capital_cost=store_capital_cost,
+          e_nom_extendable=True, e_cyclic=True)
+    return n
+
+
+def solve_model(job, solver_name='glpk', solver_options=None):
+    """Build and solve one model of the grid; returns its results as a series."""
+    job = pd.Series(job)
+    start = time.time()
+    n = build_network(job.technology, job.horizon,
+                      **job[PARAMETERS].astype(float).to_dict())
+    built = time.time()
+
+    kwargs = dict(solver_name=solver_name, solver_options=solver_options or {}, pyomo=False)
+    if job.technology in FIXED_RATIO:
+        kwargs['extra_functionality'] = extra_functionality
+    status, condition = n.lopf(**kwargs)
+    solved = time.time()
+
+    ok = status == 'ok'
+    return pd.Series({'status': status, 'condition': condition,
+                      'objective': n.objective if ok else np.nan,
+                      'e_nom_opt': n.stores.at['TheStorage', 'e_nom_opt'] if ok else np.nan,
+                      'e_max': n.stores_t.e['TheStorage'].max() if ok else np.nan,
+                      'charger_p_nom_opt': n.links.at['Link2Store', 'p_nom_opt'] if ok else np.nan,
+                      'discharger_p_nom_opt': (n.links.at['Link2Main', 'p_nom_opt'] if ok
+                                               else np.nan),
+                      'build_time': built - start, 'solve_time': solved - built})
+
+
+def solve_grid(technologies=None, horizons=('10h', '3M'), scenarios=None,
+               cost_dir=COST_DIR, workers=None, solver_name='glpk', solver_options=None):
+    """
+    Solve the minimal network for every combination of ``technologies``,
+    ``horizons`` and cost ``scenarios`` in a pool of ``workers`` processes.
+
+    Returns a tidy frame with one row per model: its technology, horizon,
+    scenario and parameters, the solver status, the objective, optimal store
+    and link capacities and build and solve times.
+    """
+    grid = build_grid(technologies, horizons, scenarios, cost_dir)
+    logger.info(f"Solving {len(grid)} minimal network models.")
+
+    jobs = grid.to_dict('records')
+    with ProcessPoolExecutor(workers) as pool:
+        results = list(pool.map(solve_model, jobs, [solver_name] * len(jobs),
+                                [solver_options] * len(jobs)))
+
+    results = pd.concat([grid, pd.DataFrame(results)], axis=1)
+    failed = results.status != 'ok'
+    if failed.any():
+        logger.warning(f"{failed.sum()} of {len(results)} models were not solved to optimality.")
+    return results
+
+
+def benchmark_build(horizons=('10h', '3M'), technology='Lithium', scenario='realistic',
+                    cost_dir=COST_DIR, repeats=3):
+    """
+    Time building the optimisation problem of the minimal network of
+    ``technology`` through Pyomo (``lopf(pyomo=True)``) and through
+    :mod:`pypsa.linopf` (``lopf(pyomo=False)``, including writing the LP
+    file), without solving it. Returns the best of ``repeats`` in seconds per
+    horizon and path.
+    """
+    try:
+        from pypsa.opf import network_lopf_build_model
+    except ModuleNotFoundError:
+        raise ModuleNotFoundError("Optional dependency 'pyomo' not found. "
+                                  "Install via 'conda install -c conda-forge pyomo'.")
+    fixed = technology in FIXED_RATIO
+    grid = build_grid([technology], horizons, [scenario], cost_dir)
+
+    timings = {}
+    for job in grid.itertuples():
+        parameters = {p: getattr(job, p) for p in PARAMETERS}
+        pyomo_times, linopf_times = [], []
+        for _ in range(repeats):
+            n = build_network(technology, job.horizon, **parameters)
+            start = time.time()
+            network_lopf_build_model(n, n.snapshots)
+            if fixed:
+                pyomo_extra_functionality(n, n.snapshots)
+            pyomo_times.append(time.time() - start)
+
+            n = build_network(technology, job.horizon, **parameters)
+            start = time.time()
+            n.calculate_dependent_values()
+            n.determine_network_topology()
+            fdp, problem_fn = prepare_lopf(n, n.snapshots, extra_functionality=
+                                           extra_functionality if fixed else None)
+            linopf_times.append(time.time() - start)
+            os.close(fdp)
+            os.remove(problem_fn)
+        timings[job.horizon] = {'pyomo': min(pyomo_times), 'linopf': min(linopf_times)}
+
+    timings = pd.DataFrame(timings).T.rename_axis('horizon')
+    timings['speedup'] = timings.pyomo / timings.linopf
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--technologies', nargs='+', choices=list(TECHNOLOGIES))
+    parser.add_argument('--horizons', nargs='+', default=['10h', '3M'])
+    parser.add_argument('--scenarios', nargs='+', default=SCENARIOS,
+                        help="names of cost scenarios, i.e. cost-data/costs-{scenario}.csv")
+    parser.add_argument('--cost-dir', default=COST_DIR, type=Path)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--solver', default='glpk')
+    parser.add_argument('--benchmark', action='store_true',
+                        help="only compare build times of the Pyomo and linopf problems")
+    parser.add_argument('-o', '--output',
+                        help="default: minimal-network-results.csv, or "
+                             "minimal-network-benchmark.csv with --benchmark")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.benchmark:
+        timings = {}
+        for technology in args.technologies or ['Lithium']:
+            timings[technology] = benchmark_build(args.horizons, technology,
+                                                  args.scenarios[0], args.cost_dir)
+            logger.info(f"Build times of {technology} in seconds:\n{timings[technology]}")
+        timings = pd.concat(timings, names=['technology'])
+        timings.to_csv(args.output or 'minimal-network-benchmark.csv')
+        raise SystemExit
+    results = solve_grid(args.technologies, args.horizons, args.scenarios,
+                         args.cost_dir, args.workers, args.solver)
+    results.to_csv(args.output or 'minimal-network-results.csv', index=False)
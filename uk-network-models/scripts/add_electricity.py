@@ -25,6 +25,8 @@ Relevant Settings
         co2limit:
         extendable_carriers:
         estimate_renewable_capacities:
+        renewable_profile_chunksize:
+        renewable_profile_memory_logging:
 
 
     load:
@@ -84,6 +86,7 @@ It further adds extendable ``generators`` with **zero** capacity for
 """
 
 import logging
+import time
 from _helpers import configure_logging, update_p_nom_max
 
 import pypsa
@@ -94,7 +97,10 @@ import geopandas as gpd
 import powerplantmatching as pm
 from powerplantmatching.export import map_country_bus
 
+from contextlib import nullcontext
+from functools import lru_cache
 from vresutils import transfer as vtransfer
+from vresutils.benchmark import memory_logger
 
 idx = pd.IndexSlice
 
@@ -281,7 +287,29 @@ def update_transmission_costs(n, costs, length_factor=1.0):
     n.links.loc[dc_b, 'capital_cost'] = costs
 
 
-def attach_wind_and_solar(n, costs, input_profiles, technologies, extendable_carriers, line_length_factor=1):
+def load_profile(da, chunksize=None):
+    """
+    Read a renewable availability profile as a (time, bus) DataFrame.
+
+    Without ``chunksize`` the profile is materialised in one go in the dtype
+    stored on disk. With ``chunksize`` the profile is read lazily in blocks
+    of ``chunksize`` snapshots into a preallocated float32 array, so that the
+    peak memory is the float32 profile plus one float64 block.
+    """
+    da = da.transpose('time', 'bus')
+    if not chunksize:
+        return da.to_pandas()
+
+    profile = np.empty(da.shape, dtype=np.float32)
+    for start in range(0, da.sizes['time'], chunksize):
+        block = slice(start, start + chunksize)
+        profile[block] = da.isel(time=block).values
+    return pd.DataFrame(profile, index=da.indexes['time'],
+                        columns=da.indexes['bus'], copy=False)
+
+
+def attach_wind_and_solar(n, costs, input_profiles, technologies, extendable_carriers,
+                          line_length_factor=1, chunksize=None):
     # TODO: rename tech -> carrier, technologies -> carriers
     _add_missing_carriers_from_costs(n, costs, technologies)
 
@@ -309,7 +337,7 @@ def attach_wind_and_solar(n, costs, input_profiles, technologies, extendable_car
             else:
                 capital_cost = costs.at[tech, 'capital_cost']
 
-            n.madd("Generator", ds.indexes['bus'], ' ' + tech,
+            gens_i = n.madd("Generator", ds.indexes['bus'], ' ' + tech,
                    bus=ds.indexes['bus'],
                    carrier=tech,
                    p_nom_extendable=tech in extendable_carriers['Generator'],
@@ -317,8 +345,18 @@ def attach_wind_and_solar(n, costs, input_profiles, technologies, extendable_car
                    weight=ds['weight'].to_pandas(),
                    marginal_cost=costs.at[suptech, 'marginal_cost'],
                    capital_cost=capital_cost,
-                   efficiency=costs.at[suptech, 'efficiency'],
-                   p_max_pu=ds['profile'].transpose('time', 'bus').to_pandas())
+                   efficiency=costs.at[suptech, 'efficiency'])
+
+            # write the profile straight into the time-series storage instead
+            # of passing it through `madd`, which would copy it (and upcast
+            # a float32 profile) while aligning it to the network
+            p_max_pu = load_profile(ds['profile'], chunksize).reindex(n.snapshots, copy=False)
+            p_max_pu.columns = gens_i
+            if n.generators_t.p_max_pu.empty:
+                n.generators_t.p_max_pu = p_max_pu
+            else:
+                n.generators_t.p_max_pu = pd.concat([n.generators_t.p_max_pu, p_max_pu],
+                                                    axis=1, copy=False)
 
 
 def attach_conventional_generators(n, costs, ppl, conventional_carriers, extendable_carriers, conventional_config, conventional_inputs):
@@ -346,26 +384,32 @@ def attach_conventional_generators(n, costs, ppl, conventional_carriers, extenda
            lifetime=(ppl.dateout - ppl.datein).fillna(np.inf),
         )
     
-    for carrier in conventional_config:
-        
-        # Generators with technology affected
-        idx = n.generators.query("carrier == @carrier").index
-
-        for attr in list(set(conventional_config[carrier]) & set(n.generators)):
-
-            values = conventional_config[carrier][attr]
-
+    # collect all overrides, then assign them in one aligned update
+    scalar, by_country = {}, {}
+    for carrier, attrs in conventional_config.items():
+        for attr, values in attrs.items():
+            if attr not in n.generators: continue
             if f"conventional_{carrier}_{attr}" in conventional_inputs:
                 # Values affecting generators of technology k country-specific
-                # First map generator buses to countries; then map countries to p_max_pu
-                values = pd.read_csv(values, index_col=0).iloc[:, 0]
-                bus_values = n.buses.country.map(values)
-                n.generators[attr].update(n.generators.loc[idx].bus.map(bus_values).dropna())
+                by_country.setdefault(attr, {})[carrier] = _read_country_values(values)
             else:
                 # Single value affecting all generators of technology k indiscriminantely of country
-                n.generators.loc[idx, attr] = values
+                scalar.setdefault(attr, {})[carrier] = values
+    if not scalar and not by_country: return
+
+    gens = n.generators[n.generators.carrier.isin(list(conventional_config))]
+    overrides = pd.DataFrame(scalar).reindex(gens.carrier).set_axis(gens.index)
+    if by_country:
+        keys = pd.MultiIndex.from_arrays([gens.carrier, gens.bus.map(n.buses.country)])
+        by_country = pd.DataFrame({attr: pd.concat(values) for attr, values in by_country.items()})
+        overrides = overrides.combine_first(by_country.reindex(keys).set_axis(gens.index))
+    n.generators.update(overrides)
 
 
+@lru_cache(maxsize=None)
+def _read_country_values(fn):
+    return pd.read_csv(fn, index_col=0).iloc[:, 0]
+
 
 def attach_hydro(n, costs, ppl, profile_hydro, hydro_capacities, carriers, **config):
 
@@ -554,27 +598,31 @@ def estimate_renewable_capacities(n, config):
     logger.info(f"Heuristics applied to distribute renewable capacities [GW]: "
                 f"\n{capacities.groupby('Technology').sum().div(1e3).round(2)}")
 
-    
-    for ppm_technology, techs in tech_map.items():
-        tech_i = n.generators.query('carrier in @techs').index
-        stats = capacities.loc[ppm_technology].reindex(countries, fill_value=0.)
-        country = n.generators.bus[tech_i].map(n.buses.country)
-        existent = n.generators.p_nom[tech_i].groupby(country).sum()
-        missing = stats - existent
-        dist = n.generators_t.p_max_pu.mean() * n.generators.p_nom_max
-
-        n.generators.loc[tech_i, 'p_nom'] += (
-            dist[tech_i]
-            .groupby(country)
-            .transform(lambda s: normed(s) * missing[s.name])
-            .where(lambda s: s>0.1, 0.)  # only capacities above 100kW
-            ) 
-        n.generators.loc[tech_i, 'p_nom_min'] = n.generators.loc[tech_i, 'p_nom']
-
-        if expansion_limit:
-            assert np.isscalar(expansion_limit)
-            logger.info(f"Reducing capacity expansion limit to {expansion_limit*100:.2f}% of installed capacity.")
-            n.generators.loc[tech_i, 'p_nom_max'] = expansion_limit * n.generators.loc[tech_i, 'p_nom_min']
+    carrier_tech = pd.Series([tech for tech, carriers in tech_map.items() for _ in carriers],
+                             [carrier for carriers in tech_map.values() for carrier in carriers])
+    duplicated = carrier_tech.index[carrier_tech.index.duplicated()].unique()
+    if not duplicated.empty:
+        raise ValueError(f"Carriers {', '.join(duplicated)} are mapped to several technologies "
+                         f"in `estimate_renewable_capacities: technology_mapping`.")
+    tech_i = n.generators.query('carrier in @carrier_tech.index').index
+    keys = [n.generators.carrier[tech_i].map(carrier_tech).rename('Technology'),
+            n.generators.bus[tech_i].map(n.buses.country).rename('Country')]
+
+    # distribute missing capacities per technology and country in proportion
+    # to the expected generation at the expansion limit
+    stats = capacities.reindex(pd.MultiIndex.from_arrays(keys), fill_value=0.).values
+    existent = n.generators.p_nom[tech_i].groupby(keys).transform('sum').values
+    dist = (n.generators_t.p_max_pu.mean() * n.generators.p_nom_max)[tech_i]
+    share = dist / dist.groupby(keys).transform('sum').values
+    added = (share * (stats - existent)).where(lambda s: s>0.1, 0.)  # only capacities above 100kW
+
+    n.generators.loc[tech_i, 'p_nom'] += added
+    n.generators.loc[tech_i, 'p_nom_min'] = n.generators.loc[tech_i, 'p_nom']
+
+    if expansion_limit:
+        assert np.isscalar(expansion_limit)
+        logger.info(f"Reducing capacity expansion limit to {expansion_limit*100:.2f}% of installed capacity.")
+        n.generators.loc[tech_i, 'p_nom_max'] = expansion_limit * n.generators.loc[tech_i, 'p_nom_min']
 
 
 def add_nice_carrier_names(n, config):
@@ -625,7 +673,15 @@ if __name__ == "__main__":
     conventional_inputs = {k: v for k, v in snakemake.input.items() if k.startswith("conventional_")}
     attach_conventional_generators(n, costs, ppl, conventional_carriers, extendable_carriers, snakemake.config.get("conventional", {}), conventional_inputs)
 
-    attach_wind_and_solar(n, costs, snakemake.input, renewable_carriers, extendable_carriers, snakemake.config['lines']['length_factor'])
+    chunksize = snakemake.config['electricity'].get('renewable_profile_chunksize')
+    log_memory = snakemake.config['electricity'].get('renewable_profile_memory_logging', False)
+    start = time.time()
+    with memory_logger(interval=0.1, max_usage=True) if log_memory else nullcontext() as mem:
+        attach_wind_and_solar(n, costs, snakemake.input, renewable_carriers, extendable_carriers,
+                              snakemake.config['lines']['length_factor'], chunksize)
+    logger.info(f"Attached renewable profiles ({'chunks of ' + str(chunksize) if chunksize else 'eager'}) "
+                f"in {time.time() - start:.1f}s"
+                + (f" with maximum memory usage {mem.mem_usage}." if log_memory else "."))
 
     if 'hydro' in renewable_carriers:
         conf = snakemake.config['renewable']['hydro']
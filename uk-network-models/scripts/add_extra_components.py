@@ -24,6 +24,7 @@ Relevant Settings
         extendable_carriers:
             StorageUnit:
             Store:
+        extra_components_cache:
 
 .. seealso::
     Documentation of the configuration file ``config.yaml`` at :ref:`costs_cf`,
@@ -38,6 +39,7 @@ Outputs
 -------
 
 - ``networks/elec_s{simpl}_{clusters}_ec.nc``:
+- ``extra_components_cache`` (optional): directory of cached component fragments, one per storage carrier
 
 
 Description
@@ -48,14 +50,23 @@ The rule :mod:`add_extra_components` attaches additional extendable components t
 - ``StorageUnits`` of carrier 'H2' and/or 'battery'. If this option is chosen, every bus is given an extendable ``StorageUnit`` of the corresponding carrier. The energy and power capacities are linked through a parameter that specifies the energy capacity as maximum hours at full dispatch power and is configured in ``electricity: max_hours:``. This linkage leads to one investment variable per storage unit. The default ``max_hours`` lead to long-term hydrogen and short-term battery storage units.
 
 - ``Stores`` of carrier 'H2' and/or 'battery' in combination with ``Links``. If this option is chosen, the script adds extra buses with corresponding carrier where energy ``Stores`` are attached and which are connected to the corresponding power buses via two links, one each for charging and discharging. This leads to three investment variables for the energy capacity, charging and discharging capacity of the storage unit.
+
+Each storage carrier (and the hydrogen pipelines) is attached to a skeleton of the network, holding only its buses, lines and DC links, and the resulting components form a fragment which is merged into the network in bulk. With ``electricity: extra_components_cache`` set to a directory, fragments are stored there, keyed by a hash of the carrier's cost rows, its ``max_hours``, the network topology and the source code of the function attaching it, so that only carriers whose costs, configuration or code changed are rebuilt. Fragments are written atomically, so that concurrent jobs may share the cache, and only the ``fragment_cache_size`` most recently used fragments of each carrier are kept.
 """
 import logging
 from _helpers import configure_logging
 
+import hashlib
+import inspect
+import json
+import os
 import pypsa
 import pandas as pd
 import numpy as np
 
+from pathlib import Path
+from tempfile import mkstemp
+
 from add_electricity import (load_costs, add_nice_carrier_names,
                              _add_missing_carriers_from_costs)
 
@@ -425,6 +436,155 @@ def attach_hydrogen_pipelines(n, costs, elec_opts):
            carrier="H2 pipeline")
 
 
+# rows of the cost database used to attach each storage carrier
+carrier_cost_rows = {
+    'battery': ['battery', 'battery storage', 'battery inverter'],
+    'H2': ['H2', 'hydrogen storage', 'fuel cell', 'electrolysis'],
+    'CAES': ['CAES', 'CAES Storage', 'CAES Compressor', 'CAES Turbine'],
+    'LAES': ['LAES', 'LAES Energy', 'LAES Power'],
+    'ETES': ['ETES', 'ETES Energy', 'ETES Power'],
+    'NaS': ['NaS', 'NaS Energy', 'NaS Inverter'],
+    'FeFlow': ['FeFlow', 'FeFlow Energy', 'FeFlow Inverter'],
+    'H2 pipeline': ['H2 pipeline'],
+}
+
+fragment_components = ['Carrier', 'Bus', 'Store', 'Link', 'StorageUnit']
+
+
+def network_skeleton(n):
+    """Network with only the carriers, buses, lines and DC links of ``n``."""
+    m = pypsa.Network()
+    m.import_components_from_dataframe(n.carriers, 'Carrier')
+    m.import_components_from_dataframe(n.buses, 'Bus')
+    m.import_components_from_dataframe(n.lines[['bus0', 'bus1', 'length']], 'Line')
+    m.import_components_from_dataframe(
+        n.links.query('carrier == "DC"')[['bus0', 'bus1', 'length', 'carrier']], 'Link')
+    return m
+
+
+def topology_hash(n):
+    buses = n.buses[['x', 'y', 'country']].to_json()
+    branches = pd.concat([n.lines[['bus0', 'bus1', 'length']],
+                          n.links.query('carrier == "DC"')[['bus0', 'bus1', 'length']]]).to_json()
+    return hashlib.sha1((buses + branches).encode()).hexdigest()
+
+
+# number of cached fragments kept per carrier, the least recently used ones
+# being deleted first
+fragment_cache_size = 8
+
+
+def fragment_attach(component):
+    return {'StorageUnit': attach_storageunits, 'Store': attach_stores,
+            'Link': attach_hydrogen_pipelines}[component]
+
+
+def fragment_key(component, carrier, costs, elec_opts, topology):
+    rows = costs.reindex(carrier_cost_rows.get(carrier, [carrier])).to_json()
+    # fragments built by an earlier version of the code are not reused
+    code = inspect.getsource(fragment_attach(component)) + inspect.getsource(build_fragment)
+    payload = json.dumps([component, carrier, rows, elec_opts['max_hours'].get(carrier), topology,
+                          code], default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def build_fragment(skeleton, component, carrier, costs, elec_opts):
+    """Attach a single storage carrier to ``skeleton`` and return the added components."""
+    m = skeleton.copy()
+    before = {c: m.df(c).index for c in fragment_components}
+    extendable = {'StorageUnit': [], 'Store': [], 'Link': []}
+    if component == 'Link':
+        extendable.update(Store=['H2'], Link=[carrier])
+    else:
+        extendable[component] = [carrier]
+    opts = dict(elec_opts, extendable_carriers=dict(elec_opts['extendable_carriers'], **extendable))
+
+    fragment_attach(component)(m, costs, opts)
+    return {c: m.df(c).loc[m.df(c).index.difference(before[c])] for c in fragment_components}
+
+
+def write_fragment(fragment, fn):
+    """Write ``fragment`` to ``fn`` atomically, so that readers never see a partial file."""
+    fd, tmp = mkstemp(suffix='.tmp', prefix=fn.stem + '-', dir=fn.parent)
+    os.close(fd)
+    try:
+        pd.to_pickle(fragment, tmp)
+        os.replace(tmp, fn)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def prune_fragments(fn, keep=fragment_cache_size):
+    """Delete all but the ``keep`` most recently used fragments of the carrier of ``fn``."""
+    prefix, key = fn.stem.rsplit('-', 1)
+    stale = []
+    for other in fn.parent.glob(f"{prefix}-{'?' * len(key)}.pkl"):
+        try:
+            stale.append((other.stat().st_mtime, other))
+        except FileNotFoundError:
+            continue
+    for _, other in sorted(stale, reverse=True)[keep:]:
+        other.unlink(missing_ok=True)
+
+
+def carrier_fragments(n, costs, elec_opts, cache_dir=None):
+    """
+    Component fragments of all extendable storage carriers and hydrogen
+    pipelines, loaded from ``cache_dir`` where costs and configuration of a
+    carrier are unchanged.
+    """
+    carriers = elec_opts['extendable_carriers']
+    jobs = ([('StorageUnit', c) for c in carriers['StorageUnit']] +
+            [('Store', c) for c in carriers['Store']])
+    if 'H2 pipeline' in carriers.get('Link', []):
+        jobs.append(('Link', 'H2 pipeline'))
+    if cache_dir is not None:
+        cache_dir = Path(cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+
+    topology = topology_hash(n)
+    skeleton = None
+    fragments, rebuilt = [], []
+    for component, carrier in jobs:
+        key = fragment_key(component, carrier, costs, elec_opts, topology)
+        fn = None if cache_dir is None else cache_dir / f"{component}-{carrier.replace(' ', '_')}-{key}.pkl"
+        if fn is not None and fn.exists():
+            try:
+                fragment = pd.read_pickle(fn)
+                # the modification time marks the fragment as recently used
+                os.utime(fn)
+            except FileNotFoundError:
+                # pruned by a concurrent job in the meantime
+                fragment = None
+            if fragment is not None:
+                fragments.append(fragment)
+                continue
+        if skeleton is None:
+            skeleton = network_skeleton(n)
+        fragment = build_fragment(skeleton, component, carrier, costs, elec_opts)
+        if fn is not None:
+            write_fragment(fragment, fn)
+            prune_fragments(fn)
+        fragments.append(fragment)
+        rebuilt.append(carrier)
+
+    logger.info(f"Rebuilt fragments of {rebuilt or 'no carriers'}; "
+                f"{len(jobs) - len(rebuilt)} taken from cache.")
+    return fragments
+
+
+def attach_fragments(n, fragments):
+    """Merge component fragments into ``n`` in bulk, one import per component."""
+    for c in fragment_components:
+        dfs = [f[c] for f in fragments if not f[c].empty]
+        if not dfs: continue
+        df = pd.concat(dfs)
+        df = df[~df.index.duplicated() & ~df.index.isin(n.df(c).index)]
+        if df.empty: continue
+        n.import_components_from_dataframe(df, c)
+
+
 if __name__ == "__main__":
     if 'snakemake' not in globals():
         from _helpers import mock_snakemake
@@ -438,9 +598,9 @@ if __name__ == "__main__":
     Nyears = n.snapshot_weightings.objective.sum() / 8760.
     costs = load_costs(snakemake.input.tech_costs, snakemake.config['costs'], elec_config, Nyears)
 
-    attach_storageunits(n, costs, elec_config)
-    attach_stores(n, costs, elec_config)
-    attach_hydrogen_pipelines(n, costs, elec_config)
+    fragments = carrier_fragments(n, costs, elec_config,
+                                  elec_config.get('extra_components_cache'))
+    attach_fragments(n, fragments)
 
     add_nice_carrier_names(n, snakemake.config)
 
@@ -0,0 +1,253 @@
+# SPDX-FileCopyrightText: : 2017-2020 The PyPSA-Eur Authors
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Times and memory-profiles the stages of the workflow on synthetic GB-like
+networks, so that performance changes can be measured without the PyPSA-Eur
+data bundle or a commercial solver.
+
+Relevant Settings
+-----------------
+
+.. code:: yaml
+
+    costs:
+    electricity:
+    lines:
+    solving:
+        options:
+    benchmark:
+        clusters:
+        nhours:
+        carriers:
+        opts:
+        solver:
+        compare_scaling:
+        lp_workers:
+        tolerance:
+        seed:
+        history:
+
+.. seealso::
+    Documentation of the configuration file ``config.yaml`` at :ref:`costs_cf`,
+    :ref:`electricity_cf`, :ref:`solving_cf`
+
+Inputs
+------
+
+- ``cost-data/costs-{scenario}.csv``: cost assumptions of the novel storage technologies
+
+Outputs
+-------
+
+- ``benchmarks/stages_{scenario}.csv``: run time and maximum memory usage per case and stage of this run
+
+Description
+-----------
+
+For every combination of cluster count (``clusters``), number of hourly
+snapshots (``nhours``) and named set of extendable storage carriers
+(``carriers``), a network is built by :mod:`build_synthetic_network` and
+taken through the stages
+
+- ``load_costs``: :func:`add_electricity.load_costs`,
+- ``build_network``: :func:`build_synthetic_network.build_synthetic_network`,
+- ``add_extra_components``: attaching storage units, stores and hydrogen pipelines,
+- ``prepare_network``: :func:`solve_network.prepare_network`,
+- ``build_lp``: writing the linear problem including ``extra_functionality``,
+- ``solve``: :func:`solve_network.solve_network` with the open-source ``solver``.
+
+Each constraint hook called by :func:`solve_network.extra_functionality` is
+timed separately while the linear problem is built (stages ``hook:<name>``).
+For each number of ``lp_workers`` the linear problem is also built by
+:func:`solve_network.prepare_lopf_parallel` (stages ``build_lp:<workers>``),
+recording the speedup against the serial ``build_lp``.
+With ``compare_scaling: true`` and solver gurobi, the problem is additionally
+solved without and with the scaling of
+:func:`solve_network.scale_gurobi_model` (stages ``solve:unscaled`` and
+``solve:scaled``), recording the barrier iterations of each.
+
+Every run is also appended to the file ``history`` (outside of the rule's
+outputs, so that snakemake does not remove it) together with a timestamp and
+the git commit. Stages which take more than ``1 + tolerance`` times as long as
+in the previous run of the same case are reported as regressions.
+"""
+
+import logging
+from _helpers import configure_logging
+
+import os
+import subprocess
+import time
+import numpy as np
+import pandas as pd
+
+import solve_network
+
+from contextlib import contextmanager
+from functools import wraps
+from itertools import product
+from pathlib import Path
+from tempfile import mkstemp
+from vresutils.benchmark import memory_logger
+from add_electricity import load_costs
+from add_extra_components import (attach_storageunits, attach_stores,
+                                  attach_hydrogen_pipelines)
+from build_synthetic_network import synthetic_costs, build_synthetic_network
+from solve_network import prepare_network, prepare_problem
+
+logger = logging.getLogger(__name__)
+
+# constraint hooks called by solve_network.extra_functionality
+hooks = ['add_BAU_constraints', 'add_SAFE_constraints', 'add_CCL_constraints',
+         'add_operational_reserve_margin', 'add_EQ_constraints', 'add_battery_constraints']
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@contextmanager
+def timed_hooks(timings):
+    """Record the run time of each constraint hook of :mod:`solve_network` in ``timings``."""
+    originals = {name: getattr(solve_network, name) for name in hooks}
+
+    def timed(name, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            result = func(*args, **kwargs)
+            timings[name] = timings.get(name, 0.) + time.time() - start
+            return result
+        return wrapper
+
+    for name, func in originals.items():
+        setattr(solve_network, name, timed(name, func))
+    try:
+        yield timings
+    finally:
+        for name, func in originals.items():
+            setattr(solve_network, name, func)
+
+
+def run_case(tech_costs, config, clusters, nhours, carriers, opts, solver, seed=0,
+             compare_scaling=False, lp_workers=()):
+    """Run all stages for one case and return run time [s] and maximum memory [MiB] per stage."""
+    config = dict(config, electricity=dict(config['electricity'],
+                  extendable_carriers=dict(config['electricity']['extendable_carriers'], **carriers)),
+                  solving=dict(config['solving'], solver=solver))
+    elec_config = config['electricity']
+    results = {}
+
+    def stage(name, func, *args):
+        start = time.time()
+        with memory_logger(interval=0.1, max_usage=True) as mem:
+            result = func(*args)
+        results[name] = {'time': time.time() - start, 'memory': np.max(mem.mem_usage)}
+        return result
+
+    Nyears = nhours / 8760.
+    costs = stage('load_costs', load_costs, tech_costs, config['costs'], elec_config, Nyears)
+    n = stage('build_network', build_synthetic_network, clusters, nhours, costs, config, seed)
+
+    def add_extra_components(n):
+        attach_storageunits(n, costs, elec_config)
+        attach_stores(n, costs, elec_config)
+        attach_hydrogen_pipelines(n, costs, elec_config)
+        return n
+
+    n = stage('add_extra_components', add_extra_components, n)
+    n = stage('prepare_network', prepare_network, n, config['solving']['options'])
+
+    n.config = config
+    n.opts = opts
+    hook_timings = {}
+    with timed_hooks(hook_timings):
+        problem_fn = stage('build_lp', prepare_problem, n)
+    os.remove(problem_fn)
+    for name, seconds in hook_timings.items():
+        results[f'hook:{name}'] = {'time': seconds, 'memory': np.nan}
+
+    def build_lp_parallel(n, workers):
+        fdp, problem_fn = solve_network.prepare_lopf_parallel(
+            n, extra_functionality=solve_network.extra_functionality, workers=workers)
+        os.close(fdp)
+        return problem_fn
+
+    for workers in lp_workers:
+        name = f'build_lp:{workers}'
+        os.remove(stage(name, build_lp_parallel, n, workers))
+        results[name]['speedup'] = results['build_lp']['time'] / results[name]['time']
+        logger.info(f"Building the LP with {workers} workers: speedup "
+                    f"{results[name]['speedup']:.2f}.")
+
+    if compare_scaling and solver['name'] == 'gurobi':
+        options = config['solving']['options']
+        for scaled in [False, True]:
+            scaling = dict(options.get('scaling', {}), enable=scaled, compare=False)
+            case = dict(config, solving=dict(config['solving'],
+                                             options=dict(options, scaling=scaling)))
+            name = 'solve:scaled' if scaled else 'solve:unscaled'
+            m = stage(name, solve_network.solve_network_gurobi, n.copy(), case, opts)
+            results[name]['objective'] = m.objective
+            results[name]['barrier_iterations'] = m.solver_stats['solve']['barrier_iterations']
+
+    n = stage('solve', solve_network.solve_network, n, config, opts)
+    results['solve']['objective'] = n.objective
+    return pd.DataFrame(results).T.rename_axis('stage')
+
+
+def report_regressions(results, previous, tolerance):
+    keys = ['clusters', 'nhours', 'carriers', 'stage']
+    last = previous.groupby(keys).time.last()
+    compared = results.join(last.rename('previous'), on=keys).dropna(subset=['previous'])
+    slower = compared.query('time > (1 + @tolerance) * previous and time > 0.1')
+    for row in slower.itertuples():
+        logger.warning(f"Regression in stage '{row.stage}' for {row.clusters} clusters, "
+                       f"{row.nhours} snapshots and carriers '{row.carriers}': "
+                       f"{row.time:.2f}s instead of {row.previous:.2f}s.")
+    return slower
+
+
+if __name__ == "__main__":
+    if 'snakemake' not in globals():
+        from _helpers import mock_snakemake
+        snakemake = mock_snakemake('benchmark_stages', scenario='realistic')
+    configure_logging(snakemake)
+
+    config = snakemake.config
+    bconfig = config['benchmark']
+
+    fd, tech_costs = mkstemp(suffix='.csv', prefix='costs-synthetic-')
+    os.close(fd)
+    synthetic_costs(snakemake.input.cost_data, config['costs']['year']).to_csv(tech_costs)
+
+    timestamp = pd.Timestamp.now().isoformat(timespec='seconds')
+    commit = git_commit()
+    results = []
+    for clusters, nhours, (name, carriers) in product(bconfig['clusters'], bconfig['nhours'],
+                                                      bconfig['carriers'].items()):
+        logger.info(f"Benchmarking {clusters} clusters, {nhours} snapshots, carriers '{name}'.")
+        case = run_case(tech_costs, config, clusters, nhours, carriers,
+                        bconfig.get('opts', []), bconfig['solver'], bconfig.get('seed', 0),
+                        bconfig.get('compare_scaling', False), bconfig.get('lp_workers', []))
+        results.append(case.reset_index().assign(clusters=clusters, nhours=nhours, carriers=name))
+    os.remove(tech_costs)
+
+    results = pd.concat(results, ignore_index=True).assign(timestamp=timestamp, commit=commit)
+    results = results.reindex(columns=['timestamp', 'commit', 'clusters', 'nhours', 'carriers',
+                                       'stage', 'time', 'memory', 'objective',
+                                       'barrier_iterations', 'speedup'])
+
+    results.to_csv(snakemake.output[0], index=False)
+
+    history = Path(bconfig.get('history', 'benchmarks/history.csv'))
+    if history.exists():
+        report_regressions(results, pd.read_csv(history), bconfig.get('tolerance', 0.2))
+    history.parent.mkdir(parents=True, exist_ok=True)
+    results.to_csv(history, mode='a', header=not history.exists(), index=False)
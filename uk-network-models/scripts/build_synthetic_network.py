@@ -0,0 +1,315 @@
+# SPDX-FileCopyrightText: : 2017-2020 The PyPSA-Eur Authors
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Builds synthetic GB-like networks without the PyPSA-Eur data bundle, cutouts
+or powerplant database, e.g. to benchmark the later stages of the workflow.
+
+Relevant Settings
+-----------------
+
+.. code:: yaml
+
+    snapshots:
+        start:
+
+    costs:
+        year:
+        USD2013_to_EUR2013:
+        discountrate:
+
+    electricity:
+        co2limit:
+        max_hours:
+        extendable_carriers:
+            Generator:
+        conventional_carriers:
+
+    lines:
+        types:
+        s_max_pu:
+        length_factor:
+
+.. seealso::
+    Documentation of the configuration file ``config.yaml`` at :ref:`costs_cf`,
+    :ref:`electricity_cf`, :ref:`lines_cf`
+
+Inputs
+------
+
+- ``cost-data/costs-{scenario}.csv``: cost assumptions of the novel storage technologies
+
+Outputs
+-------
+
+- ``resources/costs_synthetic_{scenario}.csv``: cost database in the format of ``data/costs.csv``, readable by :func:`add_electricity.load_costs`
+- ``networks/synthetic_s_{clusters}_{nhours}h.nc``: synthetic network in the state of ``networks/elec_s_{clusters}.nc``, i.e. before :mod:`add_extra_components`
+
+Description
+-----------
+
+The cost database combines indicative defaults for the conventional,
+renewable, transmission, battery and hydrogen technologies (rounded from
+PyPSA-Eur's ``data/costs.csv`` for 2030) with the rows of the given file of
+``cost-data/``, which take precedence.
+
+The network has ``clusters - 1`` buses ``GB0 0, GB0 1, ...`` spread over
+Great Britain and one bus ``GB1 0`` in Northern Ireland, connected by an HVDC
+link, so that the bus names match those assumed for the salt cavern
+potentials in :mod:`add_extra_components`. AC lines form a spanning tree plus
+connections to nearest neighbours. Loads, wind and solar availability follow
+seeded random processes with daily and seasonal patterns; conventional
+generators, run-of-river and pumped hydro are placed on random buses. All
+costs are taken from :func:`add_electricity.load_costs`.
+"""
+
+import logging
+from _helpers import configure_logging
+
+import numpy as np
+import pandas as pd
+
+import pypsa
+from pypsa.geo import haversine_pts
+
+from add_electricity import (load_costs, update_transmission_costs,
+                             _add_missing_carriers_from_costs)
+
+logger = logging.getLogger(__name__)
+
+# technology, parameter, value, unit
+default_costs = [
+    ('onwind', 'investment', 1040., 'EUR/kWel'), ('onwind', 'FOM', 1.2, '%/year'),
+    ('onwind', 'VOM', 1.4, 'EUR/MWh'), ('onwind', 'lifetime', 30., 'years'),
+    ('offwind', 'investment', 1570., 'EUR/kWel'), ('offwind', 'FOM', 2.3, '%/year'),
+    ('offwind', 'VOM', 2.7, 'EUR/MWh'), ('offwind', 'lifetime', 30., 'years'),
+    ('solar-utility', 'investment', 420., 'EUR/kWel'), ('solar-utility', 'FOM', 2.5, '%/year'),
+    ('solar-utility', 'lifetime', 25., 'years'),
+    ('solar-rooftop', 'investment', 720., 'EUR/kWel'), ('solar-rooftop', 'FOM', 1.4, '%/year'),
+    ('solar-rooftop', 'lifetime', 25., 'years'),
+    ('OCGT', 'investment', 435., 'EUR/kWel'), ('OCGT', 'FOM', 1.8, '%/year'),
+    ('OCGT', 'VOM', 4.5, 'EUR/MWh'), ('OCGT', 'efficiency', 0.41, 'per unit'),
+    ('OCGT', 'lifetime', 25., 'years'),
+    ('CCGT', 'investment', 830., 'EUR/kWel'), ('CCGT', 'FOM', 3.3, '%/year'),
+    ('CCGT', 'VOM', 4.2, 'EUR/MWh'), ('CCGT', 'efficiency', 0.58, 'per unit'),
+    ('CCGT', 'lifetime', 25., 'years'),
+    ('nuclear', 'investment', 7940., 'EUR/kWel'), ('nuclear', 'FOM', 1.3, '%/year'),
+    ('nuclear', 'VOM', 3.5, 'EUR/MWh'), ('nuclear', 'fuel', 2.6, 'EUR/MWh'),
+    ('nuclear', 'efficiency', 0.33, 'per unit'), ('nuclear', 'lifetime', 40., 'years'),
+    ('biomass', 'investment', 2210., 'EUR/kWel'), ('biomass', 'FOM', 4.5, '%/year'),
+    ('biomass', 'VOM', 3.1, 'EUR/MWh'), ('biomass', 'fuel', 7., 'EUR/MWhth'),
+    ('biomass', 'efficiency', 0.47, 'per unit'), ('biomass', 'lifetime', 30., 'years'),
+    ('gas', 'fuel', 21.6, 'EUR/MWhth'), ('gas', 'CO2 intensity', 0.2, 'tCO2/MWh_th'),
+    ('gas', 'discount rate', 0.07, 'per unit'),
+    ('hydro', 'investment', 2200., 'EUR/kWel'), ('hydro', 'FOM', 1., '%/year'),
+    ('hydro', 'lifetime', 80., 'years'),
+    ('ror', 'investment', 3000., 'EUR/kWel'), ('ror', 'FOM', 2., '%/year'),
+    ('ror', 'lifetime', 80., 'years'),
+    ('PHS', 'investment', 2200., 'EUR/kWel'), ('PHS', 'FOM', 1., '%/year'),
+    ('PHS', 'efficiency', 0.75, 'per unit'), ('PHS', 'lifetime', 80., 'years'),
+    ('battery storage', 'investment', 142., 'EUR/kWh'), ('battery storage', 'lifetime', 25., 'years'),
+    ('battery inverter', 'investment', 160., 'EUR/kWel'), ('battery inverter', 'FOM', 0.34, '%/year'),
+    ('battery inverter', 'efficiency', 0.96, 'per unit'), ('battery inverter', 'lifetime', 10., 'years'),
+    ('hydrogen storage', 'investment', 11.2, 'EUR/kWh'), ('hydrogen storage', 'lifetime', 30., 'years'),
+    ('electrolysis', 'investment', 550., 'EUR/kWel'), ('electrolysis', 'FOM', 2., '%/year'),
+    ('electrolysis', 'efficiency', 0.66, 'per unit'), ('electrolysis', 'lifetime', 25., 'years'),
+    ('fuel cell', 'investment', 1100., 'EUR/kWel'), ('fuel cell', 'FOM', 5., '%/year'),
+    ('fuel cell', 'efficiency', 0.5, 'per unit'), ('fuel cell', 'lifetime', 10., 'years'),
+    ('H2 pipeline', 'investment', 267., 'EUR/MW/km'), ('H2 pipeline', 'FOM', 1.7, '%/year'),
+    ('H2 pipeline', 'efficiency', 1., 'per unit'), ('H2 pipeline', 'lifetime', 40., 'years'),
+    ('HVAC overhead', 'investment', 433., 'EUR/MW/km'), ('HVAC overhead', 'FOM', 2., '%/year'),
+    ('HVAC overhead', 'lifetime', 40., 'years'),
+    ('HVDC overhead', 'investment', 433., 'EUR/MW/km'), ('HVDC overhead', 'FOM', 2., '%/year'),
+    ('HVDC overhead', 'lifetime', 40., 'years'),
+    ('HVDC submarine', 'investment', 1008., 'EUR/MW/km'), ('HVDC submarine', 'FOM', 0.35, '%/year'),
+    ('HVDC submarine', 'lifetime', 40., 'years'),
+    ('HVDC inverter pair', 'investment', 162000., 'EUR/MW'), ('HVDC inverter pair', 'FOM', 2., '%/year'),
+    ('HVDC inverter pair', 'lifetime', 40., 'years'),
+]
+
+# bus of Northern Ireland and bounding box of Great Britain (x, y)
+ni_coordinates = (-6.6, 54.6)
+gb_bounds = ((-5.5, 50.2), (1.5, 58.5))
+
+
+def synthetic_costs(cost_data, year):
+    """Cost database in the format of ``data/costs.csv`` from the defaults and a file of ``cost-data/``."""
+    costs = pd.DataFrame(default_costs, columns=['technology', 'parameter', 'value', 'unit'])
+    costs['source'] = 'synthetic default'
+    data = pd.read_csv(cost_data, encoding='utf-8-sig')
+    data['technology'] = data.technology.str.strip()
+    data['source'] = data.get('source', cost_data)
+    costs = (pd.concat([costs, data.drop(columns='year')])
+             .drop_duplicates(['technology', 'parameter'], keep='last'))
+    costs.insert(1, 'year', year)
+    return costs.set_index(['technology', 'year', 'parameter']).sort_index()
+
+
+def synthetic_edges(x, y, neighbours=2):
+    """Minimum spanning tree of the buses plus edges to their nearest neighbours."""
+    nbuses = len(x)
+    distance = haversine_pts(np.c_[x, y][:, None].repeat(nbuses, 1).reshape(-1, 2),
+                             np.c_[x, y][None, :].repeat(nbuses, 0).reshape(-1, 2)).reshape(nbuses, nbuses)
+    # Prim's algorithm
+    edges = set()
+    in_tree = np.zeros(nbuses, dtype=bool)
+    in_tree[0] = True
+    best = distance[0].copy()
+    parent = np.zeros(nbuses, dtype=int)
+    for _ in range(nbuses - 1):
+        candidates = np.where(in_tree, np.inf, best)
+        j = int(candidates.argmin())
+        edges.add((min(j, parent[j]), max(j, parent[j])))
+        in_tree[j] = True
+        closer = distance[j] < best
+        best[closer] = distance[j][closer]
+        parent[closer] = j
+    nearest = np.argsort(distance, axis=1)[:, 1:neighbours + 1]
+    for i, row in enumerate(nearest):
+        edges.update((min(i, j), max(i, j)) for j in row)
+    edges = np.array(sorted(edges))
+    return edges, distance[edges[:, 0], edges[:, 1]]
+
+
+def ar1(rng, nhours, ncols, persistence):
+    """Standard normal AR(1) processes of length ``nhours``."""
+    noise = rng.standard_normal((nhours, ncols))
+    z = np.empty_like(noise)
+    z[0] = noise[0]
+    scale = np.sqrt(1 - persistence**2)
+    for t in range(1, nhours):
+        z[t] = persistence * z[t - 1] + scale * noise[t]
+    return z
+
+
+def synthetic_profiles(rng, snapshots, nbuses):
+    """Availability of onshore and offshore wind and solar and the load profile."""
+    nhours = len(snapshots)
+    hour = snapshots.hour.values[:, None]
+    season = np.cos(2 * np.pi * (snapshots.dayofyear.values[:, None] - 172) / 365)
+
+    national, local = ar1(rng, nhours, 1, 0.98), ar1(rng, nhours, nbuses, 0.9)
+    wind = 0.75 * national + 0.45 * local
+    onwind = np.clip(0.3 - 0.08 * season + 0.2 * wind, 0., 1.)
+    offwind = np.clip(0.45 - 0.1 * season + 0.25 * wind, 0., 1.)
+
+    daylength = 12 + 4 * season
+    daylight = np.clip(np.sin(np.pi * (hour - 12 + daylength / 2) / daylength), 0., None)
+    clouds = np.clip(0.7 + 0.2 * ar1(rng, nhours, nbuses, 0.8), 0.1, 1.)
+    solar = np.clip(daylight * (0.55 + 0.25 * season) * clouds, 0., 1.)
+
+    load = ((1 - 0.15 * season) *
+            (1 + 0.15 * np.sin(2 * np.pi * (hour - 9) / 24)) *
+            (1 + 0.02 * ar1(rng, nhours, 1, 0.95)))
+    return onwind, offwind, solar, load[:, 0]
+
+
+def build_synthetic_network(clusters, nhours, costs, config, seed=0):
+    """
+    Build a synthetic GB-like network with ``clusters`` buses and ``nhours``
+    hourly snapshots; costs are as from :func:`add_electricity.load_costs`.
+    """
+    if clusters < 20:
+        raise ValueError("Synthetic networks need at least 20 buses, as the salt cavern "
+                         "potentials of add_extra_components refer to buses 'GB0 0' to "
+                         f"'GB0 18' and 'GB1 0', not {clusters}.")
+    rng = np.random.default_rng(seed)
+    elec_config = config['electricity']
+
+    n = pypsa.Network()
+    n.set_snapshots(pd.date_range(config['snapshots']['start'], periods=nhours, freq='H'))
+    Nyears = n.snapshot_weightings.objective.sum() / 8760.
+
+    (x0, y0), (x1, y1) = gb_bounds
+    x = np.r_[rng.uniform(x0, x1, clusters - 1), ni_coordinates[0]]
+    y = np.r_[rng.uniform(y0, y1, clusters - 1), ni_coordinates[1]]
+    buses_i = pd.Index([f'GB0 {i}' for i in range(clusters - 1)] + ['GB1 0'])
+    n.madd("Bus", buses_i, x=x, y=y, v_nom=380., carrier='AC', country='GB')
+
+    edges, length = synthetic_edges(x[:-1], y[:-1])
+    line_type = config['lines']['types'][380.]
+    num_parallel = rng.integers(1, 4, len(edges)).astype(float)
+    n.madd("Line", pd.Index(range(len(edges))).astype(str),
+           bus0=buses_i[edges[:, 0]], bus1=buses_i[edges[:, 1]],
+           type=line_type, num_parallel=num_parallel, length=length,
+           s_nom=np.sqrt(3) * n.line_types.at[line_type, 'i_nom'] * 380. * num_parallel,
+           s_max_pu=config['lines']['s_max_pu'], carrier='AC')
+    n.lines['s_nom_min'] = n.lines.s_nom
+
+    # Northern Ireland is connected to the closest bus in Great Britain
+    distance = haversine_pts(np.c_[x[:-1], y[:-1]], np.array([ni_coordinates] * (clusters - 1)))
+    closest = int(distance.argmin())
+    n.add("Link", "NI interconnector", bus0=buses_i[closest], bus1='GB1 0', carrier='DC',
+          p_nom=500., p_min_pu=-1., length=distance[closest], underwater_fraction=1.)
+    update_transmission_costs(n, costs, config['lines']['length_factor'])
+
+    onwind, offwind, solar, load = synthetic_profiles(rng, n.snapshots, clusters)
+    share = rng.lognormal(0., 0.7, clusters)
+    n.madd("Load", buses_i, bus=buses_i,
+           p_set=pd.DataFrame(35e3 * load[:, None] * share / share.sum(),
+                              n.snapshots, buses_i))
+
+    extendable = elec_config['extendable_carriers']['Generator']
+    coastal = rng.random(clusters) < 0.4
+    renewables = {'onwind': ('onwind', onwind, np.ones(clusters, dtype=bool), 2e4),
+                  'offwind-ac': ('offwind', offwind, coastal, 1e4),
+                  'offwind-dc': ('offwind', offwind, coastal, 3e4),
+                  'solar': ('solar', solar, np.ones(clusters, dtype=bool), 1e4)}
+    for carrier, (tech, profile, located, potential) in renewables.items():
+        i = buses_i[located]
+        n.madd("Generator", i, ' ' + carrier, bus=i, carrier=carrier,
+               p_nom_extendable=carrier in extendable,
+               p_nom_max=potential * rng.uniform(0.2, 1., len(i)),
+               marginal_cost=costs.at[tech, 'marginal_cost'],
+               capital_cost=costs.at[tech, 'capital_cost'],
+               p_max_pu=pd.DataFrame(profile[:, located], n.snapshots, i + ' ' + carrier))
+
+    conventional = {'CCGT': 25e3, 'OCGT': 5e3, 'nuclear': 6e3, 'biomass': 3e3}
+    for carrier, capacity in conventional.items():
+        i = buses_i[rng.random(clusters) < 0.3]
+        if i.empty: continue
+        p_nom = capacity * rng.dirichlet(np.ones(len(i)))
+        n.madd("Generator", i, ' ' + carrier, bus=i, carrier=carrier,
+               p_nom=p_nom, p_nom_min=p_nom, p_nom_extendable=carrier in extendable,
+               marginal_cost=costs.at[carrier, 'marginal_cost'],
+               capital_cost=costs.at[carrier, 'capital_cost'],
+               efficiency=costs.at[carrier, 'efficiency'])
+
+    ror_i = buses_i[rng.choice(clusters - 1, 5, replace=False)]
+    n.madd("Generator", ror_i, ' ror', bus=ror_i, carrier='ror', p_nom=300.,
+           p_max_pu=0.4, marginal_cost=costs.at['ror', 'marginal_cost'],
+           capital_cost=costs.at['ror', 'capital_cost'], efficiency=costs.at['ror', 'efficiency'])
+
+    phs_i = buses_i[rng.choice(clusters - 1, 4, replace=False)]
+    n.madd("StorageUnit", phs_i, ' PHS', bus=phs_i, carrier='PHS', p_nom=700.,
+           max_hours=elec_config.get('PHS_max_hours', 6),
+           efficiency_store=np.sqrt(costs.at['PHS', 'efficiency']),
+           efficiency_dispatch=np.sqrt(costs.at['PHS', 'efficiency']),
+           capital_cost=costs.at['PHS', 'capital_cost'], cyclic_state_of_charge=True)
+
+    _add_missing_carriers_from_costs(n, costs, n.generators.carrier.unique().tolist() + ['PHS'])
+    n.add("GlobalConstraint", "CO2Limit", carrier_attribute="co2_emissions", sense="<=",
+          constant=elec_config['co2limit'] * Nyears)
+
+    logger.info(f"Built synthetic network with {len(n.buses)} buses, {len(n.lines)} lines "
+                f"and {len(n.snapshots)} snapshots.")
+    return n
+
+
+if __name__ == "__main__":
+    if 'snakemake' not in globals():
+        from _helpers import mock_snakemake
+        snakemake = mock_snakemake('build_synthetic_network', clusters='20',
+                                  nhours='168', scenario='realistic')
+    configure_logging(snakemake)
+
+    costs = synthetic_costs(snakemake.input.cost_data, snakemake.config['costs']['year'])
+    costs.to_csv(snakemake.output.tech_costs)
+
+    nhours = int(snakemake.wildcards.nhours)
+    costs = load_costs(snakemake.output.tech_costs, snakemake.config['costs'],
+                       snakemake.config['electricity'], nhours / 8760.)
+    n = build_synthetic_network(int(snakemake.wildcards.clusters), nhours, costs,
+                                snakemake.config, snakemake.config.get('benchmark', {}).get('seed', 0))
+    n.export_to_netcdf(snakemake.output.network)
@@ -0,0 +1,434 @@
+# SPDX-FileCopyrightText: : 2017-2020 The PyPSA-Eur Authors
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Distributes the scenarios of a scenario matrix over workers on several hosts
+through a job queue, each job attaching the extra components to a network and
+solving it, with results and telemetry in a shared store.
+
+Relevant Settings
+-----------------
+
+.. code:: yaml
+
+    dispatch:
+        queue:
+        store:
+        lease:
+        max_attempts:
+        poll:
+        matrix:
+            config:
+            network:
+            tech_costs:
+            opts:
+            co2limit:
+        resources:
+
+.. seealso::
+    The solver and storage settings of each job are taken from its own
+    configuration file in ``matrix: config``.
+
+Inputs
+------
+
+- ``networks/elec_s{simpl}_{clusters}.nc``: clustered networks before :mod:`add_extra_components`, one per weather year, as listed in ``matrix: network``
+- ``cost-data/costs-{scenario}.csv``: cost assumptions, as listed in ``matrix: tech_costs``
+
+Outputs
+-------
+
+- ``results/dispatch/{key}/network.nc``: solved network of the job with key ``key``
+- ``results/dispatch/{key}/telemetry.json``: host, run time, maximum memory usage, objective, storage capacities and solver statistics of the job
+- ``results/dispatch/status.csv``: scenario, state, attempts and host of all jobs (when run by snakemake)
+
+Description
+-----------
+
+The coordinator (``submit``, or the snakemake rule) expands the cartesian
+product of ``matrix`` (e.g. cost level × EP mode × CO2 cap × weather year)
+into jobs. Jobs start from the clustered network and do not run PyPSA-Eur's
+``prepare_network``, so ``matrix: opts`` may only contain the options handled
+by :mod:`solve_network` itself (``BAU``, ``SAFE``, ``CCL``, ``EQ``); CO2 caps
+are given by ``matrix: co2limit``. Each job carries its complete configuration, so that workers on
+other hosts solve exactly the submitted scenario. The key of a job is a hash
+of its scenario; identical scenarios are queued only once, and scenarios which
+were already solved are not solved again.
+
+The queue is an SQLite database ``queue`` on a filesystem shared by all hosts
+(a stand-in for a proper queue backend). Start one worker per host::
+
+    python scripts/dispatch_scenarios.py work --config configs/config-baseline.yaml \\
+        --cores 32 --memory 128000
+
+A worker only claims jobs which fit into its remaining ``--cores`` and
+``--memory`` [MB], as given per model family (``solving: solver_profile``)
+by ``resources``, so that a few large Var-EP jobs do not oversubscribe a host
+while small jobs fill the gaps. The solver gets as many threads as the job
+has cores. Each job runs in a child process; its worker renews the lease of
+the job every ``poll`` seconds, and terminates the job if the lease was lost
+in the meantime (e.g. after a network outage), so that only the new owner
+writes its results and state. Jobs whose lease of ``lease`` seconds expires
+(e.g. because the host went down) and jobs which fail are handed out again
+up to ``max_attempts`` times.
+
+``status`` prints the number of jobs per state and the failures.
+"""
+
+import logging
+from _helpers import configure_logging
+
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import time
+import traceback
+import yaml
+import pandas as pd
+
+from contextlib import contextmanager
+from copy import deepcopy
+from itertools import product
+from multiprocessing import get_context
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    key TEXT PRIMARY KEY,
+    scenario TEXT NOT NULL,
+    cores INTEGER NOT NULL,
+    memory INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    node TEXT,
+    lease_until REAL,
+    submitted REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    telemetry TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, submitted);
+"""
+
+
+class JobQueue:
+    """Scenario jobs in an SQLite database shared by the coordinator and the workers."""
+
+    def __init__(self, path, timeout=60.):
+        self.path = str(path)
+        self.timeout = timeout
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=self.timeout)
+        try:
+            conn.executescript(schema)
+        finally:
+            conn.close()
+
+    @contextmanager
+    def transaction(self):
+        # IMMEDIATE takes the write lock up front, so that two workers never
+        # claim the same job
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def submit(self, scenario, cores, memory, max_attempts=3, retry_failed=False):
+        """Queue ``scenario`` unless it is queued already; returns its key and whether it is new."""
+        key = scenario_key(scenario)
+        with self.transaction() as conn:
+            new = conn.execute(
+                'INSERT OR IGNORE INTO jobs (key, scenario, cores, memory, max_attempts, submitted) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, json.dumps(scenario, sort_keys=True), cores, memory, max_attempts,
+                 time.time())).rowcount > 0
+            if not new and retry_failed:
+                conn.execute("UPDATE jobs SET state = 'pending', attempts = 0, error = NULL "
+                             "WHERE key = ? AND state = 'failed'", (key,))
+        return key, new
+
+    def claim(self, node, cores, memory, lease):
+        """
+        Hand the oldest pending job which fits into ``cores`` and ``memory`` to
+        ``node`` for ``lease`` seconds, after putting jobs with expired leases
+        back into the queue. Returns the job as dictionary or None.
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute("UPDATE jobs SET state = CASE WHEN attempts < max_attempts "
+                         "THEN 'pending' ELSE 'failed' END, error = 'lease expired on ' || node "
+                         "WHERE state = 'running' AND lease_until < ?", (now,))
+            job = conn.execute("SELECT * FROM jobs WHERE state = 'pending' AND cores <= ? "
+                               "AND memory <= ? ORDER BY submitted, key LIMIT 1",
+                               (cores, memory)).fetchone()
+            if job is None:
+                return None
+            conn.execute("UPDATE jobs SET state = 'running', node = ?, attempts = attempts + 1, "
+                         "lease_until = ?, started = ? WHERE key = ?",
+                         (node, now + lease, now, job['key']))
+        return dict(job, node=node, attempts=job['attempts'] + 1)
+
+    # the lease of a job is held by the node and attempt which claimed it; all
+    # updates below only apply as long as it is held
+
+    def heartbeat(self, jobs, node, lease):
+        """Renew the leases of ``jobs`` (key to attempt); returns the keys of lost leases."""
+        lost = []
+        with self.transaction() as conn:
+            for key, attempt in jobs.items():
+                renewed = conn.execute("UPDATE jobs SET lease_until = ? WHERE key = ? "
+                                       "AND node = ? AND attempts = ? AND state = 'running'",
+                                       (time.time() + lease, key, node, attempt)).rowcount
+                if not renewed:
+                    lost.append(key)
+        return lost
+
+    def complete(self, key, node, attempt, telemetry):
+        """Mark a job done; returns False if its lease was lost."""
+        with self.transaction() as conn:
+            return conn.execute("UPDATE jobs SET state = 'done', finished = ?, telemetry = ?, "
+                                "error = NULL WHERE key = ? AND node = ? AND attempts = ? "
+                                "AND state = 'running'",
+                                (time.time(), json.dumps(telemetry, default=float), key, node,
+                                 attempt)).rowcount > 0
+
+    def fail(self, key, node, attempt, error):
+        """
+        Put a failed job back into the queue, or mark it failed after its last
+        attempt; returns False if its lease was lost.
+        """
+        with self.transaction() as conn:
+            return conn.execute("UPDATE jobs SET state = CASE WHEN attempts < max_attempts "
+                                "THEN 'pending' ELSE 'failed' END, finished = ?, error = ? "
+                                "WHERE key = ? AND node = ? AND attempts = ? AND state = 'running'",
+                                (time.time(), error, key, node, attempt)).rowcount > 0
+
+    def status(self):
+        with self.transaction() as conn:
+            rows = conn.execute("SELECT key, scenario, state, attempts, node, started, finished, "
+                                "error FROM jobs ORDER BY submitted, key").fetchall()
+        df = pd.DataFrame([dict(row) for row in rows],
+                          columns=['key', 'scenario', 'state', 'attempts', 'node', 'started',
+                                   'finished', 'error'])
+        scenarios = [json.loads(s) for s in df.pop('scenario')]
+        for column in ['family', 'network', 'tech_costs', 'opts', 'co2limit']:
+            df.insert(1, column, [s.get(column) for s in scenarios])
+        return df.set_index('key')
+
+
+def scenario_key(scenario):
+    return hashlib.sha256(json.dumps(scenario, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def read_config(fn):
+    with open(fn) as f:
+        return yaml.safe_load(f)
+
+
+def check_opts(opts):
+    """Raise for ``opts`` which only PyPSA-Eur's ``prepare_network`` would apply."""
+    unsupported = [o for o in opts.split('-')
+                   if o and o not in ['BAU', 'SAFE', 'CCL'] and 'EQ' not in o]
+    if unsupported:
+        raise ValueError(f"Opts {', '.join(unsupported)} are not supported by dispatch jobs, "
+                         "which do not run `prepare_network`; only BAU, SAFE, CCL and EQ are "
+                         "applied by `solve_network`. Use `matrix: co2limit` for CO2 caps.")
+
+
+def scenario_matrix(dconfig):
+    """Scenarios of the cartesian product of ``dispatch: matrix`` with their resources."""
+    matrix = dconfig['matrix']
+    keys = ['config', 'network', 'tech_costs', 'opts', 'co2limit']
+    values = [matrix.get(key) or [None] for key in keys]
+    for opts in values[keys.index('opts')]:
+        check_opts(opts or '')
+    resources = dconfig.get('resources', {})
+    scenarios = []
+    for config_fn, network, tech_costs, opts, co2limit in product(*values):
+        config = read_config(config_fn)
+        family = config['solving'].get('solver_profile', Path(config_fn).stem)
+        scenario = dict(config=config, family=family, network=network, tech_costs=tech_costs,
+                        opts=opts or '', co2limit=co2limit)
+        scenarios.append((scenario, resources.get(family, resources.get('default', {}))))
+    return scenarios
+
+
+def submit_matrix(queue, dconfig, retry_failed=False):
+    new = 0
+    for scenario, resources in scenario_matrix(dconfig):
+        _, added = queue.submit(scenario, resources.get('cores', 4), resources.get('memory', 16000),
+                                dconfig.get('max_attempts', 3), retry_failed)
+        new += added
+    logger.info(f"Submitted {new} new jobs.")
+    return new
+
+
+def run_job(key, scenario, store, cores):
+    """Attach the extra components to the network of ``scenario``, solve it and write the results."""
+    out = Path(store) / key
+    out.mkdir(parents=True, exist_ok=True)
+    # left by an earlier attempt
+    (out / 'telemetry.json').unlink(missing_ok=True)
+    logging.basicConfig(filename=out / 'job.log', level=logging.INFO, force=True)
+
+    import pypsa
+    from vresutils.benchmark import memory_logger
+    from add_electricity import load_costs
+    from add_extra_components import carrier_fragments, attach_fragments
+    from solve_network import (prepare_network, solve_network, storage_capacities,
+                               apply_solver_profile)
+
+    config = deepcopy(scenario['config'])
+    apply_solver_profile(config)
+    if config['solving']['solver']['name'] == 'gurobi':
+        config['solving']['solver']['threads'] = cores
+    elec_config = config['electricity']
+    tmpdir = config['solving'].get('tmpdir')
+    if tmpdir is not None:
+        Path(tmpdir).mkdir(parents=True, exist_ok=True)
+
+    start = time.time()
+    with memory_logger(interval=5., max_usage=True) as mem:
+        n = pypsa.Network(scenario['network'])
+        Nyears = n.snapshot_weightings.objective.sum() / 8760.
+        costs = load_costs(scenario['tech_costs'], config['costs'], elec_config, Nyears)
+        attach_fragments(n, carrier_fragments(n, costs, elec_config,
+                                              elec_config.get('extra_components_cache')))
+        if scenario.get('co2limit') is not None:
+            n.add("GlobalConstraint", "CO2Limit", carrier_attribute="co2_emissions",
+                  sense="<=", constant=scenario['co2limit'] * Nyears)
+        n = prepare_network(n, config['solving']['options'])
+        n = solve_network(n, config, scenario['opts'].split('-'), solver_dir=tmpdir,
+                          solver_logfile=str(out / 'solver.log'))
+        n.export_to_netcdf(out / 'network.nc')
+
+    telemetry = dict(node=socket.gethostname(), runtime=time.time() - start,
+                     memory=mem.mem_usage, objective=n.objective,
+                     capacities=storage_capacities(n).to_dict(),
+                     solver_stats=getattr(n, 'solver_stats', None))
+    with open(out / 'telemetry.json', 'w') as f:
+        json.dump(telemetry, f, default=float)
+
+
+def _run_child(key, scenario, store, cores):
+    try:
+        run_job(key, scenario, store, cores)
+    except BaseException:
+        traceback.print_exc()
+        os._exit(1)
+    os._exit(0)
+
+
+def work(queue, store, cores, memory, lease=600., poll=10., node=None, drain=False):
+    """
+    Claim and run jobs within the budget of ``cores`` and ``memory`` [MB]
+    until stopped, or with ``drain`` until the queue holds no more jobs for
+    this worker.
+    """
+    node = node or f"{socket.gethostname()}:{os.getpid()}"
+    context = get_context('fork')
+    running = {}
+    logger.info(f"Worker {node} with {cores} cores and {memory} MB polling {queue.path}.")
+    while True:
+        for key, (process, job) in list(running.items()):
+            if process.is_alive(): continue
+            process.join()
+            del running[key]
+            telemetry_fn = Path(store) / key / 'telemetry.json'
+            if process.exitcode == 0 and telemetry_fn.exists():
+                with open(telemetry_fn) as f:
+                    owned = queue.complete(key, node, job['attempts'], json.load(f))
+                logger.info(f"Finished job {key}.")
+            else:
+                owned = queue.fail(key, node, job['attempts'],
+                                   f"exit code {process.exitcode} on {node}, "
+                                   f"see {Path(store) / key / 'job.log'}")
+                logger.warning(f"Job {key} failed with exit code {process.exitcode}.")
+            if not owned:
+                logger.warning(f"Lease of job {key} was lost before it ended; its state is "
+                               "left to the new owner.")
+
+        lost = queue.heartbeat({key: job['attempts'] for key, (_, job) in running.items()},
+                               node, lease)
+        for key in lost:
+            process, _ = running.pop(key)
+            process.terminate()
+            process.join()
+            logger.warning(f"Lease of job {key} was lost; terminated it.")
+
+        free_cores = cores - sum(job['cores'] for _, job in running.values())
+        free_memory = memory - sum(job['memory'] for _, job in running.values())
+        while True:
+            job = queue.claim(node, free_cores, free_memory, lease)
+            if job is None: break
+            process = context.Process(target=_run_child,
+                                      args=(job['key'], json.loads(job['scenario']), store,
+                                            job['cores']))
+            process.start()
+            running[job['key']] = (process, job)
+            free_cores -= job['cores']
+            free_memory -= job['memory']
+            logger.info(f"Started job {job['key']} ({job['cores']} cores, {job['memory']} MB, "
+                        f"attempt {job['attempts']}).")
+
+        if drain and not running:
+            break
+        time.sleep(poll)
+
+
+if __name__ == "__main__":
+    if 'snakemake' in globals():
+        configure_logging(snakemake)
+        dconfig = snakemake.config['dispatch']
+        queue = JobQueue(dconfig['queue'])
+        submit_matrix(queue, dconfig)
+        while True:
+            status = queue.status()
+            counts = status.state.value_counts()
+            logger.info(f"Jobs: {counts.to_dict()}")
+            if not counts.reindex(['pending', 'running'], fill_value=0).any():
+                break
+            time.sleep(dconfig.get('poll', 10.))
+        status.to_csv(snakemake.output[0])
+    else:
+        parser = argparse.ArgumentParser(description="Distribute scenario jobs over several hosts.")
+        parser.add_argument('command', choices=['submit', 'work', 'status'])
+        parser.add_argument('--config', default='configs/config-baseline.yaml',
+                            help="configuration with the `dispatch` settings")
+        parser.add_argument('--cores', type=int, default=os.cpu_count())
+        parser.add_argument('--memory', type=int, default=64000, help="memory budget [MB]")
+        parser.add_argument('--node', default=None)
+        parser.add_argument('--drain', action='store_true',
+                            help="stop once no job is left for this worker")
+        parser.add_argument('--retry-failed', action='store_true')
+        args = parser.parse_args()
+
+        logging.basicConfig(level=logging.INFO)
+        dconfig = read_config(args.config)['dispatch']
+        queue = JobQueue(dconfig['queue'])
+        if args.command == 'submit':
+            submit_matrix(queue, dconfig, args.retry_failed)
+        elif args.command == 'work':
+            work(queue, dconfig['store'], args.cores, args.memory, dconfig.get('lease', 600.),
+                 dconfig.get('poll', 10.), args.node, args.drain)
+        else:
+            status = queue.status()
+            print(status.state.value_counts().to_string())
+            failed = status.query("state == 'failed'")
+            if not failed.empty:
+                print(failed[['network', 'tech_costs', 'opts', 'error']].to_string())
@@ -0,0 +1,238 @@
+# SPDX-FileCopyrightText: : 2017-2020 The PyPSA-Eur Authors
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Screens storage technologies, energy-to-power ratios and cost assumptions by
+the arbitrage revenue a single price-taking storage unit earns against a
+fixed electricity price series.
+
+Relevant Settings
+-----------------
+
+.. code:: yaml
+
+    costs:
+        year:
+        USD2013_to_EUR2013:
+        discountrate:
+        marginal_cost:
+        capital_cost:
+
+    electricity:
+        max_hours:
+
+    screening:
+        carriers:
+        max_hours:
+        soc_resolution:
+        threshold:
+
+.. seealso::
+    Documentation of the configuration file ``config.yaml`` at :ref:`costs_cf`,
+    :ref:`electricity_cf`
+
+Inputs
+------
+
+- ``results/networks/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}.nc``: solved network whose load-weighted average of nodal prices is screened against
+- ``tech_costs``: list of cost databases of the kind of ``data/costs.csv``, one per cost scenario (e.g. extended by ``cost-data/costs-{optimistic,realistic,pessimistic}.csv``)
+
+Outputs
+-------
+
+- ``results/screening/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}.csv``: annual arbitrage revenue, annualised capital cost and screening result per cost scenario, carrier and ``max_hours``
+
+Description
+-----------
+
+For every distinct technical configuration (``max_hours``, charging and
+discharging efficiency, marginal cost) the revenue-maximising dispatch of a
+storage unit of 1 MW is found by dynamic programming over the year on a
+discretised state of charge, with ``soc_resolution`` levels per snapshot of
+charging at full power. All configurations with the same ``max_hours`` are
+solved together as one NumPy array, so no linear problem is built. The
+revenue is then compared with the annualised capital cost of every cost
+scenario, computed as in :func:`add_electricity.load_costs` and
+:func:`add_extra_components.attach_storageunits`.
+
+The screen is optimistic: the unit is a price-taker, standing losses are
+neglected, prices are not lowered by the storage itself and the discretised
+energy capacity and discharging power are rounded up. Candidates whose
+revenue falls short of ``threshold`` times their capital cost can therefore
+be dropped before running :mod:`solve_network`. The unit starts and ends the
+year empty, which slightly understates revenue for long-duration storage.
+"""
+
+import logging
+from _helpers import configure_logging
+
+import time
+import numpy as np
+import pandas as pd
+
+import pypsa
+
+from pathlib import Path
+from add_electricity import load_costs
+
+logger = logging.getLogger(__name__)
+
+# cost database rows of energy capacity and power units per storage carrier,
+# as combined in add_electricity.load_costs
+storage_rows = {
+    'battery': ('battery storage', ['battery inverter']),
+    'H2': ('hydrogen storage', ['fuel cell', 'electrolysis']),
+    'CAES': ('CAES Storage', ['CAES Compressor', 'CAES Turbine']),
+    'LAES': ('LAES Energy', ['LAES Power']),
+    'ETES': ('ETES Energy', ['ETES Power']),
+    'NaS': ('NaS Energy', ['NaS Inverter']),
+    'FeFlow': ('FeFlow Energy', ['FeFlow Inverter']),
+}
+
+# as in add_extra_components.attach_storageunits
+lookup_store = {"H2": "electrolysis", "battery": "battery inverter", "CAES": "CAES Compressor",
+                "LAES": "LAES Power", "ETES": "ETES Power", "NaS": "NaS Inverter",
+                "FeFlow": "FeFlow Inverter"}
+lookup_dispatch = {"H2": "fuel cell", "battery": "battery inverter", "CAES": "CAES Turbine",
+                   "LAES": "LAES Power", "ETES": "ETES Power", "NaS": "NaS Inverter",
+                   "FeFlow": "FeFlow Inverter"}
+
+
+def average_price(n):
+    """Load-weighted average of the nodal prices of the AC buses of a solved network."""
+    buses = n.buses.index[n.buses.carrier == 'AC']
+    load = (n.loads_t.p_set.groupby(n.loads.bus, axis=1).sum()
+            .reindex(columns=buses, fill_value=0.))
+    prices = n.buses_t.marginal_price[buses]
+    return (prices * load).sum(axis=1) / load.sum(axis=1)
+
+
+def technical_parameters(costs, carriers):
+    return pd.DataFrame({'efficiency_store': [costs.at[lookup_store[c], 'efficiency'] for c in carriers],
+                         'efficiency_dispatch': [costs.at[lookup_dispatch[c], 'efficiency'] for c in carriers],
+                         'marginal_cost': [costs.at[c, 'marginal_cost'] for c in carriers]},
+                        index=pd.Index(carriers, name='carrier'))
+
+
+def capital_costs(costs, carriers, max_hours):
+    """Annualised capital cost per MW of power capacity for each carrier and ``max_hours``."""
+    energy = costs.loc[[storage_rows[c][0] for c in carriers], 'capital_cost'].values
+    power = np.array([costs.loc[storage_rows[c][1], 'capital_cost'].sum() for c in carriers])
+    return pd.DataFrame(power[:, None] + energy[:, None] * np.asarray(max_hours)[None, :],
+                        index=pd.Index(carriers, name='carrier'),
+                        columns=pd.Index(max_hours, name='max_hours')).stack()
+
+
+def arbitrage_revenue(prices, hours, max_hours, efficiency_store, efficiency_dispatch,
+                      marginal_cost=0., soc_resolution=4):
+    """
+    Maximal arbitrage revenue of storage units with 1 MW of charging and
+    discharging power and ``max_hours`` MWh of energy capacity against the
+    price series ``prices`` of snapshots of length ``hours``.
+
+    The storage parameters may be arrays; all units are solved together by
+    backward dynamic programming over the states of charge
+    ``0, step, ..., max_hours``, where ``step`` is the energy stored in one
+    snapshot of charging at full power divided by ``soc_resolution``. Limits
+    which are no whole number of steps are rounded up, so the revenue does not
+    fall below that of the continuous problem as the resolution is refined.
+    """
+    max_hours, efficiency_store, efficiency_dispatch, marginal_cost = (
+        np.atleast_1d(a).astype(float) for a in
+        np.broadcast_arrays(max_hours, efficiency_store, efficiency_dispatch, marginal_cost))
+    prices = np.asarray(prices, dtype=float)
+
+    # charging at full power moves exactly `soc_resolution` levels; the energy
+    # capacity and discharging power are rounded up to whole numbers of levels,
+    # so that the revenue stays an upper bound
+    step = efficiency_store * hours / soc_resolution
+    nlevels = np.ceil(max_hours / step - 1e-9).astype(int) + 1
+    up = np.full(len(step), soc_resolution)
+    down = np.ceil(hours / efficiency_dispatch / step - 1e-9).astype(int)
+
+    # energy (MWh) moved into the store by a change of j levels, its value per
+    # unit price and the marginal cost of the dispatched energy
+    shifts = np.arange(-down.max(), up.max() + 1)
+    energy = shifts[None, :] * step[:, None]
+    gain = np.where(energy > 0, -energy / efficiency_store[:, None],
+                    -energy * efficiency_dispatch[:, None])
+    cost = np.where(energy < 0, marginal_cost[:, None] * gain, 0.)
+    cost[(shifts[None, :] > up[:, None]) | (-shifts[None, :] > down[:, None])] = np.inf
+
+    levels = nlevels.max()
+    valid = np.arange(levels)[None, :] < nlevels[:, None]
+    lo, hi = down.max(), up.max()
+    value = np.full((len(max_hours), lo + levels + hi), -np.inf)
+    # end of the year: storage empty
+    value[:, lo] = 0.
+
+    for price in prices[::-1]:
+        current = value[:, lo:lo + levels]
+        best = np.full_like(current, -np.inf)
+        for k, j in enumerate(shifts):
+            np.maximum(best, value[:, lo + j:lo + j + levels]
+                       + (price * gain[:, k] - cost[:, k])[:, None], out=best)
+        value[:, lo:lo + levels] = np.where(valid, best, -np.inf)
+
+    # start of the year: storage empty
+    return value[:, lo]
+
+
+def screen_storage(prices, hours, costs, carriers, max_hours, soc_resolution=4, threshold=1.):
+    """
+    Screen all combinations of cost scenarios (dictionary of cost frames as
+    from :func:`add_electricity.load_costs`), ``carriers`` and ``max_hours``.
+    """
+    scale = 8760. / (len(prices) * hours)
+
+    technical = pd.concat({s: technical_parameters(c, carriers) for s, c in costs.items()},
+                          names=['scenario'])
+    configs = (technical.reset_index()
+               .merge(pd.DataFrame({'max_hours': max_hours}), how='cross'))
+    attrs = ['max_hours', 'efficiency_store', 'efficiency_dispatch', 'marginal_cost']
+    unique = configs[attrs].drop_duplicates().reset_index(drop=True)
+    logger.info(f"Screening {len(configs)} candidates with {len(unique)} distinct "
+                f"technical configurations against {len(prices)} prices.")
+
+    revenue = pd.Series(np.nan, unique.index)
+    for mh, group in unique.groupby('max_hours'):
+        start = time.time()
+        revenue[group.index] = scale * arbitrage_revenue(
+            prices, hours, group.max_hours.values, group.efficiency_store.values,
+            group.efficiency_dispatch.values, group.marginal_cost.values, soc_resolution)
+        logger.info(f"Solved {len(group)} configurations with max_hours={mh} "
+                    f"in {time.time() - start:.1f}s.")
+    configs = configs.merge(unique.assign(revenue=revenue), on=attrs)
+
+    capital_cost = pd.concat({s: capital_costs(c, carriers, max_hours) for s, c in costs.items()},
+                             names=['scenario']).rename('capital_cost')
+    configs = configs.join(capital_cost, on=['scenario', 'carrier', 'max_hours'])
+    configs['ratio'] = configs.revenue / configs.capital_cost
+    configs['promising'] = configs.ratio >= threshold
+    return configs.set_index(['scenario', 'carrier', 'max_hours']).sort_index()
+
+
+if __name__ == "__main__":
+    if 'snakemake' not in globals():
+        from _helpers import mock_snakemake
+        snakemake = mock_snakemake('screen_storage', network='elec', simpl='',
+                                  clusters='20', ll='copt', opts='Co2L-1H')
+    configure_logging(snakemake)
+
+    config = snakemake.config['screening']
+
+    n = pypsa.Network(snakemake.input.network)
+    prices = average_price(n)
+    hours = n.snapshot_weightings.generators
+    if hours.nunique() > 1:
+        logger.warning("Snapshots are not equally weighted; screening with their average length.")
+    hours = hours.mean()
+
+    costs = {Path(fn).stem: load_costs(fn, snakemake.config['costs'], snakemake.config['electricity'])
+             for fn in snakemake.input.tech_costs}
+
+    results = screen_storage(prices.values, hours, costs, config['carriers'], config['max_hours'],
+                             config.get('soc_resolution', 4), config.get('threshold', 1.))
+    logger.info(f"{results.promising.sum()} of {len(results)} candidates are promising.")
+    results.to_csv(snakemake.output[0])
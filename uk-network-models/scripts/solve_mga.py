@@ -0,0 +1,245 @@
+# SPDX-FileCopyrightText: : 2017-2020 The PyPSA-Eur Authors
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Explores the near-optimal space of storage portfolios by modelling to generate
+alternatives (MGA).
+
+Relevant Settings
+-----------------
+
+.. code:: yaml
+
+    solving:
+        tmpdir:
+        options:
+        solver:
+            name:
+        mga:
+            slack:
+            carriers:
+            workers:
+
+.. seealso::
+    Documentation of the configuration file ``config.yaml`` at
+    :ref:`solving_cf`
+
+Inputs
+------
+
+- ``networks/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}.nc``: confer :ref:`prepare`
+
+Outputs
+-------
+
+- ``results/networks/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}.nc``: cost-optimal solution, as from :mod:`solve_network`
+- ``results/mga/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}_ranges.csv``: optimal, minimal and maximal energy capacity per storage carrier
+- ``results/mga/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}_portfolios.csv``: energy capacities of all storage carriers in each alternative
+
+Description
+-----------
+
+The network is first solved to optimality with :func:`solve_network.solve_network`.
+The total system cost of the optimum is then allowed to rise by a relative
+``slack`` (e.g. 5%), and for each storage carrier in ``carriers`` its energy
+capacity is minimised and maximised within this budget. The ``2 * len(carriers)``
+alternatives are solved in parallel worker processes, each warm-started from
+the basis of the optimal solution. To store a basis, crossover is switched on
+for the optimal solve, and with gurobi the alternatives are solved by primal
+simplex, since barrier does not use the basis.
+
+Storage units contribute ``p_nom * max_hours`` and stores ``e_nom`` to the
+energy capacity of a carrier.
+"""
+
+import logging
+from _helpers import configure_logging
+
+import os
+import pandas as pd
+
+import pypsa
+from pypsa.linopf import (get_var, define_constraints, linexpr, join_exprs,
+                          write_objective, network_lopf)
+from pypsa.descriptors import (get_switchable_as_dense as get_as_dense,
+                               get_extendable_i, nominal_attrs)
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from pathlib import Path
+from tempfile import mkstemp
+from solve_network import (prepare_network, solve_network, extra_functionality,
+                           storage_capacities, marginal_attrs, apply_solver_profile)
+
+logger = logging.getLogger(__name__)
+
+# dispatch outputs belonging to the variables in `marginal_attrs`
+dispatch_attrs = {'Generator': 'p', 'Link': 'p0', 'Store': 'p',
+                  'StorageUnit': 'p_dispatch'}
+
+
+def system_cost(n):
+    """Capital costs of extendable assets plus operational costs of a solved network."""
+    cost = 0.
+    for c, attr in nominal_attrs.items():
+        ext_i = get_extendable_i(n, c)
+        cost += n.df(c).loc[ext_i, 'capital_cost'] @ n.df(c).loc[ext_i, attr + '_opt']
+    weightings = n.snapshot_weightings.objective
+    for c, attr in dispatch_attrs.items():
+        if n.df(c).empty: continue
+        dispatch = n.pnl(c)[attr]
+        marginal_cost = get_as_dense(n, c, 'marginal_cost')[dispatch.columns]
+        cost += (marginal_cost * dispatch).sum(axis=1) @ weightings
+    return cost
+
+
+def define_mga_constraint(n, snapshots, budget):
+    """Bound the total system cost, as in the objective of the optimum, by ``budget``."""
+    lhs = []
+    weightings = n.snapshot_weightings.objective[snapshots]
+    for c, attr in marginal_attrs.items():
+        if n.df(c).empty: continue
+        cost = (get_as_dense(n, c, 'marginal_cost', snapshots)
+                .loc[:, lambda df: (df != 0).any()]
+                .mul(weightings, axis=0))
+        if cost.empty: continue
+        lhs.append(join_exprs(linexpr((cost, get_var(n, c, attr).loc[snapshots, cost.columns]))))
+    for c, attr in nominal_attrs.items():
+        cost = n.df(c).capital_cost[get_extendable_i(n, c)]
+        cost = cost[cost != 0]
+        if cost.empty: continue
+        lhs.append(join_exprs(linexpr((cost, get_var(n, c, attr)[cost.index]))))
+    define_constraints(n, ''.join(lhs), '<=', budget, 'GlobalConstraint', 'mu_mga')
+
+
+def define_mga_objective(n, carrier, sense):
+    """Minimise (``sense=1``) or maximise (``sense=-1``) the energy capacity of ``carrier``."""
+    terms = []
+    units = n.storage_units.query('carrier == @carrier and p_nom_extendable')
+    if not units.empty:
+        terms.append(linexpr((sense * units.max_hours,
+                              get_var(n, 'StorageUnit', 'p_nom')[units.index])))
+    stores = n.stores.query('carrier == @carrier and e_nom_extendable')
+    if not stores.empty:
+        terms.append(linexpr((sense, get_var(n, 'Store', 'e_nom')[stores.index])))
+    if not terms:
+        raise ValueError(f"No extendable storage of carrier '{carrier}' found.")
+    write_objective(n, join_exprs(pd.concat(terms)))
+
+
+_mga = {}
+
+
+def _init_mga_worker(fn, config, opts, budget, solver_options, kwargs):
+    n = pypsa.Network(fn)
+    n.config = config
+    n.opts = opts
+    _mga.update(network=n, budget=budget, solver_options=solver_options,
+                kwargs=kwargs)
+
+
+def _solve_alternative(carrier, sense):
+    n = _mga['network']
+    solver_options = _mga['solver_options'].copy()
+    solver_name = solver_options.pop('name')
+
+    def mga_functionality(n, snapshots):
+        extra_functionality(n, snapshots)
+        define_mga_constraint(n, snapshots, _mga['budget'])
+        define_mga_objective(n, carrier, sense)
+
+    status, condition = network_lopf(n, solver_name=solver_name,
+                                     solver_options=solver_options,
+                                     extra_functionality=mga_functionality,
+                                     skip_objective=True, **_mga['kwargs'])
+    if status != 'ok':
+        logger.warning(f"Alternative {'min' if sense > 0 else 'max'} {carrier} "
+                       f"ended with '{condition}'.")
+        return None
+    return storage_capacities(n)
+
+
+def solve_mga(n, config, opts, carriers, slack, workers=None, **kwargs):
+    """
+    Minimise and maximise the storage energy capacity of each of ``carriers``
+    in parallel, while total system costs stay within ``1 + slack`` of the
+    cost-optimal solution ``n``, which must have been solved with
+    ``store_basis=True``.
+
+    Returns the capacity ranges per carrier and the storage portfolios of all
+    alternatives.
+    """
+    budget = (1 + slack) * system_cost(n)
+    optimum = storage_capacities(n)
+    missing = pd.Index(carriers).difference(optimum.index)
+    if not missing.empty:
+        logger.warning(f"Skipping storage carriers without extendable assets: {', '.join(missing)}.")
+        carriers = [c for c in carriers if c not in missing]
+    logger.info(f"Searching near-optimal storage portfolios within a total "
+                f"system cost of {budget:.6e} ({slack:.1%} slack).")
+
+    solver_options = config['solving']['solver']
+    basis_fn = getattr(n, 'basis_fn', None)
+    if basis_fn is None:
+        logger.warning("No basis of the optimal solution stored; alternatives are solved cold.")
+    else:
+        kwargs['warmstart'] = basis_fn
+        # barrier ignores the basis; only the objective changes and the budget
+        # is slack at the optimum, so the basis stays primal feasible
+        if solver_options['name'] == 'gurobi':
+            solver_options = dict(solver_options, method=0)
+
+    fd, fn = mkstemp(suffix='.nc', prefix='pypsa-mga-', dir=kwargs.get('solver_dir'))
+    os.close(fd)
+    n.export_to_netcdf(fn)
+
+    jobs = list(product(carriers, ['min', 'max']))
+    senses = {'min': 1, 'max': -1}
+    initargs = (fn, config, opts, budget, solver_options, kwargs)
+    with ProcessPoolExecutor(workers, initializer=_init_mga_worker,
+                             initargs=initargs) as pool:
+        results = pool.map(_solve_alternative, [c for c, _ in jobs],
+                           [senses[s] for _, s in jobs])
+        portfolios = pd.DataFrame({job: result for job, result in zip(jobs, results)
+                                   if result is not None}).T
+    os.remove(fn)
+
+    portfolios.index.names = ['carrier', 'sense']
+    ranges = (pd.Series({job: portfolios.at[job, job[0]] for job in portfolios.index})
+              .rename_axis(['carrier', 'sense']).unstack('sense')
+              .reindex(index=carriers, columns=['min', 'max']))
+    ranges.insert(0, 'optimum', optimum.reindex(carriers))
+    return ranges, portfolios
+
+
+if __name__ == "__main__":
+    if 'snakemake' not in globals():
+        from _helpers import mock_snakemake
+        snakemake = mock_snakemake('solve_mga', network='elec', simpl='',
+                                  clusters='20', ll='copt', opts='Co2L-1H')
+    configure_logging(snakemake)
+    apply_solver_profile(snakemake.config)
+
+    tmpdir = snakemake.config['solving'].get('tmpdir')
+    if tmpdir is not None:
+        Path(tmpdir).mkdir(parents=True, exist_ok=True)
+    opts = snakemake.wildcards.opts.split('-')
+    solve_opts = snakemake.config['solving']['options']
+    mga_config = snakemake.config['solving']['mga']
+
+    config = snakemake.config.copy()
+    config['solving'] = dict(config['solving'],
+                             solver=dict(config['solving']['solver'], crossover=-1))
+
+    n = pypsa.Network(snakemake.input[0])
+    n = prepare_network(n, solve_opts)
+    n = solve_network(n, config, opts, solver_dir=tmpdir, store_basis=True,
+                      solver_logfile=snakemake.log.solver)
+    n.export_to_netcdf(snakemake.output.network)
+
+    ranges, portfolios = solve_mga(n, config, opts, mga_config['carriers'],
+                                   mga_config['slack'], mga_config.get('workers'),
+                                   solver_dir=tmpdir)
+    ranges.to_csv(snakemake.output.ranges)
+    portfolios.to_csv(snakemake.output.portfolios)
@@ -16,14 +16,55 @@ Relevant Settings
             formulation:
             clip_p_max_pu:
             load_shedding:
+            lazy_shedding:
+                marginal_cost:
+                window:
+                max_rounds:
             noisy_costs:
             nhours:
+            segments:
             min_iterations:
             max_iterations:
             skip_iterations:
             track_iterations:
+            lp_build:
+                workers:
+                blocks:
+            decomposition:
+                enable:
+                blocks:
+                workers:
+                max_iterations:
+                tolerance:
+            hierarchical:
+                enable:
+                clusters:
+                threshold:
+                margin:
+                check_gap:
+            temporal:
+                enable:
+                resolution:
+                segments:
+                margin:
+                atol:
+                widen:
+                max_rounds:
+                warmstart:
+                check_gap:
+            warmstart:
+                enable:
+                network:
+                method:
+                compare:
+            scaling:
+                enable:
+                passes:
+                compare:
         solver:
             name:
+        solver_profile:
+        solver_profiles:
 
 .. seealso::
     Documentation of the configuration file ``config.yaml`` at
@@ -33,6 +74,8 @@ Inputs
 ------
 
 - ``networks/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}.nc``: confer :ref:`prepare`
+- ``weather_years`` (optional): list of networks of the above kind prepared for different weather years, which are solved together with shared investment variables
+- ``warmstart`` (optional): solved network of a related scenario (e.g. with other cost assumptions) to start from; overrides ``solving: options: warmstart: network``
 
 Outputs
 -------
@@ -42,6 +85,9 @@ Outputs
     .. image:: ../img/results.png
         :scale: 40 %
 
+- ``results/arrow/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}/`` (optional): dispatch, state of charge and prices as Feather files for dashboards, confer :func:`export_to_arrow`
+- ``results/metrics/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}.json`` (optional): time spent reading, preparing, solving and exporting, maximum memory usage and the solver metrics parsed from the gurobi log, confer :mod:`summarize_solver_logs`
+
 Description
 -----------
 
@@ -52,6 +98,102 @@ is provided in the
 The optimization is based on the ``pyomo=False`` setting in the :func:`network.lopf` and  :func:`pypsa.linopf.ilopf` function.
 Additionally, some extra constraints specified in :mod:`prepare_network` are added.
 
+With ``solving: options: load_shedding: lazy`` load shedding is only added
+where it is needed (:func:`solve_network_lazy_shedding`). The network is
+first solved without it as usual; only if the problem is infeasible, gurobi
+computes an irreducible infeasible subsystem, and load shedding generators
+are added only at the AC buses of its constraints and available only within
+``lazy_shedding: window`` snapshots around them. This is repeated until the
+problem is feasible, so that the many feasible runs do not carry a load
+shedding variable per bus and snapshot.
+
+With ``solving: options: lp_build: workers`` above one, the linear problem is
+built in parallel (:func:`prepare_lopf_parallel`): after all variables and
+the objective are defined, the constraints are built per component type and
+constraint group in forked worker processes, and groups which only couple
+variables of the same snapshot (dispatch limits, nodal balances, Kirchhoff's
+voltage law) are further split into ``blocks`` blocks of snapshots. Each group
+writes its own part of the LP file from its own range of labels, and the parts
+are merged in a fixed order. The builder is passed explicitly
+(:func:`lp_builder`) to the solves of :func:`solve_network`, which use
+:func:`network_lopf_with` and :func:`ilopf_with` in place of their pypsa
+counterparts; the master and subproblems of the Benders decomposition are
+built serially. The speedup against the serial build is logged, and is
+measured for several worker counts by :mod:`benchmark_stages`.
+
+With ``solving: options: segments`` the snapshots are merged into this many
+consecutive segments of variable length (:func:`segment_snapshots`):
+neighbouring snapshots with similar load, renewable availability and inflow
+are merged first, so calm periods are represented by few long segments and
+volatile ones by many short segments. Unlike typical periods, the full
+chronology is kept, which long-duration storage depends on.
+
+If several networks are passed as input ``weather_years``, they are stacked
+into one network whose investment periods are the weather years
+(:func:`stack_weather_years`). Capacities are then optimised jointly for all
+years, while dispatch and cyclic storage are resolved per year.
+
+With ``solving: options: decomposition: enable: true`` the problem is instead
+solved by a Benders decomposition (:func:`solve_network_benders`): a master
+problem chooses generator, storage power and energy capacities, and
+operational subproblems over blocks of snapshots (or weather years) are solved
+in parallel worker processes and return cuts to the master problem.
+
+With ``solving: options: hierarchical: enable: true`` the network is solved
+from coarse to fine spatial resolution (:func:`solve_network_hierarchical`).
+For each number of ``clusters`` the buses are clustered by load-weighted
+k-means, storage is aggregated per cluster and carrier, and the coarse network
+is solved. Storage candidates of carriers built below ``threshold`` in their
+cluster are then removed from the fine network, and the capacities of the
+remaining ones are bounded by ``margin`` times the capacity of their cluster.
+Run times per level are logged (and added to the output ``metrics``), a
+warning is given if a bound binds, and with ``check_gap: true`` the full
+network is solved as well to report the optimality gap.
+
+With ``solving: options: temporal: enable: true`` the network is solved
+from coarse to full temporal resolution (:func:`solve_network_temporal`). A
+copy averaged over ``resolution`` hours (or merged into ``segments``
+segments) is solved first. The capacities of all extendable assets are then
+bounded to within ``margin`` (relative, plus ``atol`` upwards) of the coarse
+capacities, and the full network is solved from the coarse dispatch
+(``warmstart: true``, with gurobi). Bounds which bind are widened by
+``widen`` and the full network is solved again; after ``max_rounds`` rounds
+binding bounds are released instead. As no tightened bound binds in the
+final solution, it is also optimal without them. The stages and their run
+times are logged (and added to the output ``metrics``), and with
+``check_gap: true`` the full network is solved directly as well to report
+the time saved and the objective difference.
+
+With ``solving: options: warmstart: enable: true`` the problem is solved by
+gurobi from a starting point (:func:`solve_network_gurobi`), either the
+solution of a related solved network (input ``warmstart`` or ``solving:
+options: warmstart: network``) or a greedy merit-order dispatch with daily
+storage arbitrage (:func:`greedy_dispatch`). The start is mapped onto the
+variables of the new problem by component name and snapshot, and passed as
+primal start vector. As barrier ignores start vectors, ``warmstart: method``
+selects the LP algorithm used instead (e.g. 0 for primal simplex). The
+iterations and run time are logged, and with ``warmstart: compare: true``
+also the reduction against a solve without start.
+
+If the rule has an output ``arrow``, the generator dispatch, link flows,
+store energy levels, storage unit states of charge and nodal prices are also
+written as uncompressed Feather files by :func:`export_to_arrow`. These can be
+memory-mapped by dashboards (:func:`read_arrow`) without decoding the netCDF
+file or copying the columns.
+
+With ``solving: options: scaling: enable: true`` the problem is solved by
+gurobi after rescaling its rows and columns (:func:`scale_gurobi_model`), since
+coefficients span many orders of magnitude (e.g. cavern energy limits, load
+shedding in kW, annualised capital costs). Scale factors are computed by
+``passes`` rounds of geometric-mean scaling and rounded to powers of two; the
+solution and duals are unscaled before they are assigned to the network. With
+``scaling: compare: true`` the unscaled problem is solved as well and the
+barrier iterations of both are logged.
+
+The solver settings are overridden by the profile of the model family
+``solving: solver_profile`` in the file ``solving: solver_profiles`` if it
+exists, as tuned by :mod:`tune_solver` (:func:`apply_solver_profile`).
+
 Solving the network in multiple iterations is motivated through the dependence of transmission line capacities and impedances.
 As lines are expanded their electrical parameters change, which renders the optimisation bilinear even if the power flow
 equations are linearized.
@@ -79,21 +221,210 @@ Details (and errors made through this heuristic) are discussed in the paper
 import logging
 from _helpers import configure_logging
 
+import os
+import heapq
+import json
+import time
 import numpy as np
 import pandas as pd
 import re
+import shutil
+import yaml
 
 import pypsa
-from pypsa.linopf import (get_var, define_constraints, define_variables,
-                          linexpr, join_exprs, network_lopf, ilopf)
-from pypsa.descriptors import get_switchable_as_dense as get_as_dense
-
+import pypsa.linopf as linopf
+import pypsa.linopt as linopt
+from pypsa.linopf import (get_var, get_con, define_constraints, define_variables,
+                          linexpr, join_exprs, write_objective, network_lopf, ilopf,
+                          prepare_lopf, assign_solution)
+from pypsa.descriptors import (get_switchable_as_dense as get_as_dense,
+                               get_extendable_i, nominal_attrs, Dict)
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import repeat
+from multiprocessing import get_context
 from pathlib import Path
+from tempfile import mkstemp
 from vresutils.benchmark import memory_logger
 
 logger = logging.getLogger(__name__)
 
 
+def segment_boundaries(features, weights, nsegments, breaks=None):
+    """
+    Greedily merge adjacent snapshots into ``nsegments`` segments, always
+    merging the pair of neighbouring segments with the smallest increase of
+    the weighted within-segment variance of ``features`` (Ward's criterion).
+    Segments never extend over the positions marked in ``breaks``. Returns
+    the positions at which segments start.
+    """
+    T = len(features)
+    breaks = np.zeros(T, dtype=bool) if breaks is None else np.asarray(breaks)
+    sums = features * weights[:, None]
+    weights = weights.astype(float).copy()
+    nxt, prv = np.arange(1, T + 1), np.arange(-1, T - 1)
+    alive = np.ones(T, dtype=bool)
+    version = np.zeros(T, dtype=int)
+
+    def cost(a, b):
+        diff = sums[a] / weights[a] - sums[b] / weights[b]
+        return weights[a] * weights[b] / (weights[a] + weights[b]) * diff @ diff
+
+    heap = [(cost(a, a + 1), a, a + 1, 0, 0) for a in range(T - 1) if not breaks[a + 1]]
+    heapq.heapify(heap)
+    count = T
+    while count > nsegments and heap:
+        _, a, b, va, vb = heapq.heappop(heap)
+        if not (alive[a] and alive[b]) or version[a] != va or version[b] != vb:
+            continue
+        sums[a] += sums[b]
+        weights[a] += weights[b]
+        alive[b] = False
+        nxt[a] = nxt[b]
+        if nxt[a] < T: prv[nxt[a]] = a
+        version[a] += 1
+        count -= 1
+        if prv[a] >= 0 and not breaks[a]:
+            heapq.heappush(heap, (cost(prv[a], a), prv[a], a, version[prv[a]], version[a]))
+        if nxt[a] < T and not breaks[nxt[a]]:
+            heapq.heappush(heap, (cost(a, nxt[a]), a, nxt[a], version[a], version[nxt[a]]))
+    return np.flatnonzero(alive)
+
+
+def segment_snapshots(n, nsegments):
+    """
+    Replace the snapshots of ``n`` by ``nsegments`` consecutive segments of
+    variable length, merging snapshots with similar load and renewable
+    availability. Time series are averaged over each segment and the
+    snapshot weightings summed, so that the chronology is kept and storage
+    balances (which scale with ``snapshot_weightings.stores``) stay exact.
+    Segments do not extend over investment periods.
+    """
+    sns = n.snapshots
+    load = get_as_dense(n, 'Load', 'p_set').groupby(n.loads.bus, axis=1).sum()
+    features = [load, n.generators_t.p_max_pu, n.storage_units_t.inflow]
+    features = pd.concat([df / df.abs().max().replace(0., 1.) for df in features
+                          if not df.empty], axis=1).fillna(0.)
+
+    if isinstance(sns, pd.MultiIndex):
+        periods = sns.get_level_values('period')
+        breaks = np.r_[False, periods[1:] != periods[:-1]]
+    else:
+        breaks = None
+    weights = n.snapshot_weightings.generators.values
+    starts = segment_boundaries(features.values, weights, nsegments, breaks)
+    n = aggregate_snapshots(n, starts)
+
+    lengths = n.snapshot_weightings.generators
+    logger.info(f"Segmented {len(sns)} snapshots into {len(n.snapshots)} segments of "
+                f"{lengths.min():.0f} to {lengths.max():.0f} hours.")
+    return n
+
+
+def aggregate_snapshots(n, starts):
+    """
+    Merge the snapshots of ``n`` into consecutive segments beginning at the
+    positions ``starts``. Time series are averaged over each segment and the
+    snapshot weightings summed; each segment keeps its first snapshot.
+    """
+    sns = n.snapshots
+    weights = n.snapshot_weightings.generators.values
+    segment = np.zeros(len(sns), dtype=int)
+    segment[starts[1:]] = 1
+    segment = segment.cumsum()
+    new_sns = sns[starts]
+
+    def aggregate(df):
+        weighted = df.mul(weights, axis=0).groupby(segment).sum()
+        return weighted.div(pd.Series(weights).groupby(segment).sum().values, axis=0) \
+                       .set_axis(new_sns)
+
+    series = {(c.name, attr): aggregate(df) for c in n.iterate_components()
+              for attr, df in c.pnl.items() if not df.empty}
+    snapshot_weightings = n.snapshot_weightings.groupby(segment).sum().set_axis(new_sns)
+
+    n.set_snapshots(new_sns)
+    n.snapshot_weightings = snapshot_weightings
+    for (c, attr), df in series.items():
+        n.pnl(c)[attr] = df
+    return n
+
+
+def resample_snapshots(n, hours):
+    """
+    Average every ``hours`` consecutive snapshots of ``n`` into one (e.g. 3
+    for a 3-hourly resolution), restarting at every investment period.
+    """
+    sns = n.snapshots
+    if isinstance(sns, pd.MultiIndex):
+        position = pd.Series(1, sns).groupby(level='period').cumsum().values - 1
+    else:
+        position = np.arange(len(sns))
+    n = aggregate_snapshots(n, np.flatnonzero(position % hours == 0))
+    logger.info(f"Resampled {len(sns)} snapshots to {len(n.snapshots)} snapshots of "
+                f"{hours} hours.")
+    return n
+
+
+def add_load_shedding(n, marginal_cost=1e2, p_max_pu=None):
+    """
+    Add load shedding generators at the AC buses, or only at the columns of
+    ``p_max_pu`` (buses by snapshots) and limited to its values. Existing load
+    shedding generators are extended to the union of both availabilities.
+    """
+    if 'load' not in n.carriers.index:
+        n.add("Carrier", "load", color="#dd2e23", nice_name="Load shedding")
+    buses_i = n.buses.query("carrier == 'AC'").index if p_max_pu is None else p_max_pu.columns
+    names = buses_i + " load"
+    new = ~names.isin(n.generators.index)
+    # intersect between macroeconomic and surveybased
+    # willingness to pay
+    # http://journal.frontiersin.org/article/10.3389/fenrg.2015.00055/full)
+    n.madd("Generator", buses_i[new], " load",
+           bus=buses_i[new],
+           carrier='load',
+           sign=1e-3, # Adjust sign to measure p and p_nom in kW instead of MW
+           marginal_cost=marginal_cost,
+           p_nom=1e9 # kW
+           )
+    if p_max_pu is not None:
+        p_max_pu = p_max_pu.astype(float).rename(columns=lambda b: b + " load")
+        old = names[~new]
+        p_max_pu[old] = np.maximum(p_max_pu[old],
+                                   get_as_dense(n, 'Generator', 'p_max_pu', p_max_pu.index)[old])
+        n.generators_t.p_max_pu = pd.concat([n.generators_t.p_max_pu.drop(columns=p_max_pu.columns,
+                                                                          errors='ignore'),
+                                             p_max_pu], axis=1)
+
+
+def merge_parameters(solver_options, parameters):
+    """Override ``solver_options`` by ``parameters``; gurobi parameter names are case-insensitive."""
+    overridden = {key.lower() for key in parameters}
+    options = {k: v for k, v in solver_options.items() if k.lower() not in overridden}
+    options.update(parameters)
+    return options
+
+
+def apply_solver_profile(config):
+    """
+    Merge the solver profile of the model family ``solving: solver_profile``
+    from the file ``solving: solver_profiles`` (as written by
+    :mod:`tune_solver`) into the solver settings of ``config``.
+    """
+    cf_solving = config['solving']
+    family, fn = cf_solving.get('solver_profile'), cf_solving.get('solver_profiles')
+    if not family or not fn or not os.path.exists(fn):
+        return config
+    with open(fn) as f:
+        profile = (yaml.safe_load(f) or {}).get(family)
+    if profile is None:
+        return config
+    cf_solving['solver'] = merge_parameters(cf_solving['solver'], profile['solver'])
+    logger.info(f"Using solver profile '{family}': {profile['solver']}.")
+    return config
+
+
 def prepare_network(n, solve_opts):
 
     if 'clip_p_max_pu' in solve_opts:
@@ -101,20 +432,9 @@ def prepare_network(n, solve_opts):
             df.where(df>solve_opts['clip_p_max_pu'], other=0., inplace=True)
 
     load_shedding = solve_opts.get('load_shedding')
-    if load_shedding:
-        n.add("Carrier", "load", color="#dd2e23", nice_name="Load shedding")
-        buses_i = n.buses.query("carrier == 'AC'").index
+    if load_shedding and load_shedding != 'lazy':
         if not np.isscalar(load_shedding): load_shedding = 1e2 # Eur/kWh
-        # intersect between macroeconomic and surveybased
-        # willingness to pay
-        # http://journal.frontiersin.org/article/10.3389/fenrg.2015.00055/full)
-        n.madd("Generator", buses_i, " load",
-               bus=buses_i,
-               carrier='load',
-               sign=1e-3, # Adjust sign to measure p and p_nom in kW instead of MW
-               marginal_cost=load_shedding, 
-               p_nom=1e9 # kW
-               )
+        add_load_shedding(n, load_shedding)
 
     if solve_opts.get('noisy_costs'):
         for t in n.iterate_components(n.one_port_components):
@@ -133,6 +453,58 @@ def prepare_network(n, solve_opts):
         n.set_snapshots(n.snapshots[:nhours])
         n.snapshot_weightings[:] = 8760. / nhours
 
+    if solve_opts.get('segments'):
+        n = segment_snapshots(n, solve_opts['segments'])
+
+    return n
+
+
+def stack_weather_years(fns):
+    """
+    Combine networks which only differ in their weather year into a single
+    network with one investment period per weather year.
+
+    Static data is taken from the first network. The other networks are read
+    one after another and only their time-varying data is kept, so that
+    besides the stacked time series at most two networks are held in memory.
+    Capacity variables are shared between all periods (assets are built in
+    year 0 and never retire), dispatch is per period and storage is cyclic
+    within each period. Periods are weighted equally, so that the objective
+    remains an average annual system cost.
+    """
+    n = None
+    series = {}
+    weightings = {}
+    for fn in fns:
+        m = pypsa.Network(fn)
+        year = m.snapshots[0].year
+        assert year not in weightings, f"Weather year {year} is given twice."
+        logger.info(f"Adding weather year {year} from {fn}.")
+        weightings[year] = m.snapshot_weightings
+        for c in m.iterate_components():
+            for attr, df in c.pnl.items():
+                if not df.empty:
+                    series.setdefault((c.name, attr), {})[year] = df
+        if n is None:
+            n = m
+        del m
+
+    years = pd.Index(list(weightings), name='period')
+    snapshots = pd.concat(weightings).index.rename(['period', 'timestep'])
+    n.set_snapshots(snapshots)
+    n.snapshot_weightings = pd.concat(weightings).set_axis(snapshots)
+    for (c, attr), dfs in series.items():
+        n.pnl(c)[attr] = pd.concat(dfs).set_axis(snapshots)
+
+    n.set_investment_periods(years)
+    n.investment_period_weightings['objective'] = 1. / len(years)
+    n.investment_period_weightings['years'] = 1.
+
+    # the CO2 limit is an annual budget, but global constraints sum over
+    # all snapshots of all periods
+    co2_i = n.global_constraints.query('type == "primary_energy"').index
+    n.global_constraints.loc[co2_i, 'constant'] *= len(years)
+
     return n
 
 
@@ -400,6 +772,1346 @@ def extra_functionality(n, snapshots):
     add_battery_constraints(n)
 
 
+# variables whose objective coefficient is the marginal cost of a component
+marginal_attrs = {'Generator': 'p', 'Link': 'p', 'Store': 'p',
+                  'StorageUnit': 'p_dispatch'}
+
+
+def storage_capacities(n):
+    """Optimised energy capacity [MWh] per storage carrier."""
+    units = n.storage_units.eval('p_nom_opt * max_hours')
+    return (units.groupby(n.storage_units.carrier).sum()
+            .add(n.stores.e_nom_opt.groupby(n.stores.carrier).sum(), fill_value=0.))
+
+
+# sections of an LP file in the order written by pypsa.linopf.prepare_lopf
+lp_sections = ['objective', 'constraints', 'bounds', 'binaries']
+
+# distance between the first labels of the groups of prepare_lopf_parallel
+label_stride = 10 ** 10
+
+
+def lp_groups(n, extra_functionality=None):
+    """
+    Constraint groups of the linear problem as ``(name, blocked, function)``,
+    where ``function(n, snapshots)`` writes the constraints and blocked groups
+    may be built for blocks of snapshots separately.
+    """
+    lookup = linopf.lookup
+    groups = []
+    for c, attr in lookup.query('nominal and not handle_separately').index:
+        groups.append((f'growth_limit:{c}', False,
+                       lambda n, sns, c=c, attr=attr: linopf.define_growth_limit(n, sns, c, attr)))
+    dispatch = lookup.query('not nominal and not handle_separately').index
+    for c in dispatch.unique('component'):
+        attrs = dispatch[dispatch.get_level_values('component') == c].get_level_values('variable')
+        groups.append((f'dispatch:{c}', True,
+                       lambda n, sns, c=c, attrs=attrs: [
+                           linopf.define_dispatch_for_extendable_constraints(n, sns, c, attr)
+                           for attr in attrs]))
+    groups += [
+        ('nominal_per_bus_carrier', False, linopf.define_nominal_constraints_per_bus_carrier),
+        ('fixed_state_of_charge', True, lambda n, sns: linopf.define_fixed_variable_constraints(
+            n, sns, 'StorageUnit', 'state_of_charge')),
+        ('fixed_energy', True, lambda n, sns: linopf.define_fixed_variable_constraints(
+            n, sns, 'Store', 'e')),
+        ('committable', False, linopf.define_committable_generator_constraints),
+        ('ramp_limit:Generator', False, partial(linopf.define_ramp_limit_constraints, c='Generator')),
+        ('ramp_limit:Link', False, partial(linopf.define_ramp_limit_constraints, c='Link')),
+        ('kirchhoff', True, linopf.define_kirchhoff_constraints),
+        ('nodal_balance', True, linopf.define_nodal_balance_constraints),
+        ('global', False, linopf.define_global_constraints),
+    ]
+    if extra_functionality is not None:
+        groups.append(('extra_functionality', False, extra_functionality))
+    return groups
+
+
+def open_lp_sections(n, solver_dir=None):
+    fns = {}
+    for section in lp_sections:
+        fd, fn = mkstemp('.txt', f'pypsa-{section}-', text=True, dir=solver_dir)
+        os.close(fd)
+        setattr(n, f'{section}_f', open(fn, mode='w'))
+        fns[section] = fn
+    return fns
+
+
+def close_lp_sections(n):
+    for section in lp_sections:
+        getattr(n, f'{section}_f').close()
+        delattr(n, f'{section}_f')
+
+
+_lp = {}
+
+
+def _init_lp_worker(n, snapshots, groups, solver_dir):
+    _lp.update(n=n, snapshots=snapshots, groups=groups, solver_dir=solver_dir,
+               vars=n.vars, variables=n.variables, constraints=n.constraints.iloc[:0])
+
+
+def _build_lp_group(i, block, offsets):
+    n = _lp['n']
+    base = _lp['vars']
+    # start every group from the references of the variables only, so that
+    # all constraint references it returns are its own
+    n.vars = Dict({c: Dict(df=ref.df.copy(), pnl=Dict(ref.pnl)) for c, ref in base.items()})
+    n.cons = Dict()
+    n.variables, n.constraints = _lp['variables'].copy(), _lp['constraints'].copy()
+    sns = _lp['snapshots']
+    if block is not None:
+        sns = sns[block[0]:block[1]]
+        for ref in n.vars.values():
+            for attr, df in ref.pnl.items():
+                ref.pnl[attr] = df.loc[sns]
+    n._xCounter, n._cCounter = offsets
+
+    start = time.time()
+    fns = open_lp_sections(n, _lp['solver_dir'])
+    _lp['groups'][i][2](n, sns)
+    close_lp_sections(n)
+
+    refs = {}
+    for kind, container in [('vars', n.vars), ('cons', n.cons)]:
+        for c, ref in container.items():
+            known = base[c] if kind == 'vars' and c in base else Dict(df=pd.DataFrame(), pnl=Dict())
+            for attr, df in ref.pnl.items():
+                if attr not in known.pnl:
+                    refs[kind, c, 'pnl', attr] = df
+            for attr in ref.df.columns.difference(known.df.columns):
+                refs[kind, c, 'df', attr] = ref.df[attr]
+    variables = n.variables.loc[n.variables.index.difference(_lp['variables'].index)]
+    return fns, variables, n.constraints, refs, time.time() - start
+
+
+def prepare_lopf_parallel(n, snapshots=None, keep_files=False, skip_objective=False,
+                          extra_functionality=None, solver_dir=None, workers=4, blocks=None):
+    """
+    Drop-in replacement of :func:`pypsa.linopf.prepare_lopf` which builds the
+    constraints in ``workers`` forked processes.
+
+    All variables (with the dispatch limits of fixed assets and the storage
+    constraints, which pypsa writes together with them) and the objective are
+    defined first. The constraint groups
+    of :func:`lp_groups` are then built in parallel, the groups which only
+    couple variables of the same snapshot separately for ``blocks`` blocks of
+    snapshots. Each group writes its own sections of the LP file and labels
+    its variables and constraints from its own range, so the groups never
+    share a label. The sections and references are merged in the order of the
+    groups, which makes the problem independent of the scheduling.
+    """
+    n._xCounter, n._cCounter = 1, 1
+    n.vars, n.cons = Dict(), Dict()
+    cols = ['component', 'name', 'pnl', 'specification']
+    n.variables = pd.DataFrame(columns=cols).set_index(cols[:2])
+    n.constraints = pd.DataFrame(columns=cols).set_index(cols[:2])
+    snapshots = n.snapshots if snapshots is None else snapshots
+    blocks = workers if blocks is None else blocks
+    start = time.time()
+
+    fdp, problem_fn = mkstemp('.lp', 'pypsa-problem-', text=True, dir=solver_dir)
+    fns = {section: [fn] for section, fn in open_lp_sections(n, solver_dir).items()}
+    n.objective_f.write("\\* LOPF *\n\nmin\nobj:\n")
+    n.constraints_f.write("\n\ns.t.\n\n")
+    n.bounds_f.write("\nbounds\n")
+    n.binaries_f.write("\nbinary\n")
+
+    lookup = linopf.lookup
+    for c, attr in lookup.query('nominal and not handle_separately').index:
+        linopf.define_nominal_for_extendable_variables(n, c, attr)
+    for c, attr in lookup.query('not nominal and not handle_separately').index:
+        linopf.define_dispatch_for_non_extendable_variables(n, snapshots, c, attr)
+        linopf.define_dispatch_for_extendable_and_committable_variables(n, snapshots, c, attr)
+        linopf.align_with_static_component(n, c, attr)
+    linopf.define_generator_status_variables(n, snapshots)
+    # these also define the state of charge and store variables
+    linopf.define_storage_unit_constraints(n, snapshots)
+    linopf.define_store_constraints(n, snapshots)
+    if not skip_objective:
+        linopf.define_objective(n, snapshots)
+    close_lp_sections(n)
+    serial = time.time() - start
+
+    groups = lp_groups(n, extra_functionality)
+    edges = np.linspace(0, len(snapshots), min(blocks, len(snapshots)) + 1).astype(int)
+    tasks = []
+    for i, (name, blocked, _) in enumerate(groups):
+        tasks += ([(i, block) for block in zip(edges[:-1], edges[1:])] if blocked else [(i, None)])
+    offsets = [(n._xCounter + (k + 1) * label_stride, n._cCounter + (k + 1) * label_stride)
+               for k in range(len(tasks))]
+
+    with ProcessPoolExecutor(workers, mp_context=get_context('fork'),
+                             initializer=_init_lp_worker,
+                             initargs=(n, snapshots, groups, solver_dir)) as pool:
+        results = list(pool.map(_build_lp_group, *zip(*tasks), offsets))
+
+    pieces, seconds = {}, 0.
+    for group_fns, _, _, refs, elapsed in results:
+        for section in lp_sections:
+            fns[section].append(group_fns[section])
+        for key, ref in refs.items():
+            pieces.setdefault(key, []).append(ref)
+        seconds += elapsed
+    n.variables = pd.concat([n.variables] + [r[1] for r in results])
+    n.variables = n.variables[~n.variables.index.duplicated()]
+    n.constraints = pd.concat([n.constraints] + [r[2] for r in results])
+    n.constraints = n.constraints[~n.constraints.index.duplicated()]
+    for (kind, c, part, attr), refs in pieces.items():
+        container = getattr(n, kind)
+        if c not in container:
+            container[c] = Dict(df=pd.DataFrame(), pnl=Dict())
+        ref = pd.concat(refs) if len(refs) > 1 else refs[0]
+        # e.g. dispatch limits of extendable next to those of fixed assets
+        if part == 'pnl' and attr in container[c].pnl:
+            container[c].pnl[attr] = pd.concat([container[c].pnl[attr], ref], axis=1)
+        elif part == 'pnl':
+            container[c].pnl[attr] = ref
+        elif attr in container[c].df:
+            container[c].df = pd.concat([container[c].df, ref.to_frame(attr)])
+        else:
+            container[c].df[attr] = ref
+    n._xCounter += (len(tasks) + 1) * label_stride
+    n._cCounter += (len(tasks) + 1) * label_stride
+
+    with open(problem_fn, 'wb') as wfd:
+        for section in lp_sections:
+            for fn in fns[section]:
+                with open(fn, 'rb') as fd:
+                    shutil.copyfileobj(fd, wfd)
+                if not keep_files:
+                    os.remove(fn)
+        wfd.write(b"end\n")
+
+    total = time.time() - start
+    logger.info(f"Built {len(tasks)} constraint groups with {workers} workers in "
+                f"{total:.1f}s ({serial:.1f}s serial, {seconds:.1f}s in groups, "
+                f"speedup {(serial + seconds) / total:.1f}).")
+    return fdp, problem_fn
+
+
+def lp_builder(config):
+    """
+    Builder of linear problems for ``solving: options: lp_build``: either
+    :func:`pypsa.linopf.prepare_lopf` or :func:`prepare_lopf_parallel`.
+    """
+    lp_build = config['solving']['options'].get('lp_build', {})
+    if lp_build.get('workers', 1) > 1:
+        return partial(prepare_lopf_parallel, workers=lp_build['workers'],
+                       blocks=lp_build.get('blocks'))
+    return prepare_lopf
+
+
+def network_lopf_with(build, n, snapshots=None, solver_name='cbc', solver_logfile=None,
+                      extra_functionality=None, multi_investment_periods=False,
+                      skip_objective=False, keep_files=False,
+                      keep_shadowprices=['Bus', 'Line', 'Transformer', 'Link', 'GlobalConstraint'],
+                      solver_options=None, warmstart=False, store_basis=False, solver_dir=None):
+    """
+    :func:`pypsa.linopf.network_lopf` with the linear problem written by
+    ``build`` (confer :func:`lp_builder`) instead of
+    :func:`pypsa.linopf.prepare_lopf`.
+    """
+    if build is prepare_lopf:
+        return network_lopf(n, snapshots, solver_name=solver_name, solver_logfile=solver_logfile,
+                            extra_functionality=extra_functionality,
+                            multi_investment_periods=multi_investment_periods,
+                            skip_objective=skip_objective, keep_files=keep_files,
+                            keep_shadowprices=keep_shadowprices, solver_options=solver_options,
+                            warmstart=warmstart, store_basis=store_basis, solver_dir=solver_dir)
+
+    snapshots = n.snapshots if snapshots is None else snapshots
+    n._multi_invest = int(multi_investment_periods)
+    n.calculate_dependent_values()
+    n.determine_network_topology()
+
+    fdp, problem_fn = build(n, snapshots, keep_files, skip_objective, extra_functionality,
+                            solver_dir)
+    fds, solution_fn = mkstemp(prefix='pypsa-solve', suffix='.sol', dir=solver_dir)
+    if warmstart is True:
+        warmstart = n.basis_fn
+    solve = getattr(linopt, f'run_and_read_{solver_name}')
+    status, condition, variables_sol, constraints_dual, obj = solve(
+        n, problem_fn, solution_fn, solver_logfile, solver_options or {}, warmstart, store_basis)
+    if not keep_files:
+        os.close(fdp)
+        os.remove(problem_fn)
+        os.close(fds)
+        os.remove(solution_fn)
+
+    if not (status == 'ok' and condition == 'optimal' or
+            status == 'warning' and condition == 'suboptimal'):
+        logger.warning(f"Optimization failed with status {status} and termination "
+                       f"condition {condition}")
+        return status, condition
+    n.objective = obj
+    assign_solution(n, snapshots, variables_sol, constraints_dual,
+                    keep_shadowprices=keep_shadowprices)
+    return status, condition
+
+
+def ilopf_with(build, n, snapshots=None, msq_threshold=0.05, min_iterations=1,
+               max_iterations=100, track_iterations=False, **kwargs):
+    """
+    :func:`pypsa.linopf.ilopf` with the linear problems written by ``build``
+    (confer :func:`network_lopf_with`).
+    """
+    if build is prepare_lopf:
+        return ilopf(n, snapshots, msq_threshold, min_iterations, max_iterations,
+                     track_iterations, **kwargs)
+
+    n.lines['carrier'] = n.lines.bus0.map(n.buses.carrier)
+    ext_i = get_extendable_i(n, 'Line')
+    typed_i = n.lines.query('type != ""').index
+    ext_untyped_i = ext_i.difference(typed_i)
+    ext_typed_i = ext_i.intersection(typed_i)
+    base_s_nom = (np.sqrt(3) * n.lines['type'].map(n.line_types.i_nom)
+                  * n.lines.bus0.map(n.buses.v_nom))
+    n.lines.loc[ext_typed_i, 'num_parallel'] = (n.lines.s_nom / base_s_nom)[ext_typed_i]
+    branches = pd.Series(nominal_attrs)[n.branch_components]
+
+    if track_iterations:
+        for c, attr in branches.items():
+            n.df(c)[f'{attr}_opt_0'] = n.df(c)[attr]
+    kwargs['store_basis'] = True
+    iteration, diff = 1, msq_threshold
+    while diff >= msq_threshold or iteration < min_iterations:
+        if iteration > max_iterations:
+            logger.info(f"Iteration {iteration} beyond max_iterations {max_iterations}. "
+                        "Stopping ...")
+            break
+        s_nom_prev = n.lines.s_nom_opt.copy() if iteration else n.lines.s_nom.copy()
+        kwargs['warmstart'] = 'basis_fn' in n.__dir__()
+        status, condition = network_lopf_with(build, n, snapshots, **kwargs)
+        assert status == 'ok', (f"Optimization failed with status {status}"
+                                f"and termination {condition}")
+        if track_iterations:
+            for c, attr in branches.items():
+                n.df(c)[f'{attr}_opt_{iteration}'] = n.df(c)[f'{attr}_opt']
+            setattr(n, f'status_{iteration}', status)
+            setattr(n, f'objective_{iteration}', n.objective)
+            n.iteration = iteration
+            n.global_constraints = n.global_constraints.rename(columns={'mu': f'mu_{iteration}'})
+        # update the impedances to the optimised capacities
+        factor = n.lines.s_nom_opt / s_nom_prev
+        for attr, carrier in (('x', 'AC'), ('r', 'DC')):
+            ln_i = n.lines.query('carrier == @carrier').index.intersection(ext_untyped_i)
+            n.lines.loc[ln_i, attr] /= factor[ln_i]
+        n.lines.loc[ext_typed_i, 'num_parallel'] = (n.lines.s_nom_opt / base_s_nom)[ext_typed_i]
+        diff = (np.sqrt((s_nom_prev - n.lines.s_nom_opt).pow(2).mean())
+                / n.lines['s_nom_opt'].mean())
+        logger.info(f"Mean square difference after iteration {iteration} is {diff}")
+        iteration += 1
+
+    logger.info("Running last lopf with fixed branches (HVDC links and HVAC lines)")
+    ext_dc_links_b = n.links.p_nom_extendable & (n.links.carrier == 'DC')
+    s_nom_orig = n.lines.s_nom.copy()
+    p_nom_orig = n.links.p_nom.copy()
+    n.lines.loc[ext_i, 's_nom'] = n.lines.loc[ext_i, 's_nom_opt']
+    n.lines.loc[ext_i, 's_nom_extendable'] = False
+    n.links.loc[ext_dc_links_b, 'p_nom'] = n.links.loc[ext_dc_links_b, 'p_nom_opt']
+    n.links.loc[ext_dc_links_b, 'p_nom_extendable'] = False
+    kwargs['warmstart'] = False
+    network_lopf_with(build, n, snapshots, **kwargs)
+    n.lines.loc[ext_i, 's_nom'] = s_nom_orig.loc[ext_i]
+    n.lines.loc[ext_i, 's_nom_extendable'] = True
+    n.links.loc[ext_dc_links_b, 'p_nom'] = p_nom_orig.loc[ext_dc_links_b]
+    n.links.loc[ext_dc_links_b, 'p_nom_extendable'] = True
+    # add costs of additional infrastructure to objective value of last iteration
+    obj_links = n.links[ext_dc_links_b].eval('capital_cost * (p_nom_opt - p_nom_min)').sum()
+    obj_lines = n.lines.eval('capital_cost * (s_nom_opt - s_nom_min)').sum()
+    n.objective += obj_links + obj_lines
+    n.objective_constant -= obj_links + obj_lines
+
+
+def prepare_problem(n, snapshots=None, solver_dir=None,
+                    extra_functionality=extra_functionality, build=prepare_lopf):
+    """
+    Write the linear problem of ``n`` to an LP file with ``build`` (confer
+    :func:`lp_builder`) as :func:`pypsa.linopf.network_lopf` does, but keep
+    the references to variables and constraints on the network so that the
+    problem can be modified and its solutions assigned repeatedly.
+    """
+    snapshots = n.snapshots if snapshots is None else snapshots
+    n.calculate_dependent_values()
+    n.determine_network_topology()
+    n._multi_invest = int(isinstance(n.snapshots, pd.MultiIndex))
+    fdp, problem_fn = build(n, snapshots, extra_functionality=extra_functionality,
+                            solver_dir=solver_dir)
+    os.close(fdp)
+    return problem_fn
+
+
+def read_gurobi_problem(problem_fn, solver_options, solver_logfile=None):
+    try:
+        import gurobipy
+    except ModuleNotFoundError:
+        raise ModuleNotFoundError("Optional dependency 'gurobipy' not found. "
+                                  "Install via 'conda install -c gurobi gurobi'.")
+    m = gurobipy.read(problem_fn)
+    if solver_logfile is not None:
+        m.setParam('logfile', solver_logfile)
+    for key, value in solver_options.items():
+        m.setParam(key, value)
+    return m
+
+
+def gurobi_variables(m):
+    """Gurobi variables indexed by their pypsa label (variables are named ``x<label>``)."""
+    variables = m.getVars()
+    labels = [int(name[1:]) for name in m.getAttr('VarName', variables)]
+    return pd.Series(variables, index=labels)
+
+
+def assign_gurobi_solution(n, m, snapshots=None,
+                           keep_shadowprices=['Bus', 'Line', 'Transformer',
+                                              'Link', 'GlobalConstraint']):
+    """Assign the solution of the gurobi model ``m`` built by :func:`prepare_problem` to ``n``."""
+    snapshots = n.snapshots if snapshots is None else snapshots
+    variables, constraints = m.getVars(), m.getConstrs()
+    variables_sol = pd.Series(m.getAttr('X', variables),
+                              index=[int(v[1:]) for v in m.getAttr('VarName', variables)])
+    constraints_dual = pd.Series(m.getAttr('Pi', constraints),
+                                 index=[int(c[1:]) for c in m.getAttr('ConstrName', constraints)])
+    n.objective = m.ObjVal
+    assign_solution(n, snapshots, variables_sol, constraints_dual,
+                    keep_references=True, keep_shadowprices=keep_shadowprices)
+
+
+def greedy_dispatch(n):
+    """
+    Starting point for :func:`solve_network_gurobi` from a merit-order
+    dispatch of the generators on a copper plate, with storage units shifting
+    energy from the hours of lowest to those of highest residual load of
+    each day. Extendable generators start at ``p_nom_min``; unserved load is
+    met by the cheapest extendable generator, whose capacity is raised
+    accordingly.
+    """
+    sns = n.snapshots
+    load = get_as_dense(n, 'Load', 'p_set', sns).sum(axis=1)
+
+    gens = n.generators
+    p_nom = gens.p_nom.where(~gens.p_nom_extendable, gens.p_nom_min).astype(float)
+    p_max_pu = get_as_dense(n, 'Generator', 'p_max_pu', sns)
+
+    # storage units with fixed capacity shave the daily residual load peaks
+    su = n.storage_units.query('p_nom > 0 or p_nom_min > 0')
+    su_p_nom = su.p_nom.where(~su.p_nom_extendable, su.p_nom_min)
+    p_store = pd.DataFrame(0., sns, su.index)
+    p_dispatch = pd.DataFrame(0., sns, su.index)
+    renewable = (p_max_pu * p_nom)[gens.index[gens.marginal_cost == 0.]].sum(axis=1)
+    residual = load - renewable
+    days = sns.get_level_values('timestep').date if isinstance(sns, pd.MultiIndex) else sns.date
+    for s in su.index:
+        if su_p_nom[s] == 0: continue
+        eff_store, eff_dispatch = su.at[s, 'efficiency_store'], su.at[s, 'efficiency_dispatch']
+        for day in residual.groupby(days):
+            hours = min(int(su.at[s, 'max_hours']), len(day[1]) // 2)
+            if hours == 0: continue
+            ranked = day[1].sort_values()
+            charge = min(su_p_nom[s], su_p_nom[s] / (eff_store * eff_dispatch))
+            p_store.loc[ranked.index[:hours], s] = charge
+            p_dispatch.loc[ranked.index[-hours:], s] = charge * eff_store * eff_dispatch
+        residual = residual - p_dispatch[s] + p_store[s]
+    weightings = n.snapshot_weightings.stores[sns]
+    soc = (p_store.mul(su.efficiency_store) - p_dispatch.div(su.efficiency_dispatch)).mul(weightings, axis=0)
+    # each day is a closed cycle, starting at its lowest state of charge
+    soc = soc.groupby(days).cumsum()
+    soc = soc - soc.groupby(days).transform('min')
+
+    demand = load + p_store.sum(axis=1) - p_dispatch.sum(axis=1)
+    p = pd.DataFrame(0., sns, gens.index)
+    for g in gens.marginal_cost.sort_values().index:
+        p[g] = np.minimum(p_max_pu[g] * p_nom[g], demand.clip(lower=0.))
+        demand = demand - p[g]
+    ext_i = gens.index[gens.p_nom_extendable]
+    if (demand > 1e-3).any() and not ext_i.empty:
+        g = gens.loc[ext_i, 'marginal_cost'].idxmin()
+        p[g] += demand.clip(lower=0.)
+        p_nom[g] = max(p_nom[g], (p[g] / p_max_pu[g].clip(lower=1e-3)).max())
+
+    return {('Generator', 'p'): p, ('Generator', 'p_nom'): p_nom,
+            ('StorageUnit', 'p_store'): p_store, ('StorageUnit', 'p_dispatch'): p_dispatch,
+            ('StorageUnit', 'state_of_charge'): soc,
+            ('StorageUnit', 'p_nom'): n.storage_units.p_nom.where(
+                ~n.storage_units.p_nom_extendable, n.storage_units.p_nom_min)}
+
+
+def network_solution(m):
+    """Starting point for :func:`solve_network_gurobi` from the solved network ``m``."""
+    values = {}
+    for c in nominal_attrs:
+        attr = nominal_attrs[c]
+        if attr + '_opt' in m.df(c):
+            values[(c, attr)] = m.df(c)[attr + '_opt']
+        for attr, df in m.pnl(c).items():
+            if not df.empty:
+                values[(c, attr)] = df
+        # flows of branches are assigned to p0
+        if 'p0' in m.pnl(c) and not m.pnl(c)['p0'].empty:
+            values[(c, 's' if c in ['Line', 'Transformer'] else 'p')] = m.pnl(c)['p0']
+    return values
+
+
+def start_vector(n, values):
+    """
+    Map the starting point ``values``, a dictionary of (component, variable)
+    to series or frames of values, onto the variables of the problem built by
+    :func:`prepare_problem`. Snapshots missing in ``values`` are filled
+    forward (e.g. from a coarser temporal resolution); variables without a
+    value are left out, so that the solver treats them as undefined.
+    """
+    start = []
+    for (c, attr), pnl in n.variables.pnl.items():
+        if (c, attr) not in values: continue
+        labels = get_var(n, c, attr)
+        value = values[(c, attr)]
+        if pnl:
+            value = value.reindex(columns=labels.columns)
+            if isinstance(value.index, pd.MultiIndex) != isinstance(labels.index, pd.MultiIndex):
+                continue
+            value = value.reindex(labels.index.union(value.index)).ffill().reindex(labels.index)
+        else:
+            value = value.reindex(labels.index)
+        start.append(pd.Series(value.values.ravel(), labels.values.ravel()))
+    start = pd.concat(start) if start else pd.Series(dtype=float)
+    return start[start.index != -1].dropna()
+
+
+def scale_gurobi_model(m, solver_options, passes=4):
+    """
+    Copy of the gurobi model ``m`` with rows and columns scaled by powers of
+    two, computed by ``passes`` alternating passes of geometric-mean scaling
+    (each row and column is divided by the square root of the product of its
+    largest and smallest absolute coefficient). With ``x = col * y`` the
+    scaled model reads ``min (col c)^T y`` subject to ``(row A col) y ~ row b``
+    and ``lb / col <= y <= ub / col``. Returns the scaled model and the row
+    and column scale factors.
+    """
+    import gurobipy
+    import scipy.sparse as sp
+
+    A = m.getA().tocsr()
+    absA = abs(A)
+    absA.eliminate_zeros()
+    row, col = np.ones(A.shape[0]), np.ones(A.shape[1])
+
+    def factors(S, axis):
+        largest = S.max(axis=axis).toarray().ravel()
+        inverse = S.copy()
+        inverse.data = 1. / inverse.data
+        smallest = 1. / np.maximum(inverse.max(axis=axis).toarray().ravel(), 1e-300)
+        f = np.ones_like(largest)
+        nz = largest > 0
+        f[nz] = 1. / np.sqrt(largest[nz] * smallest[nz])
+        return f
+
+    for _ in range(passes):
+        row *= factors(sp.diags(row) @ absA @ sp.diags(col), 1)
+        col *= factors(sp.diags(row) @ absA @ sp.diags(col), 0)
+    # powers of two scale without rounding errors
+    row, col = 2. ** np.round(np.log2(row)), 2. ** np.round(np.log2(col))
+
+    variables, constraints = m.getVars(), m.getConstrs()
+    lb = np.array(m.getAttr('LB', variables))
+    ub = np.array(m.getAttr('UB', variables))
+    obj = np.array(m.getAttr('Obj', variables))
+    rhs = np.array(m.getAttr('RHS', constraints))
+    sense = np.array(m.getAttr('Sense', constraints))
+
+    scaled = gurobipy.Model()
+    for key, value in solver_options.items():
+        scaled.setParam(key, value)
+    y = scaled.addMVar(A.shape[1], lb=lb / col, ub=ub / col, obj=obj * col)
+    scaled.addMConstr(sp.diags(row) @ A @ sp.diags(col), y, sense, rhs * row)
+    scaled.ModelSense = m.ModelSense
+    scaled.ObjCon = m.ObjCon
+    scaled.update()
+
+    ratio = lambda M: abs(M).data.max() / abs(M).data.min() if M.nnz else 1.
+    logger.info(f"Scaled coefficient range from {ratio(A):.1e} to "
+                f"{ratio(scaled.getA()):.1e}.")
+    return scaled, row, col
+
+
+def assign_scaled_solution(n, m, scaled, row, col, snapshots=None,
+                           keep_shadowprices=['Bus', 'Line', 'Transformer',
+                                              'Link', 'GlobalConstraint']):
+    """Unscale the solution of ``scaled`` and assign it to ``n`` with the labels of ``m``."""
+    snapshots = n.snapshots if snapshots is None else snapshots
+    labels = [int(v[1:]) for v in m.getAttr('VarName', m.getVars())]
+    variables_sol = pd.Series(col * np.array(scaled.getAttr('X', scaled.getVars())),
+                              index=labels)
+    labels = [int(c[1:]) for c in m.getAttr('ConstrName', m.getConstrs())]
+    constraints_dual = pd.Series(row * np.array(scaled.getAttr('Pi', scaled.getConstrs())),
+                                 index=labels)
+    n.objective = scaled.ObjVal
+    assign_solution(n, snapshots, variables_sol, constraints_dual,
+                    keep_references=True, keep_shadowprices=keep_shadowprices)
+
+
+def solve_network_gurobi(n, config, opts='', start=None, solver_dir=None,
+                         solver_logfile=None):
+    """
+    Solve ``n`` with gurobi directly, optionally from the starting point
+    ``start`` (as returned by :func:`network_solution` or
+    :func:`greedy_dispatch`) and with the model scaled by
+    :func:`scale_gurobi_model` (``solving: options: scaling: enable``), and
+    report the iterations and run time. With ``compare: true`` under
+    ``warmstart`` or ``scaling`` the problem is also solved without start and
+    scaling, and the difference is reported.
+    """
+    solver_options = config['solving']['solver'].copy()
+    solver_options.pop('name')
+    ws_config = config['solving']['options'].get('warmstart', {})
+    scaling = config['solving']['options'].get('scaling', {})
+
+    n.config = config
+    n.opts = opts
+
+    problem_fn = prepare_problem(n, solver_dir=solver_dir, build=lp_builder(config))
+    m = read_gurobi_problem(problem_fn, solver_options, solver_logfile)
+    os.remove(problem_fn)
+
+    # the reference is solved with the configured method
+    stats = {}
+    if (start is not None and ws_config.get('compare', False)) or \
+            (scaling.get('enable', False) and scaling.get('compare', False)):
+        reference = m.copy()
+        reference.optimize()
+        stats['reference'] = {'runtime': reference.Runtime,
+                              'simplex_iterations': reference.IterCount,
+                              'barrier_iterations': reference.BarIterCount}
+
+    # barrier does not use start vectors
+    if start is not None and 'method' in ws_config:
+        m.setParam('Method', ws_config['method'])
+
+    model, row, col = m, None, None
+    if scaling.get('enable', False):
+        options = dict(solver_options, **({'Method': ws_config['method']}
+                                          if start is not None and 'method' in ws_config else {}))
+        if solver_logfile is not None:
+            options['LogFile'] = solver_logfile
+        model, row, col = scale_gurobi_model(m, options, scaling.get('passes', 4))
+
+    if start is not None:
+        variables = gurobi_variables(m)
+        start = start_vector(n, start).reindex(variables.index)
+        values = start.values if col is None else start.values / col
+        # variables without a value keep their undefined start
+        defined = ~np.isnan(values)
+        model.setAttr('PStart', [v for v, d in zip(model.getVars(), defined) if d],
+                      values[defined].tolist())
+
+    model.optimize()
+    stats['solve'] = {'runtime': model.Runtime, 'simplex_iterations': model.IterCount,
+                      'barrier_iterations': model.BarIterCount}
+    if model.Status != 2:  # GRB.OPTIMAL
+        raise RuntimeError(f"Solve ended with gurobi status {model.Status}.")
+    if col is None:
+        assign_gurobi_solution(n, m)
+    else:
+        assign_scaled_solution(n, m, model, row, col)
+
+    solve = stats['solve']
+    features = [f for f, on in [('warm start', start is not None),
+                                ('scaling', col is not None)] if on]
+    message = (f"Solve{' with ' + ' and '.join(features) if features else ''} took "
+               f"{solve['simplex_iterations']:.0f} simplex and "
+               f"{solve['barrier_iterations']:.0f} barrier iterations in {solve['runtime']:.1f}s")
+    if 'reference' in stats:
+        ref = stats['reference']
+        message += (f", compared to {ref['simplex_iterations']:.0f} simplex and "
+                    f"{ref['barrier_iterations']:.0f} barrier iterations in {ref['runtime']:.1f}s "
+                    f"without ({1 - solve['runtime'] / max(ref['runtime'], 1e-9):.0%} less time)")
+    logger.info(message + ".")
+    n.solver_stats = stats
+    return n
+
+
+def time_blocks(n, nblocks):
+    """
+    Split the snapshots into ``nblocks`` contiguous blocks. Networks with
+    investment periods (e.g. stacked weather years) are split by period.
+    """
+    if isinstance(n.snapshots, pd.MultiIndex):
+        return [n.snapshots[n.snapshots.get_level_values('period') == p]
+                for p in n.investment_periods]
+    return [n.snapshots[i] for i in
+            np.array_split(np.arange(len(n.snapshots)), nblocks)]
+
+
+def _copy_for_snapshots(n, snapshots):
+    if isinstance(snapshots, pd.MultiIndex):
+        m = n.copy(snapshots=snapshots,
+                   investment_periods=snapshots.unique('period'))
+    else:
+        m = n.copy(snapshots=snapshots)
+    m.config = n.config
+    m.opts = n.opts
+    return m
+
+
+def add_benders_cuts(n, cuts, nblocks, budgets=None):
+    """
+    Add one operational cost estimate ``theta`` per time block to the
+    objective of the master problem and bound them from below by the
+    optimality cuts collected so far. The limits of the global constraints
+    ``budgets`` (of type ``primary_energy``) are split into one budget per
+    block, which the master problem chooses alongside the capacities.
+    """
+    theta = define_variables(n, 0, np.inf, 'Benders', 'theta',
+                             axes=[pd.RangeIndex(nblocks)])
+    write_objective(n, linexpr((1, theta)))
+
+    budget = None
+    if budgets is not None and not budgets.empty:
+        index = pd.MultiIndex.from_product([range(nblocks), budgets.index])
+        budget = define_variables(n, 0, np.inf, 'BendersBudget', 'value', axes=[index])
+        for name, glc in budgets.iterrows():
+            lhs = join_exprs(linexpr((1, budget.xs(name, level=1))))
+            define_constraints(n, lhs, glc.sense, glc.constant, 'BendersBudget', 'limit',
+                               axes=pd.Index([name]), spec=name)
+
+    for k, (block, value, duals, capacities, budget_duals, block_budgets) in enumerate(cuts):
+        lhs = linexpr((1, theta[[block]])).iloc[0]
+        rhs = value
+        for c, dual in duals.items():
+            dual = dual[dual != 0]
+            if dual.empty: continue
+            var = get_var(n, c, nominal_attrs[c])[dual.index]
+            lhs += join_exprs(linexpr((-dual, var)))
+            rhs -= dual @ capacities[c][dual.index]
+        dual = budget_duals[budget_duals != 0]
+        if budget is not None and not dual.empty:
+            lhs += join_exprs(linexpr((-dual, budget.loc[block][dual.index])))
+            rhs -= dual @ block_budgets[dual.index]
+        define_constraints(n, lhs, '>=', rhs, 'Benders', f'cut{k}')
+
+
+_benders = {}
+
+
+def _init_benders_worker(fn, config, opts, solver_name, solver_options, kwargs):
+    n = pypsa.Network(fn)
+    n.config = config
+    n.opts = opts
+    # capacities are fixed by equality constraints whose duals make the cuts
+    for c, attr in nominal_attrs.items():
+        ext_i = get_extendable_i(n, c)
+        n.df(c).loc[ext_i, 'capital_cost'] = 0.
+        n.df(c).loc[ext_i, attr + '_min'] = 0.
+        n.df(c).loc[ext_i, attr + '_max'] = np.inf
+    _benders.update(network=n, solver_name=solver_name,
+                    solver_options=solver_options, kwargs=kwargs)
+
+
+def _solve_benders_block(snapshots, capacities, budgets, return_dispatch=False):
+    n = _copy_for_snapshots(_benders['network'], snapshots)
+    n.global_constraints.loc[budgets.index, 'constant'] = budgets
+
+    def fix_capacities(n, snapshots):
+        extra_functionality(n, snapshots)
+        for c, x in capacities.items():
+            lhs = linexpr((1, get_var(n, c, nominal_attrs[c])[x.index]))
+            define_constraints(n, lhs, '=', x, c, 'benders_fix')
+
+    def collect_duals(n, snapshots, duals):
+        n.benders_duals = {c: get_con(n, c, 'benders_fix').map(duals)
+                           for c in capacities}
+        # limits without emitting carriers have no constraint
+        glcs = (get_con(n, 'GlobalConstraint', 'mu') if budgets.size
+                else pd.Series(dtype=float))
+        n.benders_budget_duals = glcs.reindex(budgets.index).map(duals).fillna(0.)
+
+    status, condition = network_lopf(n, solver_name=_benders['solver_name'],
+                                     solver_options=_benders['solver_options'],
+                                     extra_functionality=fix_capacities,
+                                     extra_postprocessing=collect_duals,
+                                     keep_references=True,
+                                     **_benders['kwargs'])
+    if status != 'ok':
+        raise RuntimeError(f"Benders subproblem for snapshots {snapshots[0]} to "
+                           f"{snapshots[-1]} ended with '{condition}'. Enable "
+                           "`solving: options: load_shedding` to guarantee "
+                           "feasible subproblems.")
+
+    dispatch = {}
+    if return_dispatch:
+        for c in n.iterate_components():
+            output = c.attrs.index[c.attrs.varying &
+                                   c.attrs.status.str.startswith('Output')]
+            for attr in output:
+                if not c.pnl[attr].empty:
+                    dispatch[c.name, attr] = c.pnl[attr]
+    return n.objective, n.benders_duals, n.benders_budget_duals, dispatch
+
+
+def solve_network_benders(n, config, opts='', solver_logfile=None, **kwargs):
+    """
+    Solve the capacity expansion problem with a Benders decomposition.
+
+    The master problem holds all capacity variables, their capital costs and
+    the constraints of :func:`extra_functionality`, plus one zero-weighted
+    peak-load snapshot per block as a cheap adequacy requirement. The
+    operational subproblems fix the capacities, are split into time blocks
+    (each with cyclic storage) and are solved in parallel worker processes,
+    which only build the LP of their own block. The duals of the fixed
+    capacities yield one optimality cut per block and iteration. Iterations
+    stop once the relative gap between the lowest total cost found so far and
+    the master objective is below ``tolerance``.
+
+    Global constraints of type ``primary_energy`` (e.g. the CO2 limit) are
+    split into one budget per block by the master problem; the subproblems
+    are limited to their budget, whose dual enters the cuts as well.
+
+    As storage is cyclic within each block, energy cannot be shifted between
+    blocks (e.g. seasonally), which would under-build long-duration storage.
+    Cyclic storage is therefore only accepted with a single block or if the
+    blocks are investment periods (which are cyclic in the full problem as
+    well); otherwise a ValueError is raised.
+
+    Subproblems have to be feasible for any capacities chosen by the master,
+    which is guaranteed by load shedding. Transmission impedances are not
+    updated between iterations, as they are in :func:`pypsa.linopf.ilopf`.
+    """
+    solver_options = config['solving']['solver'].copy()
+    solver_name = solver_options.pop('name')
+    cf_solving = config['solving']['options']
+    cf_decomp = cf_solving['decomposition']
+    tolerance = cf_decomp.get('tolerance', 1e-3)
+    max_iterations = cf_decomp.get('max_iterations', 50)
+
+    if not cf_solving.get('load_shedding'):
+        logger.warning("Benders decomposition without load shedding may "
+                       "produce infeasible subproblems.")
+
+    if isinstance(n.snapshots, pd.MultiIndex):
+        kwargs.setdefault('multi_investment_periods', True)
+
+    blocks = time_blocks(n, cf_decomp.get('blocks', 12))
+    workers = min(cf_decomp.get('workers', os.cpu_count()), len(blocks))
+    cyclic = (n.storage_units.cyclic_state_of_charge.any() or n.stores.e_cyclic.any())
+    if len(blocks) > 1 and cyclic and not isinstance(n.snapshots, pd.MultiIndex):
+        raise ValueError(f"Storage is cyclic, but would be cyclic within each of the "
+                         f"{len(blocks)} time blocks of the Benders decomposition, so that no "
+                         f"energy is shifted between blocks. Set `decomposition: blocks: 1` "
+                         f"or decompose by weather years instead.")
+
+    n.config = config
+    n.opts = opts
+
+    load = get_as_dense(n, 'Load', 'p_set').sum(axis=1)
+    peaks = [load.index.get_loc(load[b].idxmax()) for b in blocks]
+    master = _copy_for_snapshots(n, n.snapshots[peaks])
+    master.snapshot_weightings.loc[:, :] = 0.
+    for c, attr in nominal_attrs.items():
+        master.df(c).loc[get_extendable_i(master, c), attr] = 0.
+    # split between the blocks by add_benders_cuts instead
+    budgets = n.global_constraints.query('type == "primary_energy"')
+    master.mremove('GlobalConstraint', budgets.index)
+
+    cuts = []
+    best_cost, best, best_budgets = np.inf, None, None
+
+    def master_constraints(m, snapshots):
+        extra_functionality(m, snapshots)
+        add_benders_cuts(m, cuts, len(blocks), budgets)
+
+    fd, fn = mkstemp(suffix='.nc', prefix='pypsa-benders-', dir=kwargs.get('solver_dir'))
+    os.close(fd)
+    n.export_to_netcdf(fn)
+    initargs = (fn, config, opts, solver_name, solver_options, kwargs)
+
+    with ProcessPoolExecutor(workers, initializer=_init_benders_worker,
+                             initargs=initargs) as pool:
+        for iteration in range(max_iterations):
+            status, condition = network_lopf(master, solver_name=solver_name,
+                                             solver_options=solver_options,
+                                             extra_functionality=master_constraints,
+                                             solver_logfile=solver_logfile,
+                                             **kwargs)
+            assert status == 'ok', f"Benders master problem ended with '{condition}'."
+            lower = master.objective
+
+            capacities = {}
+            capex = 0.
+            for c, attr in nominal_attrs.items():
+                ext_i = get_extendable_i(master, c)
+                if ext_i.empty: continue
+                capacities[c] = master.df(c).loc[ext_i, attr + '_opt']
+                capex += master.df(c).loc[ext_i, 'capital_cost'] @ capacities[c]
+            if budgets.empty:
+                block_budgets = pd.DataFrame(index=range(len(blocks)), columns=budgets.index,
+                                             dtype=float)
+            else:
+                block_budgets = master.sols.BendersBudget.df.value.unstack()
+
+            results = pool.map(_solve_benders_block, blocks, repeat(capacities),
+                               [block_budgets.loc[b] for b in range(len(blocks))])
+            upper = capex
+            for block, (value, duals, budget_duals, _) in enumerate(results):
+                upper += value
+                cuts.append((block, value, duals, capacities, budget_duals,
+                             block_budgets.loc[block]))
+            if upper < best_cost:
+                best_cost, best, best_budgets = upper, capacities, block_budgets
+
+            gap = (best_cost - lower) / abs(best_cost)
+            logger.info(f"Benders iteration {iteration}: lower bound {lower:.6e}, "
+                        f"upper bound {best_cost:.6e}, gap {gap:.2%}.")
+            if gap <= tolerance:
+                break
+        else:
+            logger.warning(f"Benders decomposition stopped after {max_iterations} "
+                           f"iterations with a gap of {gap:.2%}.")
+
+        results = pool.map(_solve_benders_block, blocks, repeat(best),
+                           [best_budgets.loc[b] for b in range(len(blocks))], repeat(True))
+        dispatch = {}
+        for _, _, _, block_dispatch in results:
+            for key, df in block_dispatch.items():
+                dispatch.setdefault(key, []).append(df)
+
+    os.remove(fn)
+
+    for c, attr in nominal_attrs.items():
+        n.df(c)[attr + '_opt'] = n.df(c)[attr]
+        if c in best:
+            n.df(c).loc[best[c].index, attr + '_opt'] = best[c]
+    for (c, attr), dfs in dispatch.items():
+        n.pnl(c)[attr] = pd.concat(dfs).reindex(n.snapshots)
+    n.objective = best_cost
+
+    return n
+
+
+def ac_busmap(n):
+    """Map every bus to its AC bus; storage buses are named ``<AC bus> <carrier>``."""
+    busmap = n.buses.index.to_series()
+    other = n.buses.query('carrier != "AC"')
+    base = pd.Series([b[:-len(c) - 1] if b.endswith(' ' + c) else b
+                      for b, c in zip(other.index, other.carrier)], other.index)
+    busmap[other.index] = base.where(base.isin(n.buses.index), other.index)
+    return busmap
+
+
+def cluster_coarse(n, nclusters):
+    """
+    Cluster the AC buses of ``n`` into ``nclusters`` by load-weighted k-means
+    and aggregate storage units and stores per cluster and carrier. Returns
+    the coarse network and the cluster of every AC bus.
+    """
+    from pypsa.networkclustering import (busmap_by_kmeans, get_clustering_from_busmap,
+                                         _make_consense)
+
+    ac_i = n.buses.index[n.buses.carrier == 'AC']
+    load = (get_as_dense(n, 'Load', 'p_set').mean().groupby(n.loads.bus).sum()
+            .reindex(ac_i, fill_value=0.))
+    weighting = (load / load.max() * 100).clip(lower=1).astype(int)
+    clusters = busmap_by_kmeans(n, weighting, nclusters, buses_i=ac_i, n_init=10)
+
+    to_ac = ac_busmap(n)
+    carrier = n.buses.carrier
+    busmap = to_ac.map(clusters).where(carrier == 'AC',
+                                       to_ac.map(clusters) + ' ' + carrier)
+
+    clustering = get_clustering_from_busmap(
+        n, busmap, aggregate_generators_weighted=True,
+        aggregate_one_ports={'StorageUnit', 'Store'},
+        bus_strategies=dict(country=_make_consense('Bus', 'country')),
+        one_port_strategies=dict(e_nom=np.sum, e_nom_min=np.sum, e_nom_max=np.sum),
+        scale_link_capital_costs=False)
+    m = clustering.network
+    m.import_components_from_dataframe(n.global_constraints, 'GlobalConstraint')
+    return m, clusters
+
+
+def storage_by_cluster(m):
+    """Optimised power and energy capacity per cluster and storage carrier of a coarse network."""
+    to_ac = ac_busmap(m)
+    units = m.storage_units.query('p_nom_extendable')
+    stores = m.stores.query('e_nom_extendable')
+    power = units.p_nom_opt.groupby([units.bus, units.carrier]).sum()
+    energy = pd.concat([(units.p_nom_opt * units.max_hours).groupby([units.bus, units.carrier]).sum(),
+                        stores.e_nom_opt.groupby([stores.bus.map(to_ac), stores.carrier]).sum()])
+    links = m.links.query('p_nom_extendable')
+    link_power = links.p_nom_opt.groupby([links.bus0.map(to_ac), links.carrier]).sum()
+    return power, energy.groupby(level=[0, 1]).sum(), link_power
+
+
+def prune_storage(n, clusters, power, energy, link_power, threshold=1., margin=1.5):
+    """
+    Remove the storage candidates of ``n`` whose carrier is built below
+    ``threshold`` [MW or MWh] in their cluster of the coarse solution, and
+    bound the remaining ones by ``margin`` times the capacity of their cluster.
+    Returns the number of removed and bounded candidates.
+    """
+    to_ac = ac_busmap(n)
+    cluster = to_ac.map(clusters)
+
+    def coarse(values, bus, carrier):
+        return values.reindex(pd.MultiIndex.from_arrays([cluster[bus].values, carrier.values])) \
+                     .fillna(0.).values
+
+    units = n.storage_units.query('p_nom_extendable')
+    e = coarse(energy, units.bus, units.carrier)
+    drop_units = units.index[e < threshold]
+
+    carrier_buses = n.buses.query('carrier != "AC"')
+    e = coarse(energy, carrier_buses.index, carrier_buses.carrier)
+    drop_buses = carrier_buses.index[(e < threshold) &
+                                     carrier_buses.index.isin(n.stores.query('e_nom_extendable').bus)]
+    drop_stores = n.stores.index[n.stores.bus.isin(drop_buses)]
+    drop_links = n.links.index[n.links.bus0.isin(drop_buses) | n.links.bus1.isin(drop_buses)]
+
+    n.mremove('StorageUnit', drop_units)
+    n.mremove('Store', drop_stores)
+    n.mremove('Link', drop_links)
+    n.mremove('Bus', drop_buses)
+
+    units = n.storage_units.query('p_nom_extendable')
+    bound = margin * coarse(power, units.bus, units.carrier)
+    n.storage_units.loc[units.index, 'p_nom_max'] = np.minimum(units.p_nom_max, bound)
+
+    stores = n.stores.query('e_nom_extendable')
+    bound = margin * coarse(energy, stores.bus, stores.carrier)
+    n.stores.loc[stores.index, 'e_nom_max'] = np.minimum(stores.e_nom_max, bound)
+
+    # chargers and dischargers connect an AC bus with a storage bus
+    links = n.links.query('p_nom_extendable')
+    links = links[links.bus0.isin(carrier_buses.index) != links.bus1.isin(carrier_buses.index)]
+    bound = margin * coarse(link_power, links.bus0, links.carrier)
+    n.links.loc[links.index, 'p_nom_max'] = np.minimum(links.p_nom_max, bound)
+
+    return len(drop_units) + len(drop_stores), len(units) + len(stores) + len(links)
+
+
+def binding_bounds(n, rtol=1e-3):
+    """Storage candidates whose capacity reached the bound set by :func:`prune_storage`."""
+    units = n.storage_units.query('p_nom_extendable and p_nom_max > 0')
+    stores = n.stores.query('e_nom_extendable and e_nom_max > 0')
+    return (units.index[units.p_nom_opt >= (1 - rtol) * units.p_nom_max]
+            .append(stores.index[stores.e_nom_opt >= (1 - rtol) * stores.e_nom_max]))
+
+
+def solve_network_hierarchical(n, config, opts='', **kwargs):
+    """
+    Solve ``n`` from coarse to fine spatial resolution: for each number of
+    ``clusters`` the network is clustered and solved, storage candidates in
+    clusters without storage of their carrier are removed from ``n`` and the
+    remaining ones bounded, before ``n`` itself is solved.
+    """
+    cf_hier = config['solving']['options']['hierarchical']
+    threshold = cf_hier.get('threshold', 1.)
+    margin = cf_hier.get('margin', 1.5)
+    config = dict(config, solving=dict(config['solving'], options=dict(
+        config['solving']['options'], hierarchical=dict(cf_hier, enable=False))))
+
+    full = n.copy() if cf_hier.get('check_gap', False) else None
+    levels = []
+    for nclusters in cf_hier['clusters']:
+        start = time.time()
+        m, clusters = cluster_coarse(n, nclusters)
+        clustered = time.time() - start
+        m = solve_network(m, config, opts, **kwargs)
+        solved = time.time() - start - clustered
+        removed, bounded = prune_storage(n, clusters, *storage_by_cluster(m),
+                                         threshold=threshold, margin=margin)
+        levels.append({'clusters': nclusters, 'cluster time': clustered, 'solve time': solved,
+                       'objective': m.objective, 'removed': removed, 'bounded': bounded})
+        logger.info(f"Level with {nclusters} clusters solved in {solved:.1f}s; removed "
+                    f"{removed} and bounded {bounded} storage candidates.")
+
+    start = time.time()
+    n = solve_network(n, config, opts, **kwargs)
+    levels.append({'clusters': len(n.buses.query('carrier == "AC"')), 'cluster time': 0.,
+                   'solve time': time.time() - start, 'objective': n.objective})
+
+    binding = binding_bounds(n)
+    if not binding.empty:
+        logger.warning(f"{len(binding)} storage capacities reached their bound from the coarse "
+                       f"solution, consider a larger `margin`: {', '.join(binding[:10])}")
+
+    if full is not None:
+        start = time.time()
+        full = solve_network(full, config, opts, **kwargs)
+        gap = (n.objective - full.objective) / full.objective
+        levels.append({'clusters': levels[-1]['clusters'], 'cluster time': 0.,
+                       'solve time': time.time() - start, 'objective': full.objective,
+                       'gap': gap})
+        logger.info(f"Optimality gap of the hierarchical solution: {gap:.3%} "
+                    f"(full solve {levels[-1]['solve time']:.1f}s, hierarchical "
+                    f"{sum(l['cluster time'] + l['solve time'] for l in levels[:-1]):.1f}s).")
+
+    n.hierarchy = pd.DataFrame(levels)
+    return n
+
+
+def capacity_bounds(n):
+    """Lower and upper capacity bounds of all extendable assets of ``n``, per component."""
+    bounds = {}
+    for c, attr in nominal_attrs.items():
+        df = n.df(c)
+        if df.empty or not df[attr + '_extendable'].any(): continue
+        ext = df[df[attr + '_extendable']]
+        bounds[c] = pd.DataFrame({'min': ext[attr + '_min'], 'max': ext[attr + '_max']})
+    return bounds
+
+
+def tighten_bounds(n, coarse, original, scale, margin=0.25, atol=10.):
+    """
+    Bound the extendable assets of ``n`` to ``margin`` (relative) plus
+    ``atol`` (MW or MWh, upwards only) around their capacities in the solved
+    network ``coarse``, both widened by the factor ``scale`` per asset, and
+    never beyond the ``original`` bounds (as from :func:`capacity_bounds`).
+    Assets with an infinite ``scale`` keep their original bounds.
+    """
+    for c, b in original.items():
+        attr = nominal_attrs[c]
+        opt = coarse.df(c)[attr + '_opt'].reindex(b.index).fillna(0.)
+        s = scale[c]
+        released = np.isinf(s)
+        s = s.where(~released, 1.)
+        lower = np.maximum(b['min'], opt * (1 - margin * s)).where(~released, b['min'])
+        upper = np.minimum(b['max'], opt * (1 + margin * s) + atol * s).where(~released, b['max'])
+        n.df(c).loc[b.index, attr + '_min'] = lower
+        n.df(c).loc[b.index, attr + '_max'] = upper
+
+
+def binding_tightened(n, original, rtol=1e-3):
+    """Assets of ``n`` whose capacity reached a bound tightened by :func:`tighten_bounds`."""
+    binding = {}
+    for c, b in original.items():
+        attr = nominal_attrs[c]
+        df = n.df(c).loc[b.index]
+        lower, upper, opt = df[attr + '_min'], df[attr + '_max'], df[attr + '_opt']
+        tol = rtol * np.maximum(np.abs(opt), 1.)
+        at_lower = (lower > b['min'] + tol) & (opt <= lower + tol)
+        at_upper = (upper < b['max'] - tol) & (opt >= upper - tol)
+        binding[c] = b.index[at_lower | at_upper]
+    return binding
+
+
+def solve_network_temporal(n, config, opts='', **kwargs):
+    """
+    Solve ``n`` from coarse to full temporal resolution: a copy of ``n``
+    averaged over ``resolution`` hours (or merged into ``segments``) is solved
+    first, and the capacities of all extendable assets in ``n`` are bounded
+    around the coarse solution, starting from the coarse dispatch. Bounds
+    which bind are widened and ``n`` is solved again, until no tightened
+    bound binds; the solution is then optimal for ``n`` without the bounds.
+    """
+    cf_temporal = config['solving']['options']['temporal']
+    margin = cf_temporal.get('margin', 0.25)
+    atol = cf_temporal.get('atol', 10.)
+    widen = cf_temporal.get('widen', 4.)
+    max_rounds = cf_temporal.get('max_rounds', 3)
+    config = dict(config, solving=dict(config['solving'], options=dict(
+        config['solving']['options'], temporal=dict(cf_temporal, enable=False))))
+    start = kwargs.pop('start', None)
+
+    stages = []
+    total = time.time()
+    m = n.copy()
+    if cf_temporal.get('segments'):
+        m = segment_snapshots(m, cf_temporal['segments'])
+    else:
+        m = resample_snapshots(m, cf_temporal.get('resolution', 3))
+    m = solve_network(m, config, opts, start=start, **kwargs)
+    stages.append({'stage': 'coarse', 'snapshots': len(m.snapshots),
+                   'solve time': time.time() - total, 'objective': m.objective})
+    logger.info(f"Coarse solve on {len(m.snapshots)} snapshots took "
+                f"{stages[-1]['solve time']:.1f}s.")
+
+    fine_config = config
+    if cf_temporal.get('warmstart', True) and config['solving']['solver']['name'] == 'gurobi':
+        fine_config = dict(config, solving=dict(config['solving'], options=dict(
+            config['solving']['options'],
+            warmstart=dict(config['solving']['options'].get('warmstart', {}), enable=True))))
+    original = capacity_bounds(n)
+    scale = {c: pd.Series(1., b.index) for c, b in original.items()}
+    start = network_solution(m)
+    full = n.copy() if cf_temporal.get('check_gap', False) else None
+
+    i = 0
+    while True:
+        i += 1
+        f = n.copy()
+        tighten_bounds(f, m, original, scale, margin, atol)
+        released = all(np.isinf(s).all() for s in scale.values())
+        begin = time.time()
+        # the objective is only set if the solve succeeds
+        f.objective = np.nan
+        try:
+            f = solve_network(f, fine_config, opts, start=start, **kwargs)
+        except (RuntimeError, AssertionError):
+            if released: raise
+        if np.isnan(f.objective):
+            if released:
+                raise RuntimeError("Solving the network at full resolution failed.")
+            # e.g. capacities too small for the hourly peaks: widen all bounds
+            binding = {c: s.index[np.isfinite(s)] for c, s in scale.items()}
+        else:
+            binding = binding_tightened(f, original)
+        nbinding = sum(map(len, binding.values()))
+        stages.append({'stage': f'fine {i}', 'snapshots': len(f.snapshots),
+                       'solve time': time.time() - begin, 'objective': f.objective,
+                       'binding': nbinding})
+        if not nbinding:
+            break
+        if np.isnan(f.objective):
+            logger.info(f"Round {i} at full resolution failed with the tightened bounds; "
+                        f"{'widening' if i < max_rounds else 'releasing'} all of them.")
+        else:
+            logger.info(f"{nbinding} tightened capacity bounds bind in round {i}; "
+                        f"{'widening' if i < max_rounds else 'releasing'} them.")
+            start = network_solution(f)
+        for c, index in binding.items():
+            # np.inf leaves only the original bounds
+            scale[c][index] = scale[c][index] * widen if i < max_rounds else np.inf
+    n = f
+    total = time.time() - total
+    logger.info(f"Coarse-to-fine solve took {total:.1f}s in {len(stages) - 1} full "
+                f"resolution round(s); the coarse objective deviates by "
+                f"{(stages[0]['objective'] - n.objective) / n.objective:.3%}.")
+
+    if full is not None:
+        begin = time.time()
+        full = solve_network(full, config, opts, **kwargs)
+        direct = time.time() - begin
+        difference = (n.objective - full.objective) / full.objective
+        stages.append({'stage': 'direct', 'snapshots': len(full.snapshots),
+                       'solve time': direct, 'objective': full.objective,
+                       'difference': difference})
+        logger.info(f"Direct solve took {direct:.1f}s against {total:.1f}s coarse-to-fine "
+                    f"({total / max(direct, 1e-9):.2f} times the direct solve time); "
+                    f"relative objective difference {difference:.2e}.")
+
+    n.refinement = pd.DataFrame(stages)
+    return n
+
+
+def infeasible_windows(n, m, window=24):
+    """
+    AC buses and snapshots (boolean frame) around the constraints in an
+    irreducible infeasible subsystem of the infeasible gurobi model ``m``,
+    widened by ``window`` snapshots on either side. Constraints of components
+    are attributed to their ``bus`` (or ``bus0``); if none of these is an AC
+    bus, all AC buses are marked at the affected snapshots.
+    """
+    m.computeIIS()
+    constraints = m.getConstrs()
+    iis = pd.Index([int(name[1:]) for name, flag in
+                    zip(m.getAttr('ConstrName', constraints), m.getAttr('IISConstr', constraints))
+                    if flag])
+    logger.info(f"Irreducible infeasible subsystem of {len(iis)} constraints.")
+
+    ac_i = n.buses.query("carrier == 'AC'").index
+    marked = pd.DataFrame(False, n.snapshots, ac_i)
+    affected = pd.Series(False, n.snapshots)
+    for (c, attr), pnl in n.constraints.pnl.items():
+        if not pnl: continue
+        found = get_con(n, c, attr).isin(iis)
+        if not found.values.any(): continue
+        affected |= found.any(axis=1).reindex(n.snapshots, fill_value=False)
+        if c == 'Bus':
+            buses = found.columns
+        else:
+            df = n.df(c)
+            buses = df['bus' if 'bus' in df else 'bus0'].reindex(found.columns)
+        found = found.T.groupby(buses.values).any().T
+        marked |= found.reindex(index=n.snapshots, columns=ac_i, fill_value=False)
+
+    if not marked.values.any():
+        if not affected.any():
+            affected[:] = True
+        marked = pd.DataFrame(np.tile(affected.values[:, None], len(ac_i)), n.snapshots, ac_i)
+    marked = marked.astype(float).rolling(2 * window + 1, center=True, min_periods=1).max()
+    return marked.loc[:, marked.any()].astype(bool)
+
+
+def shedding_availability(n):
+    """Sum of the availability of all load shedding generators over all snapshots."""
+    shedding = n.generators.index[n.generators.carrier == 'load']
+    return get_as_dense(n, 'Generator', 'p_max_pu', n.snapshots)[shedding].values.sum()
+
+
+def solve_network_lazy_shedding(n, config, opts='', **kwargs):
+    """
+    Solve without load shedding, and only if the problem is infeasible add
+    load shedding at the buses and snapshots of :func:`infeasible_windows`
+    and solve again, for at most ``max_rounds`` rounds. A feasible problem is
+    thus solved without any shedding variables. If the problem can be solved
+    by gurobi directly, each round is solved that way and the solution of
+    the last round is assigned; otherwise each round is solved by
+    :func:`solve_network`, and gurobi only builds the problem again to
+    diagnose an infeasible round.
+    """
+    solver_options = config['solving']['solver'].copy()
+    solver_name = solver_options.pop('name')
+    cf_solving = config['solving']['options']
+    cf_lazy = cf_solving.get('lazy_shedding', {})
+    marginal_cost = cf_lazy.get('marginal_cost', 1e2)
+    config = dict(config, solving=dict(config['solving'],
+                                       options=dict(cf_solving, load_shedding=False)))
+
+    if solver_name != 'gurobi':
+        logger.warning(f"Lazy load shedding needs gurobi to diagnose infeasibilities, not "
+                       f"'{solver_name}'; adding load shedding at all buses.")
+        add_load_shedding(n, marginal_cost)
+        return solve_network(n, config, opts, **kwargs)
+
+    direct = (cf_solving.get('skip_iterations', False) or not n.lines.s_nom_extendable.any())
+    direct &= not any(cf_solving.get(key, {}).get('enable', False)
+                      for key in ['warmstart', 'scaling', 'hierarchical'])
+
+    max_rounds = cf_lazy.get('max_rounds', 5)
+    for i in range(max_rounds + 1):
+        if not direct:
+            try:
+                n = solve_network(n, config, opts, **kwargs)
+                break
+            except (RuntimeError, AssertionError) as e:
+                # ilopf asserts an optimal status
+                error = e
+
+        n.config = config
+        n.opts = opts
+        problem_fn = prepare_problem(n, solver_dir=kwargs.get('solver_dir'),
+                                     build=lp_builder(config))
+        m = read_gurobi_problem(problem_fn, solver_options, kwargs.get('solver_logfile'))
+        os.remove(problem_fn)
+        m.optimize()
+        if m.Status == 4:  # GRB.INF_OR_UNBD
+            m.setParam('DualReductions', 0)
+            m.optimize()
+        if m.Status != 3:  # GRB.INFEASIBLE
+            if not direct:
+                raise error
+            if m.Status != 2:  # GRB.OPTIMAL
+                raise RuntimeError(f"Solve ended with gurobi status {m.Status}.")
+            assign_gurobi_solution(n, m)
+            break
+        if i == max_rounds:
+            raise RuntimeError(f"Problem still infeasible after {max_rounds} rounds of "
+                               "lazy load shedding.")
+
+        windows = infeasible_windows(n, m, cf_lazy.get('window', 24))
+        before = shedding_availability(n)
+        add_load_shedding(n, marginal_cost, windows)
+        if shedding_availability(n) <= before:
+            raise RuntimeError("Infeasibility cannot be resolved by load shedding.")
+        logger.info(f"Infeasible; allowing load shedding at {windows.shape[1]} buses in "
+                    f"{windows.any(axis=1).sum()} snapshots.")
+
+    if i > 0:
+        shedding = n.generators.index[n.generators.carrier == 'load']
+        logger.warning(f"Problem required load shedding at {len(shedding)} buses.")
+    return n
+
+
 def solve_network(n, config, opts='', **kwargs):
     solver_options = config['solving']['solver'].copy()
     solver_name = solver_options.pop('name')
@@ -407,34 +2119,123 @@ def solve_network(n, config, opts='', **kwargs):
     track_iterations = cf_solving.get('track_iterations', False)
     min_iterations = cf_solving.get('min_iterations', 4)
     max_iterations = cf_solving.get('max_iterations', 6)
+    start = kwargs.pop('start', None)
+
+    if cf_solving.get('temporal', {}).get('enable'):
+        return solve_network_temporal(n, config, opts, start=start, **kwargs)
+
+    if cf_solving.get('decomposition', {}).get('enable'):
+        if cf_solving.get('load_shedding') == 'lazy':
+            # subproblems have to be feasible for any master solution
+            add_load_shedding(n, cf_solving.get('lazy_shedding', {}).get('marginal_cost', 1e2))
+        return solve_network_benders(n, config, opts, **kwargs)
+
+    if cf_solving.get('hierarchical', {}).get('enable'):
+        return solve_network_hierarchical(n, config, opts, **kwargs)
+
+    if cf_solving.get('load_shedding') == 'lazy':
+        return solve_network_lazy_shedding(n, config, opts, start=start, **kwargs)
 
     # add to network for extra_functionality
     n.config = config
     n.opts = opts
 
+    if isinstance(n.snapshots, pd.MultiIndex):
+        kwargs.setdefault('multi_investment_periods', True)
+
     skip_iterations = cf_solving.get('skip_iterations', False)
     if not n.lines.s_nom_extendable.any():
         skip_iterations = True
         logger.info("No expandable lines found. Skipping iterative solving.")
 
+    warmstart = cf_solving.get('warmstart', {}).get('enable', False)
+    scaling = cf_solving.get('scaling', {}).get('enable', False)
+    if warmstart or scaling:
+        if solver_name != 'gurobi':
+            logger.warning(f"Warm starts and scaling are implemented for gurobi only, not "
+                           f"'{solver_name}'; solving without.")
+        elif not skip_iterations:
+            logger.warning("Warm starts and scaling are not used with iterative solving; set "
+                           "`solving: options: skip_iterations: true`.")
+        else:
+            if not warmstart:
+                start = None
+            elif start is None:
+                logger.info("Starting from greedy merit-order dispatch.")
+                start = greedy_dispatch(n)
+            return solve_network_gurobi(n, config, opts, start,
+                                        solver_dir=kwargs.get('solver_dir'),
+                                        solver_logfile=kwargs.get('solver_logfile'))
+
+    build = lp_builder(config)
     if skip_iterations:
-        network_lopf(n, solver_name=solver_name, solver_options=solver_options,
-                     extra_functionality=extra_functionality, **kwargs)
+        status, condition = network_lopf_with(build, n, solver_name=solver_name,
+                                              solver_options=solver_options,
+                                              extra_functionality=extra_functionality,
+                                              **kwargs)
+        if 'infeasible' in condition:
+            raise RuntimeError(f"Solve ended with status '{status}' and condition "
+                               f"'{condition}'.")
     else:
-        ilopf(n, solver_name=solver_name, solver_options=solver_options,
-              track_iterations=track_iterations,
-              min_iterations=min_iterations,
-              max_iterations=max_iterations,
-              extra_functionality=extra_functionality, **kwargs)
+        ilopf_with(build, n, solver_name=solver_name, solver_options=solver_options,
+                   track_iterations=track_iterations,
+                   min_iterations=min_iterations,
+                   max_iterations=max_iterations,
+                   extra_functionality=extra_functionality, **kwargs)
     return n
 
 
+# time series exported by export_to_arrow
+arrow_series = [('Generator', 'p'), ('Link', 'p0'), ('Store', 'e'),
+                ('StorageUnit', 'state_of_charge'), ('Bus', 'marginal_price')]
+
+
+def export_to_arrow(n, path, series=arrow_series):
+    """
+    Write the time series ``series`` of the solved network ``n`` to one
+    uncompressed Feather (Arrow IPC) file per series in the directory
+    ``path``, e.g. ``generators_t.p.feather``. Each file starts with the
+    snapshot column(s), so all files share the same snapshot index.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.feather as feather
+    except ModuleNotFoundError:
+        raise ModuleNotFoundError("Optional dependency 'pyarrow' not found. "
+                                  "Install via 'conda install -c conda-forge pyarrow'.")
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    if isinstance(n.snapshots, pd.MultiIndex):
+        snapshots = n.snapshots.to_frame(index=False)
+    else:
+        snapshots = pd.DataFrame({'snapshot': n.snapshots})
+    for c, attr in series:
+        df = n.pnl(c)[attr].reindex(n.snapshots).astype(float)
+        table = pa.Table.from_pandas(pd.concat([snapshots, df.reset_index(drop=True)], axis=1),
+                                     preserve_index=False)
+        feather.write_feather(table, path / f"{n.components[c]['list_name']}_t.{attr}.feather",
+                              compression='uncompressed')
+    logger.info(f"Exported {len(series)} time series to {path}.")
+
+
+def read_arrow(path, name):
+    """
+    Memory-map the series ``name`` (e.g. ``'stores_t.e'``) written by
+    :func:`export_to_arrow` as a :class:`pyarrow.Table`; its columns are read
+    without copying.
+    """
+    import pyarrow.feather as feather
+    return feather.read_table(Path(path) / f"{name}.feather", memory_map=True)
+
+
 if __name__ == "__main__":
     if 'snakemake' not in globals():
         from _helpers import mock_snakemake
         snakemake = mock_snakemake('solve_network', network='elec', simpl='',
                                   clusters='5', ll='copt', opts='Co2L-BAU-CCL-24H')
     configure_logging(snakemake)
+    apply_solver_profile(snakemake.config)
 
     tmpdir = snakemake.config['solving'].get('tmpdir')
     if tmpdir is not None:
@@ -442,12 +2243,46 @@ if __name__ == "__main__":
     opts = snakemake.wildcards.opts.split('-')
     solve_opts = snakemake.config['solving']['options']
 
+    phases = {}
     fn = getattr(snakemake.log, 'memory', None)
     with memory_logger(filename=fn, interval=30.) as mem:
-        n = pypsa.Network(snakemake.input[0])
+        start = time.time()
+        weather_years = getattr(snakemake.input, 'weather_years', None)
+        if weather_years:
+            n = stack_weather_years(weather_years)
+        else:
+            n = pypsa.Network(snakemake.input[0])
+        phases['read'] = time.time() - start
+
+        start = time.time()
         n = prepare_network(n, solve_opts)
+        warmstart = getattr(snakemake.input, 'warmstart', None) or \
+            solve_opts.get('warmstart', {}).get('network')
+        warmstart = network_solution(pypsa.Network(warmstart)) if warmstart else None
+        phases['prepare'] = time.time() - start
+
+        start = time.time()
         n = solve_network(n, snakemake.config, opts, solver_dir=tmpdir,
-                          solver_logfile=snakemake.log.solver)
+                          solver_logfile=snakemake.log.solver, start=warmstart)
+        phases['solve'] = time.time() - start
+
+        start = time.time()
         n.export_to_netcdf(snakemake.output[0])
+        arrow = getattr(snakemake.output, 'arrow', None)
+        if arrow is not None:
+            export_to_arrow(n, arrow)
+        phases['export'] = time.time() - start
 
     logger.info("Maximum memory usage: {}".format(mem.mem_usage))
+
+    metrics = getattr(snakemake.output, 'metrics', None)
+    if metrics is not None:
+        from summarize_solver_logs import parse_gurobi_log
+        solves = (parse_gurobi_log(snakemake.log.solver)
+                  if snakemake.config['solving']['solver']['name'] == 'gurobi'
+                  and os.path.exists(snakemake.log.solver) else [])
+        with open(metrics, 'w') as f:
+            levels = getattr(n, 'hierarchy', pd.DataFrame()).to_dict('records')
+            refinement = getattr(n, 'refinement', pd.DataFrame()).to_dict('records')
+            json.dump({'phases': phases, 'memory': mem.mem_usage, 'solves': solves,
+                       'levels': levels, 'refinement': refinement}, f, default=float)
@@ -0,0 +1,289 @@
+# SPDX-FileCopyrightText: : 2017-2020 The PyPSA-Eur Authors
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Solves a sequence of planning years myopically, each year inheriting the
+capacities built in the previous years as brownfield assets.
+
+Relevant Settings
+-----------------
+
+.. code:: yaml
+
+    costs:
+        year:
+    electricity:
+        extra_components_cache:
+        extendable_carriers:
+            StorageUnit:
+            Store:
+            Link:
+    solving:
+        tmpdir:
+        options:
+            warmstart:
+        solver:
+            name:
+        pathway:
+            years:
+            threshold:
+            warmstart:
+
+.. seealso::
+    Documentation of the configuration file ``config.yaml`` at
+    :ref:`costs_cf`, :ref:`electricity_cf`, :ref:`solving_cf`
+
+Inputs
+------
+
+- ``networks/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}.nc``: confer :ref:`prepare`
+- ``tech_costs``: cost database of the kind of ``data/costs.csv`` with values for all ``years``
+
+Outputs
+-------
+
+- ``results/pathway/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}/{year}.nc``: solved network of each planning year
+- ``results/pathway/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}_capacities.csv``: capacity in operation per component, carrier and build year (rows) and planning year (columns)
+
+Description
+-----------
+
+The planning ``years`` are solved in order. For each year the prepared
+network is copied, the costs of extendable generators and the storage
+carriers (attached again as in :mod:`add_extra_components`) are taken from
+the cost data of that year, and all capacities built in previous years are
+added as fixed assets named ``<asset>-<build year>``. Assets whose
+``build_year`` plus ``lifetime`` (from the cost data of their build year) is
+not after the planning year are retired. The potentials (``p_nom_max`` and
+``e_nom_max``, e.g. renewable potentials or salt caverns) of the extendable
+assets are reduced by the capacity of their brownfield copies in operation.
+Transmission capacities are never retired and bound the lines and DC links
+from below instead. Capacities below ``threshold`` are not carried over.
+
+The network is read and prepared only once, and storage fragments are taken
+from the cache of :mod:`add_extra_components` where they are unchanged. With
+``pathway: warmstart: true`` each year is solved from the solution of the
+previous one (confer :func:`solve_network.solve_network_gurobi`), in which
+the dispatch of the assets built then is moved to their brownfield copies and
+new capacities start at zero.
+"""
+
+import logging
+from _helpers import configure_logging
+
+import pandas as pd
+import numpy as np
+
+import pypsa
+
+from pathlib import Path
+from pypsa.descriptors import nominal_attrs
+from add_electricity import load_costs
+from add_extra_components import carrier_fragments, attach_fragments
+from solve_network import (prepare_network, solve_network, network_solution,
+                           apply_solver_profile)
+from solve_uncertainty import strip_storage
+
+logger = logging.getLogger(__name__)
+
+# components whose capacities are carried over as fixed brownfield assets
+brownfield_components = ['Generator', 'StorageUnit', 'Store', 'Link']
+
+
+def update_costs(n, costs):
+    """Capital and marginal costs of extendable generators with a carrier in ``costs``."""
+    gens = n.generators.query('p_nom_extendable and carrier in @costs.index')
+    n.generators.loc[gens.index, 'capital_cost'] = costs.loc[gens.carrier, 'capital_cost'].values
+    n.generators.loc[gens.index, 'marginal_cost'] = costs.loc[gens.carrier, 'marginal_cost'].values
+
+
+def built_assets(n, year, costs, threshold=1.):
+    """
+    Extendable assets of the solved network ``n`` built in ``year`` with their
+    input attributes and time series, fixed at their optimal capacity.
+    """
+    assets = {}
+    for c in brownfield_components:
+        attr = nominal_attrs[c]
+        df = n.df(c)
+        built = df.query(f'{attr}_extendable and {attr}_opt > @threshold')
+        if c == 'Link':
+            built = built[built.carrier != 'DC']
+        if built.empty: continue
+
+        attrs = n.components[c]['attrs']
+        outputs = attrs.index[attrs.static & attrs.status.str.startswith('Output')]
+        static = built.drop(columns=outputs.intersection(built.columns))
+        static[attr] = built[attr + '_opt']
+        static[attr + '_extendable'] = False
+        static['build_year'] = year
+        lifetime = costs.lifetime.reindex(built.carrier).values
+        if c == 'Link':
+            # chargers and dischargers retire with their storage carrier
+            carrier = built.bus0.map(n.buses.carrier)
+            carrier = carrier.where(carrier != 'AC', built.bus1.map(n.buses.carrier))
+            lifetime = np.where(np.isnan(lifetime), costs.lifetime.reindex(carrier).values, lifetime)
+        static['lifetime'] = np.nan_to_num(lifetime, nan=np.inf)
+        rename = lambda name: f"{name}-{year}"
+        series = {a: pnl[pnl.columns.intersection(built.index)].rename(columns=rename)
+                  for a, pnl in n.pnl(c).items()
+                  if attrs.at[a, 'status'].startswith('Input')
+                  and len(pnl.columns.intersection(built.index))}
+        assets[c] = (static.rename(rename), series)
+    return assets
+
+
+def attach_brownfield(n, brownfield, year):
+    """
+    Add all assets in ``brownfield`` still in operation in ``year`` to ``n``
+    and reduce the bounds (e.g. ``p_nom_min`` and ``p_nom_max``) of the
+    extendable asset they were built from by their capacity.
+    """
+    for c, (static, series) in brownfield.items():
+        alive = static.query('build_year + lifetime > @year')
+        retired = len(static) - len(alive)
+        if retired:
+            logger.info(f"Retiring {retired} {n.components[c]['list_name']} in {year}.")
+        if alive.empty: continue
+        n.import_components_from_dataframe(alive, c)
+
+        attr = nominal_attrs[c]
+        installed = alive[attr].groupby(alive.index.str.rsplit('-', n=1).str[0]).sum()
+        installed = installed.reindex(n.df(c).index.intersection(installed.index))
+        for bound in [attr + '_min', attr + '_max']:
+            n.df(c).loc[installed.index, bound] = (n.df(c).loc[installed.index, bound]
+                                                   - installed).clip(lower=0.)
+        for attr, pnl in series.items():
+            columns = pnl.columns.intersection(alive.index)
+            if columns.empty: continue
+            n.import_series_from_dataframe(pnl[columns], c, attr)
+
+
+def merge_assets(brownfield, assets):
+    """Add the assets of one year (as from :func:`built_assets`) to ``brownfield``."""
+    for c, (static, series) in assets.items():
+        if c not in brownfield:
+            brownfield[c] = (static, series)
+            continue
+        old_static, old_series = brownfield[c]
+        merged = {a: pd.concat([old_series.get(a, pd.DataFrame()), series.get(a, pd.DataFrame())],
+                               axis=1) for a in set(old_series) | set(series)}
+        brownfield[c] = (pd.concat([old_static, static]), merged)
+
+
+def transmission_minimum(n, solved):
+    """Keep the transmission capacities of ``solved`` as lower bounds in ``n``."""
+    lines = n.lines.index[n.lines.s_nom_extendable]
+    n.lines.loc[lines, 's_nom_min'] = solved.lines.s_nom_opt.reindex(lines).fillna(0.).values
+    dc = n.links.index[n.links.p_nom_extendable & (n.links.carrier == 'DC')]
+    n.links.loc[dc, 'p_nom_min'] = solved.links.p_nom_opt.reindex(dc).fillna(0.).values
+
+
+def pathway_start(solved, assets):
+    """
+    Starting point from the solved network of the previous year, with the
+    values of the assets built then moved to their brownfield copies.
+    """
+    start = network_solution(solved)
+    for c, (static, _) in assets.items():
+        rename = {name.rsplit('-', 1)[0]: name for name in static.index}
+        for (component, attr), value in list(start.items()):
+            if component != c: continue
+            if isinstance(value, pd.DataFrame):
+                start[component, attr] = value.rename(columns=rename)
+            else:
+                start[component, attr] = value.rename(rename)
+    return start
+
+
+def installed_capacities(n, year):
+    capacities = {}
+    for c in brownfield_components + ['Line']:
+        attr = nominal_attrs[c]
+        df = n.df(c)
+        build_year = df.build_year.where(~df[attr + '_extendable'], year)
+        capacities[c] = df[attr + '_opt'].groupby([df.carrier, build_year]).sum()
+    return (pd.concat(capacities, names=['component', 'carrier', 'build_year'])
+            .rename(year))
+
+
+def check_cost_years(tech_costs, years):
+    """Raise if the cost data ``tech_costs`` has no values for some of ``years``."""
+    available = pd.read_csv(tech_costs, index_col=list(range(3))).index.unique(level=1)
+    missing = [year for year in years if year not in available]
+    if missing:
+        raise ValueError(f"Cost data {tech_costs} has no values for the planning years "
+                         f"{', '.join(map(str, missing))} (only for "
+                         f"{', '.join(map(str, sorted(available.dropna())))}); adjust "
+                         f"`solving: pathway: years`.")
+
+
+def solve_pathway(n, tech_costs, config, opts, networks_dir, **kwargs):
+    """
+    Solve the prepared network ``n`` for each planning year in ``solving:
+    pathway: years`` with the capacities of previous years as brownfield
+    assets, writing the solved networks to ``networks_dir``. Returns the
+    capacities in operation per planning year.
+    """
+    cf_pathway = config['solving']['pathway']
+    threshold = cf_pathway.get('threshold', 1.)
+    elec_config = config['electricity']
+    carriers = (elec_config['extendable_carriers']['StorageUnit'] +
+                elec_config['extendable_carriers']['Store'])
+    Nyears = n.snapshot_weightings.objective.sum() / 8760.
+    check_cost_years(tech_costs, cf_pathway['years'])
+    Path(networks_dir).mkdir(parents=True, exist_ok=True)
+
+    brownfield, solved, start, capacities = {}, None, None, []
+    for year in cf_pathway['years']:
+        logger.info(f"Solving planning year {year}.")
+        costs = load_costs(tech_costs, dict(config['costs'], year=year), elec_config, Nyears)
+
+        m = n.copy()
+        update_costs(m, costs)
+        strip_storage(m, carriers)
+        attach_fragments(m, carrier_fragments(m, costs, elec_config,
+                                              elec_config.get('extra_components_cache')))
+        attach_brownfield(m, brownfield, year)
+        if solved is not None:
+            transmission_minimum(m, solved)
+
+        year_config = config
+        if start is not None:
+            year_config = dict(config, solving=dict(config['solving'], options=dict(
+                config['solving']['options'],
+                warmstart=dict(config['solving']['options'].get('warmstart', {}), enable=True))))
+        m = solve_network(m, year_config, opts, start=start, **kwargs)
+        m.export_to_netcdf(Path(networks_dir) / f"{year}.nc")
+        capacities.append(installed_capacities(m, year))
+
+        assets = built_assets(m, year, costs, threshold)
+        merge_assets(brownfield, assets)
+        if cf_pathway.get('warmstart', True):
+            start = pathway_start(m, assets)
+        solved = m
+
+    return pd.concat(capacities, axis=1).fillna(0.)
+
+
+if __name__ == "__main__":
+    if 'snakemake' not in globals():
+        from _helpers import mock_snakemake
+        snakemake = mock_snakemake('solve_pathway', network='elec', simpl='',
+                                  clusters='20', ll='copt', opts='Co2L-1H')
+    configure_logging(snakemake)
+    apply_solver_profile(snakemake.config)
+
+    tmpdir = snakemake.config['solving'].get('tmpdir')
+    if tmpdir is not None:
+        Path(tmpdir).mkdir(parents=True, exist_ok=True)
+    opts = snakemake.wildcards.opts.split('-')
+
+    n = pypsa.Network(snakemake.input.network)
+    n = prepare_network(n, snakemake.config['solving']['options'])
+
+    capacities = solve_pathway(n, snakemake.input.tech_costs, snakemake.config, opts,
+                               snakemake.output.networks, solver_dir=tmpdir,
+                               solver_logfile=snakemake.log.solver)
+    capacities.to_csv(snakemake.output.capacities)
@@ -0,0 +1,280 @@
+# SPDX-FileCopyrightText: : 2017-2020 The PyPSA-Eur Authors
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Propagates the uncertainty of storage cost assumptions to optimal storage
+capacities by Monte-Carlo sampling, stopping once the capacity quantiles have
+converged.
+
+Relevant Settings
+-----------------
+
+.. code:: yaml
+
+    costs:
+    electricity:
+        max_hours:
+        extendable_carriers:
+            StorageUnit:
+            Store:
+            Link:
+    solving:
+        tmpdir:
+        options:
+        solver:
+            name:
+        uncertainty:
+            parameters:
+            quantiles:
+            tolerance:
+            patience:
+            batch:
+            min_samples:
+            max_samples:
+            workers:
+            seed:
+
+.. seealso::
+    Documentation of the configuration file ``config.yaml`` at
+    :ref:`costs_cf`, :ref:`electricity_cf`, :ref:`solving_cf`
+
+Inputs
+------
+
+- ``networks/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}.nc``: confer :ref:`prepare`
+- ``tech_costs``: cost database of the kind of ``data/costs.csv``, for all technologies except the sampled storage technologies
+- ``cost_scenarios``: ``cost-data/costs-{optimistic,realistic,pessimistic}.csv``, which bound the distributions of the storage parameters
+
+Outputs
+-------
+
+- ``results/uncertainty/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}_samples.csv``: sampled parameters, objective and energy capacity per storage carrier of each sample
+- ``results/uncertainty/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}_statistics.csv``: mean, standard deviation and ``quantiles`` of the energy capacity per storage carrier
+
+Description
+-----------
+
+Each of the ``parameters`` (by default investment, FOM, efficiency and
+lifetime) of each storage technology in ``cost_scenarios`` is drawn from a
+triangular distribution between the lowest and highest of its values in the
+cost scenarios, with the mode at the realistic value. Parameters with the same
+value in all scenarios are kept fixed.
+
+For every sample the storage carriers of the prepared network are removed and
+attached again with the sampled costs as in :mod:`add_extra_components`, and
+the network is solved with :func:`solve_network.solve_network`. Samples are
+solved in ``workers`` parallel processes and written to the outputs as soon
+as they are solved, so an interrupted run keeps all results so far.
+
+After every ``batch`` solved samples (and at least ``min_samples``) the
+``quantiles`` of the energy capacity of each carrier are compared with those
+of the previous check. Sampling stops when no quantile has moved by more than
+``tolerance`` times the mean capacity of its carrier in ``patience``
+consecutive checks, or after ``max_samples``. Wide distributions thereby get
+more samples than narrow ones.
+"""
+
+import logging
+from _helpers import configure_logging
+
+import io
+import pandas as pd
+import numpy as np
+
+import pypsa
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from add_electricity import load_costs
+from add_extra_components import carrier_fragments, attach_fragments
+from solve_network import (prepare_network, solve_network, storage_capacities,
+                           apply_solver_profile)
+
+logger = logging.getLogger(__name__)
+
+
+def read_cost_data(fn):
+    df = (pd.read_csv(fn, encoding='utf-8-sig')
+          .rename(columns=str.strip)
+          .set_index(['technology', 'year', 'parameter']))
+    return df[~df.index.duplicated()]
+
+
+def parameter_bounds(scenarios, parameters, mode='realistic'):
+    """
+    Lower bound, mode and upper bound of each storage parameter from the cost
+    scenarios ``scenarios`` (dictionary of frames as from :func:`read_cost_data`).
+    """
+    values = pd.concat({s: df.value for s, df in scenarios.items()}, axis=1)
+    values = values[values.index.get_level_values('parameter').isin(parameters)]
+    return pd.DataFrame({'low': values.min(axis=1),
+                         'mode': values[mode].clip(values.min(axis=1), values.max(axis=1)),
+                         'high': values.max(axis=1)})
+
+
+def draw_samples(bounds, nsamples, rng):
+    """Triangular samples of all parameters, one row per sample."""
+    varying = bounds.query('high > low')
+    samples = pd.DataFrame(np.tile(bounds['mode'].values, (nsamples, 1)),
+                           columns=bounds.index)
+    samples[varying.index] = rng.triangular(varying['low'].values, varying['mode'].values,
+                                            varying['high'].values,
+                                            size=(nsamples, len(varying)))
+    return samples
+
+
+def strip_storage(n, carriers):
+    """Remove all storage units, stores, links and buses of ``carriers``."""
+    buses_i = n.buses.index[n.buses.carrier.isin(carriers)]
+    n.mremove('StorageUnit', n.storage_units.index[n.storage_units.carrier.isin(carriers)])
+    n.mremove('Store', n.stores.index[n.stores.bus.isin(buses_i)])
+    n.mremove('Link', n.links.index[n.links.bus0.isin(buses_i) | n.links.bus1.isin(buses_i)])
+    n.mremove('Bus', buses_i)
+
+
+_uncertainty = {}
+
+
+def _init_uncertainty_worker(fn, tech_costs, storage_costs, config, opts, kwargs):
+    n = pypsa.Network(fn)
+    elec_config = config['electricity']
+    carriers = (elec_config['extendable_carriers']['StorageUnit'] +
+                elec_config['extendable_carriers']['Store'])
+    strip_storage(n, carriers)
+    _uncertainty.update(network=n, tech_costs=tech_costs, storage_costs=storage_costs,
+                        config=config, opts=opts, kwargs=kwargs)
+
+
+def _solve_sample(sample):
+    n = _uncertainty['network'].copy()
+    config = _uncertainty['config']
+    storage_costs = _uncertainty['storage_costs'].copy()
+    storage_costs.loc[sample.index, 'value'] = sample.values
+
+    buffer = io.StringIO()
+    pd.concat([_uncertainty['tech_costs'], storage_costs]).to_csv(buffer)
+    buffer.seek(0)
+    Nyears = n.snapshot_weightings.objective.sum() / 8760.
+    costs = load_costs(buffer, config['costs'], config['electricity'], Nyears)
+
+    attach_fragments(n, carrier_fragments(n, costs, config['electricity']))
+    n = prepare_network(n, config['solving']['options'])
+    try:
+        n = solve_network(n, config, _uncertainty['opts'], **_uncertainty['kwargs'])
+    except Exception as e:
+        logger.warning(f"Sample failed to solve: {e}")
+        return None
+    return pd.concat([pd.Series({'objective': n.objective}),
+                      storage_capacities(n).add_prefix('e_nom_opt ')])
+
+
+def quantile_change(previous, current, scale, atol=1.):
+    """Largest change of any quantile relative to the mean capacity of its carrier."""
+    if previous is None:
+        return np.inf
+    return ((current - previous).abs().div(scale + atol, axis=1)).max().max()
+
+
+def statistics(results, quantiles):
+    capacities = results.filter(like='e_nom_opt ')
+    stats = capacities.quantile(quantiles)
+    stats.index = [f'q{q:g}' for q in quantiles]
+    return pd.concat([capacities.agg(['mean', 'std']), stats])
+
+
+def solve_uncertainty(fn, tech_costs, scenarios, config, opts, samples_fn, statistics_fn,
+                      **kwargs):
+    """
+    Solve the network in ``fn`` for triangular samples of the storage costs
+    in ``scenarios`` until the capacity quantiles converge, writing samples
+    and statistics incrementally.
+    """
+    uconfig = config['solving']['uncertainty']
+    quantiles = uconfig.get('quantiles', [0.05, 0.5, 0.95])
+    tolerance = uconfig.get('tolerance', 0.02)
+    patience = uconfig.get('patience', 3)
+    workers = uconfig.get('workers', 4)
+    batch = uconfig.get('batch', workers)
+    min_samples = uconfig.get('min_samples', 20)
+    max_samples = uconfig.get('max_samples', 500)
+    rng = np.random.default_rng(uconfig.get('seed', 0))
+
+    bounds = parameter_bounds(scenarios, uconfig.get('parameters', ['investment', 'FOM',
+                                                                     'efficiency', 'lifetime']))
+    logger.info(f"Sampling {(bounds.high > bounds.low).sum()} uncertain storage parameters.")
+    samples = draw_samples(bounds, max_samples, rng)
+
+    storage_costs = scenarios['realistic']
+    tech_costs = tech_costs.drop(storage_costs.index, errors='ignore')
+
+    results, previous, calm = [], None, 0
+    initargs = (fn, tech_costs, storage_costs, config, opts, kwargs)
+    with ProcessPoolExecutor(workers, initializer=_init_uncertainty_worker,
+                             initargs=initargs) as pool:
+        submitted = iter(samples.iterrows())
+        pending = {}
+        for i, sample in submitted:
+            pending[pool.submit(_solve_sample, sample)] = i
+            if len(pending) >= workers: break
+
+        stop = False
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = pending.pop(future)
+                result = future.result()
+                if result is None: continue
+                row = pd.concat([samples.loc[i].rename(lambda p: ' '.join(map(str, p))), result])
+                results.append(row.rename(i))
+                row.to_frame().T.rename_axis('sample').to_csv(
+                    samples_fn, mode='a', header=len(results) == 1)
+
+                if len(results) % batch == 0:
+                    frame = pd.DataFrame(results)
+                    stats = statistics(frame, quantiles)
+                    stats.to_csv(statistics_fn)
+                    current = stats.loc[[f'q{q:g}' for q in quantiles]]
+                    change = quantile_change(previous, current, stats.loc['mean'])
+                    previous = current
+                    calm = calm + 1 if change < tolerance else 0
+                    logger.info(f"{len(results)} samples solved; largest quantile change {change:.2%}.")
+                    if len(results) >= min_samples and calm >= patience:
+                        logger.info(f"Capacity quantiles converged after {len(results)} samples.")
+                        stop = True
+
+            if not stop:
+                for i, sample in submitted:
+                    pending[pool.submit(_solve_sample, sample)] = i
+                    if len(pending) >= workers: break
+
+    if not stop:
+        logger.warning(f"Capacity quantiles did not converge within {max_samples} samples.")
+    frame = pd.DataFrame(results)
+    statistics(frame, quantiles).to_csv(statistics_fn)
+    return frame
+
+
+if __name__ == "__main__":
+    if 'snakemake' not in globals():
+        from _helpers import mock_snakemake
+        snakemake = mock_snakemake('solve_uncertainty', network='elec', simpl='',
+                                  clusters='20', ll='copt', opts='Co2L-1H')
+    configure_logging(snakemake)
+    apply_solver_profile(snakemake.config)
+
+    tmpdir = snakemake.config['solving'].get('tmpdir')
+    if tmpdir is not None:
+        Path(tmpdir).mkdir(parents=True, exist_ok=True)
+    opts = snakemake.wildcards.opts.split('-')
+
+    scenarios = {Path(fn).stem.replace('costs-', ''): read_cost_data(fn)
+                 for fn in snakemake.input.cost_scenarios}
+    tech_costs = read_cost_data(snakemake.input.tech_costs)
+
+    for fn in snakemake.output:
+        Path(fn).parent.mkdir(parents=True, exist_ok=True)
+        Path(fn).unlink(missing_ok=True)
+
+    solve_uncertainty(snakemake.input.network, tech_costs, scenarios, snakemake.config, opts,
+                      snakemake.output.samples, snakemake.output.statistics, solver_dir=tmpdir)
@@ -0,0 +1,177 @@
+# SPDX-FileCopyrightText: : 2017-2020 The PyPSA-Eur Authors
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Parses gurobi solver logs into structured convergence metrics and collects
+them, together with the phase timings of :mod:`solve_network`, into one table
+across scenarios.
+
+Relevant Settings
+-----------------
+
+None.
+
+Inputs
+------
+
+- ``results/metrics/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}.json``: solver metrics and phase timings per solved network, as written by :mod:`solve_network`
+
+Outputs
+-------
+
+- ``results/metrics/summary.csv``: one row per scenario with problem size before and after presolve, iterations, final residuals, solve time and number of numerical warnings
+
+Description
+-----------
+
+:func:`parse_gurobi_log` splits a gurobi log into its solves (a log holds
+several solves for iterative line expansion, sweeps or warm-start
+comparisons) and extracts per solve
+
+- rows, columns and nonzeros before and after presolve, the rows and columns removed by presolve and the presolve time,
+- the ranges of the matrix, objective, bound and right-hand side coefficients,
+- the barrier iterations with primal and dual objective, primal and dual residual and complementarity,
+- barrier and simplex iteration counts, the solution time, status and objective,
+- all warnings and messages about numerical trouble.
+
+:mod:`solve_network` stores these metrics together with the time spent in
+each phase (reading, preparing, solving, exporting) whenever the rule has an
+output ``metrics``. This script then summarises the last solve of each
+scenario, so that storage configurations which lead to numerically hard or
+slow problems stand out, and tuning changes can be tracked across many runs.
+"""
+
+import logging
+from _helpers import configure_logging
+
+import json
+import re
+import pandas as pd
+
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+number = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+
+patterns = {
+    'size': re.compile(rf'Optimize a model with ({number}) rows, ({number}) columns and ({number}) nonzeros'),
+    'presolved': re.compile(rf'Presolved: ({number}) rows, ({number}) columns, ({number}) nonzeros'),
+    'removed': re.compile(rf'Presolve removed ({number}) rows and ({number}) columns'),
+    'presolve_time': re.compile(rf'Presolve time: ({number})s'),
+    'range': re.compile(rf'^\s*(Matrix|Objective|Bounds|RHS) range\s+\[({number}), ({number})\]'),
+    'iteration': re.compile(rf'^\s*(\d+)\*?\s+({number})\s+({number})\s+({number})\s+({number})'
+                            rf'\s+({number})\s+(\d+)s'),
+    'barrier': re.compile(rf'Barrier (?:solved model|performed) (?:in )?({number}) iterations '
+                          rf'(?:and|in) ({number}) seconds'),
+    'solved': re.compile(rf'Solved in ({number}) iterations and ({number}) seconds'),
+    'objective': re.compile(rf'Optimal objective\s+({number})'),
+}
+
+status_messages = {
+    'Optimal objective': 'optimal',
+    'Infeasible model': 'infeasible',
+    'Unbounded model': 'unbounded',
+    'Infeasible or unbounded model': 'infeasible or unbounded',
+    'Time limit reached': 'time limit',
+    'Sub-optimal termination': 'suboptimal',
+    'Numerical trouble encountered': 'numerical trouble',
+}
+
+
+def parse_solve(lines):
+    """Metrics of a single solve from the lines of a gurobi log."""
+    solve = {'warnings': [], 'ranges': {}, 'iterations': [], 'status': None}
+    keys = ['size', 'presolved', 'removed', 'presolve_time', 'range', 'iteration',
+            'barrier', 'solved']
+    for line in lines:
+        for key in keys:
+            m = patterns[key].search(line)
+            if m is not None: break
+        else:
+            key = None
+
+        if key == 'size':
+            solve.update(zip(['rows', 'columns', 'nonzeros'], map(float, m.groups())))
+        elif key == 'presolved':
+            solve.update(zip(['presolved_rows', 'presolved_columns', 'presolved_nonzeros'],
+                             map(float, m.groups())))
+        elif key == 'removed':
+            solve['presolve_removed_rows'] = solve.get('presolve_removed_rows', 0) + float(m.group(1))
+            solve['presolve_removed_columns'] = solve.get('presolve_removed_columns', 0) + float(m.group(2))
+        elif key == 'presolve_time':
+            solve['presolve_time'] = float(m.group(1))
+        elif key == 'range':
+            solve['ranges'][m.group(1).lower()] = [float(m.group(2)), float(m.group(3))]
+        elif key == 'iteration':
+            solve['iterations'].append(dict(zip(
+                ['iteration', 'primal_objective', 'dual_objective', 'primal_residual',
+                 'dual_residual', 'complementarity', 'time'], map(float, m.groups()))))
+        elif key == 'barrier':
+            solve['barrier_iterations'], solve['barrier_time'] = map(float, m.groups())
+            solve['runtime'] = solve['barrier_time']
+        elif key == 'solved':
+            solve['simplex_iterations'], solve['runtime'] = map(float, m.groups())
+        elif line.startswith('Warning') or 'numerical trouble' in line.lower():
+            solve['warnings'].append(line.strip())
+
+        m = patterns['objective'].search(line)
+        if m is not None:
+            solve['objective'] = float(m.group(1))
+        for message, status in status_messages.items():
+            if line.startswith(message):
+                solve['status'] = status
+    return solve
+
+
+def parse_gurobi_log(fn):
+    """List of metrics of all solves in the gurobi log ``fn``."""
+    with open(fn) as f:
+        lines = f.read().splitlines()
+    starts = [i for i, line in enumerate(lines) if patterns['size'].search(line)]
+    return [parse_solve(lines[i:j]) for i, j in zip(starts, starts[1:] + [len(lines)])]
+
+
+def summarize(metrics):
+    """Flat summary of the last solve and the phase timings in ``metrics``."""
+    solves = metrics.get('solves', [])
+    summary = {f'{phase} time': seconds for phase, seconds in metrics.get('phases', {}).items()}
+    summary['solves'] = len(solves)
+    if not solves:
+        return pd.Series(summary)
+
+    solve = solves[-1]
+    for key, value in solve.items():
+        if not isinstance(value, (list, dict)):
+            summary[key] = value
+    for name, (lower, upper) in solve['ranges'].items():
+        summary[f'{name} range'] = upper / lower if lower else float('inf')
+    if solve['iterations']:
+        last = solve['iterations'][-1]
+        summary['final primal residual'] = last['primal_residual']
+        summary['final dual residual'] = last['dual_residual']
+        summary['final complementarity'] = last['complementarity']
+    summary['warnings'] = len(solve['warnings'])
+    return pd.Series(summary)
+
+
+if __name__ == "__main__":
+    if 'snakemake' not in globals():
+        from _helpers import mock_snakemake
+        snakemake = mock_snakemake('summarize_solver_logs')
+    configure_logging(snakemake)
+
+    summaries = {}
+    for fn in snakemake.input:
+        with open(fn) as f:
+            summaries[Path(fn).stem] = summarize(json.load(f))
+    summaries = pd.DataFrame(summaries).T.rename_axis('scenario').infer_objects()
+
+    slow = summaries.get('runtime', pd.Series(dtype=float)).nlargest(5)
+    logger.info(f"Slowest scenarios [s]:\n{slow}")
+    warned = summaries.query('warnings > 0').index if 'warnings' in summaries else []
+    if len(warned):
+        logger.warning(f"Numerical warnings in scenarios: {', '.join(warned)}")
+
+    summaries.to_csv(snakemake.output[0])
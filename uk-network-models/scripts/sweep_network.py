@@ -0,0 +1,266 @@
+# SPDX-FileCopyrightText: : 2017-2020 The PyPSA-Eur Authors
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Solves a network for a sequence of CO2 limits and cost assumptions while
+building the optimisation problem only once.
+
+Relevant Settings
+-----------------
+
+.. code:: yaml
+
+    costs:
+        year:
+    electricity:
+        extra_components_cache:
+    solving:
+        tmpdir:
+        options:
+        solver:
+            name:
+        sweep:
+            co2limits:
+            solver_options:
+
+.. seealso::
+    Documentation of the configuration file ``config.yaml`` at
+    :ref:`solving_cf`
+
+Inputs
+------
+
+- ``networks/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}.nc``: confer :ref:`prepare`
+- ``cost_data`` (optional): cost databases of the kind of ``data/costs.csv`` with other cost assumptions (e.g. ``cost-data/costs-*.csv``); each one adds a sweep point with its capital and marginal costs
+
+Outputs
+-------
+
+- ``results/sweeps/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}/``: one solved network per sweep point
+- ``results/sweeps/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}.csv``: objective, solver statistics and storage energy capacities per sweep point
+
+Description
+-----------
+
+The linear problem is written and read into gurobi once. For every sweep point
+only the right-hand side of the ``CO2Limit`` global constraint or the
+objective coefficients of capacity and dispatch variables are modified, and
+the model is re-optimised from the basis of the previous point. Points are
+not cumulative: points without a CO2 limit or costs of their own are solved at
+the CO2 limit and with the costs of the network. The costs of a cost point are
+read from its cost database with :func:`add_electricity.load_costs`; extendable
+generators are costed by carrier, and the storage carriers are attached again
+to a skeleton of the network as in :mod:`add_extra_components` (using its
+fragment cache), so that no network is built per point. Transmission costs are
+kept. To have a
+basis to start from, crossover is switched on for the first point. Later
+points are solved with dual simplex if only the CO2 limit changed and with
+primal simplex if costs changed, unless ``solving: sweep: solver_options``
+says otherwise.
+
+Each point is written to disk as soon as it is solved, so an interrupted sweep
+keeps all points solved so far.
+"""
+
+import logging
+from _helpers import configure_logging
+
+import os
+import time
+import pandas as pd
+
+import pypsa
+from pypsa.linopf import get_var, get_con
+from pypsa.descriptors import get_extendable_i, nominal_attrs
+
+from pathlib import Path
+from add_electricity import load_costs
+from add_extra_components import carrier_fragments
+from solve_network import (prepare_network, prepare_problem, read_gurobi_problem,
+                           gurobi_variables, assign_gurobi_solution,
+                           storage_capacities, marginal_attrs, apply_solver_profile)
+
+logger = logging.getLogger(__name__)
+
+def co2_points(co2limits):
+    return [{'name': f'co2-{limit:.4g}', 'co2limit': float(limit)}
+            for limit in co2limits]
+
+
+def cost_points(n, fns, config):
+    """Sweep points with the capital and marginal costs of ``n`` under the cost databases ``fns``."""
+    elec_config = config['electricity']
+    Nyears = n.snapshot_weightings.objective.sum() / 8760.
+    points = []
+    for fn in fns:
+        costs = load_costs(fn, config['costs'], elec_config, Nyears)
+        gens = n.generators.query('p_nom_extendable and carrier in @costs.index')
+        capital_cost = {'Generator': pd.Series(costs.loc[gens.carrier, 'capital_cost'].values,
+                                               gens.index)}
+        marginal_cost = {'Generator': pd.Series(costs.loc[gens.carrier, 'marginal_cost'].values,
+                                                gens.index)}
+        fragments = carrier_fragments(n, costs, elec_config,
+                                      elec_config.get('extra_components_cache'))
+        for c in ['StorageUnit', 'Store', 'Link']:
+            dfs = [f[c] for f in fragments if not f[c].empty]
+            if not dfs: continue
+            df = pd.concat(dfs)
+            df = df[~df.index.duplicated()]
+            capital_cost[c] = df.capital_cost
+            marginal_cost[c] = df.marginal_cost
+        points.append({'name': Path(fn).stem, 'capital_cost': capital_cost,
+                       'marginal_cost': marginal_cost})
+    return points
+
+
+def set_co2limit(n, m, limit):
+    name = 'CO2Limit'
+    constraint = m.getConstrByName('c{}'.format(get_con(n, 'GlobalConstraint', 'mu')[name]))
+    # keep any constant offset on the right-hand side
+    offset = constraint.RHS - n.global_constraints.at[name, 'constant']
+    constraint.RHS = limit + offset
+    n.global_constraints.at[name, 'constant'] = limit
+
+
+def objective_constant(n):
+    """
+    Capital costs of the existing capacities of extendable assets, which pypsa
+    subtracts from the objective.
+    """
+    return sum(n.df(c).loc[get_extendable_i(n, c), 'capital_cost'] @
+               n.df(c).loc[get_extendable_i(n, c), attr] for c, attr in nominal_attrs.items())
+
+
+def merge_costs(base, costs):
+    """Per-component cost series ``costs``, completed by those of ``base``."""
+    return dict(base, **{c: cost.combine_first(base[c]) if c in base else cost
+                         for c, cost in costs.items()})
+
+
+def set_capital_costs(n, m, variables, capital_cost):
+    for c, cost in capital_cost.items():
+        ext_i = get_extendable_i(n, c).intersection(cost.index)
+        if ext_i.empty: continue
+        labels = get_var(n, c, nominal_attrs[c])[ext_i]
+        m.setAttr('Obj', variables[labels].tolist(), cost[ext_i].tolist())
+        n.df(c).loc[ext_i, 'capital_cost'] = cost[ext_i]
+
+
+def set_marginal_costs(n, m, variables, marginal_cost):
+    for c, cost in marginal_cost.items():
+        if n.df(c).empty: continue
+        labels = get_var(n, c, marginal_attrs[c])
+        names = labels.columns.intersection(cost.index)
+        coeffs = pd.DataFrame(n.snapshot_weightings.objective[labels.index].values[:, None] *
+                              cost[names].values[None, :], labels.index, names)
+        m.setAttr('Obj', variables[labels[names].values.ravel()].tolist(),
+                  coeffs.values.ravel().tolist())
+        n.df(c).loc[names, 'marginal_cost'] = cost[names]
+
+
+def sweep_network(n, config, opts, points, networks_dir, summary_fn,
+                  solver_dir=None, solver_logfile=None):
+    """
+    Solve ``n`` for each of the sweep ``points``, which are dictionaries with
+    a ``name`` and any of ``co2limit`` (float), ``capital_cost`` and
+    ``marginal_cost`` (dictionaries of per-component cost series). Points
+    without ``co2limit`` or costs are solved at the CO2 limit and with the
+    costs of ``n``.
+    """
+    if isinstance(n.snapshots, pd.MultiIndex):
+        raise ValueError("Sweeps are not implemented for networks "
+                         "with investment periods.")
+    solver_options = config['solving']['solver'].copy()
+    solver_name = solver_options.pop('name')
+    if solver_name != 'gurobi':
+        raise ValueError("Modifying a built problem in place requires "
+                         f"solver 'gurobi', not '{solver_name}'.")
+    sweep_options = config['solving'].get('sweep', {}).get('solver_options', {})
+
+    n.config = config
+    n.opts = opts
+
+    start = time.time()
+    problem_fn = prepare_problem(n, solver_dir=solver_dir)
+    m = read_gurobi_problem(problem_fn, solver_options, solver_logfile)
+    os.remove(problem_fn)
+    variables = gurobi_variables(m)
+    # the problem keeps the constant and CO2 limit it was built with
+    built_constant = objective_constant(n)
+    base_co2limit = (n.global_constraints.at['CO2Limit', 'constant']
+                     if 'CO2Limit' in n.global_constraints.index else None)
+    base_capital_cost = {c: n.df(c).capital_cost.copy() for c in nominal_attrs}
+    base_marginal_cost = {c: n.df(c).marginal_cost.copy() for c in marginal_attrs}
+    if m.Params.Crossover == 0:
+        logger.info("Enabling crossover to obtain a basis for warm starts.")
+        m.Params.Crossover = -1
+    logger.info(f"Built problem for sweep in {time.time() - start:.1f}s.")
+
+    networks_dir = Path(networks_dir)
+    networks_dir.mkdir(parents=True, exist_ok=True)
+
+    costs_set = False
+    for k, point in enumerate(points):
+        co2limit = point.get('co2limit', base_co2limit)
+        if co2limit is not None and \
+                co2limit != n.global_constraints.at['CO2Limit', 'constant']:
+            set_co2limit(n, m, co2limit)
+        # the costs of the previous point are reset to those of the network
+        costs_changed = costs_set or 'capital_cost' in point or 'marginal_cost' in point
+        if costs_changed:
+            set_capital_costs(n, m, variables,
+                              merge_costs(base_capital_cost, point.get('capital_cost', {})))
+            set_marginal_costs(n, m, variables,
+                               merge_costs(base_marginal_cost, point.get('marginal_cost', {})))
+        costs_set = 'capital_cost' in point or 'marginal_cost' in point
+
+        if k > 0:
+            m.Params.Method = 0 if costs_changed else 1
+            for key, value in sweep_options.items():
+                m.setParam(key, value)
+
+        m.optimize()
+        if m.Status != 2:  # GRB.OPTIMAL
+            logger.warning(f"Sweep point '{point['name']}' ended with gurobi "
+                           f"status {m.Status}; skipping.")
+            continue
+        assign_gurobi_solution(n, m)
+        n.objective_constant = objective_constant(n)
+        n.objective += built_constant - n.objective_constant
+
+        n.export_to_netcdf(networks_dir / f"{point['name']}.nc")
+        summary = pd.Series({'objective': n.objective, 'runtime': m.Runtime,
+                             'simplex_iterations': m.IterCount,
+                             'barrier_iterations': m.BarIterCount,
+                             'co2limit': co2limit})
+        summary = pd.concat([summary, storage_capacities(n).add_prefix('e_nom_opt ')])
+        summary.to_frame(point['name']).T.rename_axis('point').to_csv(
+            summary_fn, mode='a', header=not Path(summary_fn).exists())
+        logger.info(f"Solved sweep point '{point['name']}' ({k + 1}/{len(points)}) "
+                    f"in {m.Runtime:.1f}s.")
+
+
+if __name__ == "__main__":
+    if 'snakemake' not in globals():
+        from _helpers import mock_snakemake
+        snakemake = mock_snakemake('sweep_network', network='elec', simpl='',
+                                  clusters='20', ll='copt', opts='Co2L-1H')
+    configure_logging(snakemake)
+    apply_solver_profile(snakemake.config)
+
+    tmpdir = snakemake.config['solving'].get('tmpdir')
+    if tmpdir is not None:
+        Path(tmpdir).mkdir(parents=True, exist_ok=True)
+    opts = snakemake.wildcards.opts.split('-')
+    solve_opts = snakemake.config['solving']['options']
+    sweep_config = snakemake.config['solving'].get('sweep', {})
+
+    n = pypsa.Network(snakemake.input.network)
+    n = prepare_network(n, solve_opts)
+
+    points = (co2_points(sweep_config.get('co2limits', [])) +
+              cost_points(n, getattr(snakemake.input, 'cost_data', []), snakemake.config))
+    sweep_network(n, snakemake.config, opts, points, snakemake.output.networks,
+                  snakemake.output.summary, solver_dir=tmpdir,
+                  solver_logfile=snakemake.log.solver)
@@ -0,0 +1,222 @@
+# SPDX-FileCopyrightText: : 2017-2020 The PyPSA-Eur Authors
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Tunes the gurobi parameters for a model family by short, time-capped solves of
+a reduced network over a grid of parameter settings, and writes the fastest
+robust setting to the solver profiles.
+
+Relevant Settings
+-----------------
+
+.. code:: yaml
+
+    solving:
+        tmpdir:
+        options:
+        solver:
+        solver_profile:
+        solver_profiles:
+        tuning:
+            nhours:
+            segments:
+            parameters:
+            max_trials:
+            repeats:
+            time_limit:
+            tolerance:
+            workers:
+            threads:
+            seed:
+
+.. seealso::
+    Documentation of the configuration file ``config.yaml`` at :ref:`solving_cf`
+
+Inputs
+------
+
+- ``networks/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}.nc``: confer :ref:`prepare`
+
+Outputs
+-------
+
+- ``results/tuning/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}.csv``: run time, status, objective and iterations of every trial and repeat
+
+The profile of the model family is updated in the file ``solver_profiles``
+(outside of the rule's outputs, so that profiles of other families are kept).
+
+Description
+-----------
+
+The network is reduced to its first ``nhours`` snapshots or to ``segments``
+segments (confer :mod:`solve_network`), and its linear problem is written
+once. Every combination of the ``parameters`` (at most ``max_trials``, drawn
+at random if the grid is larger) is solved ``repeats`` times with different
+gurobi seeds, by ``workers`` parallel processes with ``threads`` threads each
+and a time limit of ``time_limit`` seconds. The current solver settings are
+always included as reference.
+
+A setting is robust if all its repeats are optimal and their objectives are
+within ``tolerance`` of the reference. The robust setting with the lowest
+mean run time is written as profile ``solving: solver_profile`` (e.g.
+``varEP``) to ``solver_profiles``, together with its run time and that of
+the reference. :mod:`solve_network` merges the profile of its model family
+into the solver settings, so Fixed-EP and Var-EP models can use different
+parameters from the same configuration.
+"""
+
+import logging
+from _helpers import configure_logging
+
+import os
+import time
+import yaml
+import numpy as np
+import pandas as pd
+
+import pypsa
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from pathlib import Path
+from solve_network import (prepare_network, prepare_problem, read_gurobi_problem,
+                           merge_parameters)
+
+logger = logging.getLogger(__name__)
+
+
+def parameter_grid(parameters, max_trials=None, seed=0):
+    """Combinations of the ``parameters`` (dictionary of lists), at most ``max_trials`` at random."""
+    keys = list(parameters)
+    grid = [dict(zip(keys, values)) for values in product(*parameters.values())]
+    if max_trials is not None and len(grid) > max_trials:
+        rng = np.random.default_rng(seed)
+        grid = [grid[i] for i in sorted(rng.choice(len(grid), max_trials, replace=False))]
+    return grid
+
+
+_tuning = {}
+
+
+def _init_tuning_worker(problem_fn, solver_options, time_limit, threads):
+    _tuning.update(problem_fn=problem_fn, solver_options=solver_options,
+                   time_limit=time_limit, threads=threads)
+
+
+def _solve_trial(trial, parameters, seed):
+    options = merge_parameters(_tuning['solver_options'], parameters)
+    options.update(TimeLimit=_tuning['time_limit'], Threads=_tuning['threads'], Seed=seed,
+                   OutputFlag=0)
+    m = read_gurobi_problem(_tuning['problem_fn'], options)
+    start = time.time()
+    m.optimize()
+    return dict(trial=trial, seed=seed, status=m.Status, runtime=m.Runtime,
+                wallclock=time.time() - start,
+                objective=m.ObjVal if m.SolCount > 0 else np.nan,
+                barrier_iterations=m.BarIterCount, simplex_iterations=m.IterCount)
+
+
+def rank_trials(results, tolerance=1e-4):
+    """
+    Mean run time and robustness per trial; trial 0 is the reference whose
+    objective the others have to match within ``tolerance``.
+    """
+    optimal = results.status == 2  # GRB.OPTIMAL
+    reference = results.loc[(results.trial == 0) & optimal, 'objective'].median()
+    if np.isnan(reference):
+        reference = results.loc[optimal, 'objective'].median()
+    matches = ((results.objective - reference).abs() <= tolerance * max(abs(reference), 1.))
+    results = results.assign(robust=optimal & matches)
+    ranking = results.groupby('trial').agg(runtime=('runtime', 'mean'),
+                                           worst=('runtime', 'max'),
+                                           robust=('robust', 'all'))
+    return ranking.sort_values(['robust', 'runtime'], ascending=[False, True])
+
+
+def tune_solver(n, config, opts, solver_dir=None):
+    """
+    Solve the reduced linear problem of ``n`` for all trials of the parameter
+    grid and return the trials, their results and the ranking.
+    """
+    cf_tuning = config['solving']['tuning']
+    solver_options = config['solving']['solver'].copy()
+    solver_name = solver_options.pop('name')
+    if solver_name != 'gurobi':
+        raise ValueError(f"Solver tuning is implemented for gurobi only, not "
+                         f"'{solver_name}'.")
+
+    solve_opts = dict(config['solving']['options'], nhours=cf_tuning.get('nhours'),
+                      segments=cf_tuning.get('segments', False))
+    n = prepare_network(n, solve_opts)
+    n.config = config
+    n.opts = opts
+    problem_fn = prepare_problem(n, solver_dir=solver_dir)
+
+    trials = [{}] + parameter_grid(cf_tuning['parameters'], cf_tuning.get('max_trials'),
+                                   cf_tuning.get('seed', 0))
+    repeats = cf_tuning.get('repeats', 2)
+    workers = cf_tuning.get('workers', 4)
+    logger.info(f"Solving {len(trials)} trials {repeats} times each on {len(n.snapshots)} "
+                f"snapshots with {workers} workers.")
+
+    initargs = (problem_fn, solver_options, cf_tuning.get('time_limit', 600),
+                cf_tuning.get('threads', solver_options.get('threads', 1)))
+    jobs = [(i, trial, seed) for i, trial in enumerate(trials) for seed in range(repeats)]
+    try:
+        with ProcessPoolExecutor(workers, initializer=_init_tuning_worker,
+                                 initargs=initargs) as pool:
+            results = list(pool.map(_solve_trial, *zip(*jobs)))
+    finally:
+        os.remove(problem_fn)
+
+    results = pd.DataFrame(results)
+    ranking = rank_trials(results, cf_tuning.get('tolerance', 1e-4))
+    return trials, results, ranking
+
+
+def write_profile(fn, family, parameters, ranking):
+    """Store ``parameters`` as the solver profile of ``family`` in the YAML file ``fn``."""
+    profiles = {}
+    if os.path.exists(fn):
+        with open(fn) as f:
+            profiles = yaml.safe_load(f) or {}
+    best = ranking.index[0]
+    profiles[family] = {'solver': parameters,
+                        'runtime': float(ranking.at[best, 'runtime']),
+                        'reference_runtime': float(ranking.at[0, 'runtime']),
+                        'tuned': pd.Timestamp.now().isoformat(timespec='seconds')}
+    Path(fn).parent.mkdir(parents=True, exist_ok=True)
+    with open(fn, 'w') as f:
+        yaml.safe_dump(profiles, f, sort_keys=False)
+
+
+if __name__ == "__main__":
+    if 'snakemake' not in globals():
+        from _helpers import mock_snakemake
+        snakemake = mock_snakemake('tune_solver', network='elec', simpl='',
+                                  clusters='20', ll='copt', opts='Co2L-1H')
+    configure_logging(snakemake)
+
+    tmpdir = snakemake.config['solving'].get('tmpdir')
+    if tmpdir is not None:
+        Path(tmpdir).mkdir(parents=True, exist_ok=True)
+    opts = snakemake.wildcards.opts.split('-')
+
+    n = pypsa.Network(snakemake.input[0])
+    trials, results, ranking = tune_solver(n, snakemake.config, opts, solver_dir=tmpdir)
+
+    parameters = pd.Series([trials[i] for i in results.trial], index=results.index)
+    results.assign(parameters=parameters.map(str)).to_csv(snakemake.output[0], index=False)
+
+    best = ranking.index[0]
+    if not ranking.at[best, 'robust']:
+        logger.warning("No robust setting found; keeping the current solver profile.")
+    else:
+        gain = 1 - ranking.at[best, 'runtime'] / ranking.at[0, 'runtime']
+        logger.info(f"Fastest robust setting {trials[best] or 'current settings'}: "
+                    f"{ranking.at[best, 'runtime']:.1f}s, {gain:.0%} faster than the current "
+                    f"settings.")
+        cf_solving = snakemake.config['solving']
+        write_profile(cf_solving.get('solver_profiles', 'solver_profiles.yaml'),
+                      cf_solving['solver_profile'], trials[best], ranking)
@@ -0,0 +1,292 @@
+# SPDX-FileCopyrightText: : 2017-2020 The PyPSA-Eur Authors
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Runs pipeline scripts in a long-lived worker process which keeps the heavy
+modules, parsed cost databases and networks loaded between jobs.
+
+Relevant Settings
+-----------------
+
+.. code:: yaml
+
+    worker:
+        address:
+
+Inputs
+------
+
+As of the script run by the worker, given by ``params: worker_script``.
+
+Outputs
+-------
+
+As of the script run by the worker.
+
+Description
+-----------
+
+Start the worker once, e.g. next to a snakemake session::
+
+    python scripts/worker.py
+
+It imports pypsa, xarray, geopandas, powerplantmatching, vresutils and the
+scripts :mod:`add_electricity`, :mod:`add_extra_components` and
+:mod:`solve_network`, and listens on a local socket. A rule is routed to the
+worker by running this script in place of its own and naming the original in
+its params:
+
+.. code:: python
+
+    rule add_extra_components:
+        ...
+        params: worker_script="scripts/add_extra_components.py"
+        script: "scripts/worker.py"
+
+The submitting side only imports the standard library and sends the rule's
+``snakemake`` object to the worker. Before each job, the worker loads all
+``.nc`` inputs of the job into its network cache (reloading files which
+changed on disk) and parses the ``tech_costs`` input with
+:func:`add_electricity.load_costs`. The job is then run in a forked child
+process with :func:`runpy.run_path`, where ``pypsa.Network(fn)`` returns the
+cached network and ``load_costs`` the cached costs. Forking makes the cached
+objects copy-on-write, so a job may modify them freely without affecting the
+worker or other jobs; a second request for the same file within one job
+returns a copy. Scripts which define ``load_costs`` themselves
+(:mod:`add_electricity`) still parse the costs.
+
+The worker accepts and prepares jobs one at a time in its single thread, so
+that no other thread can hold a lock while a child is forked; the children
+report their results to the submitting side themselves. Up to ``--max-jobs``
+jobs run at the same time and at most ``--max-networks`` networks are cached,
+the least recently used ones being dropped first.
+
+The socket is ``worker: address`` of the configuration on the submitting side
+and ``--address`` on the worker side, by default ``worker.sock`` in the
+directory ``pypsa-eur-worker-<uid>`` of the temporary directory. The
+directory of the socket must be private to the user (mode 0700); the worker
+creates it if needed and writes a random key to ``authkey`` next to the
+socket, with which the submitting side authenticates.
+"""
+
+import logging
+import argparse
+import json
+import os
+import runpy
+import sys
+import time
+import traceback
+
+from collections import OrderedDict
+from multiprocessing import get_context
+from multiprocessing.connection import Listener, Client, wait
+from pathlib import Path
+from tempfile import gettempdir
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ADDRESS = os.path.join(gettempdir(), f'pypsa-eur-worker-{os.getuid()}', 'worker.sock')
+
+scripts_dir = Path(__file__).resolve().parent
+
+
+def private_dir(address):
+    """Create the directory of the socket ``address`` and check that it is private."""
+    path = Path(address).parent
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    stat = path.stat()
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+        raise PermissionError(f"Directory {path} of the worker socket must be owned "
+                              f"by the current user and have mode 0700.")
+    return path
+
+
+def read_authkey(address):
+    return (private_dir(address) / 'authkey').read_bytes()
+
+
+def write_authkey(address):
+    fn = private_dir(address) / 'authkey'
+    if fn.exists():
+        fn.unlink()
+    authkey = os.urandom(32)
+    fd = os.open(fn, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(authkey)
+    return authkey
+
+
+class Worker:
+    """Caches networks and costs and runs jobs in forked child processes."""
+
+    def __init__(self, max_jobs=4, max_networks=8):
+        sys.path.insert(0, str(scripts_dir))
+        import pypsa, xarray, geopandas, powerplantmatching, vresutils
+        import add_electricity, add_extra_components, solve_network
+        self.pypsa = pypsa
+        self.add_electricity = add_electricity
+
+        self.networks = OrderedDict()
+        self.costs = {}
+        self.max_networks = max_networks
+        self.max_jobs = max_jobs
+        self.running = []
+        self.context = get_context('fork')
+
+    def load_network(self, fn):
+        fn = str(Path(fn).resolve())
+        mtime = os.path.getmtime(fn)
+        cached = self.networks.get(fn)
+        if cached is None or cached[0] != mtime:
+            start = time.time()
+            self.networks[fn] = (mtime, self.pypsa.Network(fn))
+            logger.info(f"Cached network {fn} in {time.time() - start:.1f}s.")
+        self.networks.move_to_end(fn)
+        while len(self.networks) > self.max_networks:
+            self.networks.popitem(last=False)
+        return self.networks[fn][1]
+
+    def costs_key(self, tech_costs, config, Nyears):
+        tech_costs = str(Path(tech_costs).resolve())
+        return (tech_costs, os.path.getmtime(tech_costs),
+                json.dumps(config['costs'], sort_keys=True, default=str),
+                json.dumps(config['electricity']['max_hours'], sort_keys=True), Nyears)
+
+    def prepare(self, job, workdir):
+        """Cache the networks and costs a job is expected to read."""
+        fns = [os.path.join(workdir, fn) for fn in job.input if isinstance(fn, str)]
+        networks = [self.load_network(fn) for fn in fns
+                    if fn.endswith('.nc') and os.path.exists(fn)]
+        tech_costs = getattr(job.input, 'tech_costs', None)
+        if tech_costs and networks:
+            tech_costs = os.path.join(workdir, tech_costs)
+            Nyears = networks[0].snapshot_weightings.objective.sum() / 8760.
+            key = self.costs_key(tech_costs, job.config, Nyears)
+            if key not in self.costs:
+                self.costs[key] = self.add_electricity.load_costs(
+                    tech_costs, job.config['costs'], job.config['electricity'], Nyears)
+
+    def reap(self, block=False):
+        """Drop finished children; with ``block``, wait for at least one."""
+        if block and self.running:
+            wait([p.sentinel for p in self.running])
+        for process in [p for p in self.running if not p.is_alive()]:
+            process.join()
+            self.running.remove(process)
+
+    def run(self, conn, job, script, workdir):
+        """Run ``script`` for ``job`` in a forked child, which answers on ``conn``."""
+        self.prepare(job, workdir)
+        process = self.context.Process(target=self._run_child,
+                                       args=(conn, job, script, workdir, time.time()))
+        process.start()
+        self.running.append(process)
+
+    def _run_child(self, conn, job, script, workdir, start):
+        exitcode, result = 0, {}
+        try:
+            self._run_script(job, script, workdir)
+        except BaseException:
+            traceback.print_exc()
+            exitcode, result = 1, {'error': traceback.format_exc()}
+        elapsed = time.time() - start
+        logger.info(f"Finished {script} with exit code {exitcode} in {elapsed:.1f}s.")
+        try:
+            conn.send(dict(result, exitcode=exitcode, elapsed=elapsed))
+        finally:
+            os._exit(exitcode)
+
+    def _run_script(self, job, script, workdir):
+        pypsa = self.pypsa
+        networks = {fn: n for fn, (_, n) in self.networks.items()}
+        handed_out = set()
+        Network = pypsa.Network
+
+        def cached_network(import_name=None, *args, **kwargs):
+            if isinstance(import_name, (str, Path)) and not args and not kwargs:
+                fn = str(Path(import_name).resolve())
+                if fn in networks:
+                    n = networks[fn] if fn not in handed_out else networks[fn].copy()
+                    handed_out.add(fn)
+                    return n
+            return Network(import_name, *args, **kwargs)
+
+        load_costs = self.add_electricity.load_costs
+        costs = self.costs
+
+        def cached_load_costs(tech_costs, config, elec_config, Nyears=1.):
+            key = self.costs_key(tech_costs, {'costs': config, 'electricity': elec_config}, Nyears)
+            if key in costs:
+                return costs[key].copy()
+            return load_costs(tech_costs, config, elec_config, Nyears)
+
+        pypsa.Network = cached_network
+        self.add_electricity.load_costs = cached_load_costs
+
+        os.chdir(workdir)
+        sys.argv = [script]
+        runpy.run_path(script, init_globals={'snakemake': job}, run_name='__main__')
+
+    def handle(self, conn):
+        with conn:
+            try:
+                job, script, workdir = conn.recv()
+            except (EOFError, OSError):
+                logger.warning("Connection closed before a job was received.")
+                return
+            logger.info(f"Running {script} for rule '{getattr(job, 'rule', None)}'.")
+            try:
+                self.run(conn, job, script, workdir)
+            except Exception:
+                conn.send({'exitcode': -1, 'error': traceback.format_exc()})
+
+    def serve(self, address=DEFAULT_ADDRESS, preload=()):
+        authkey = write_authkey(address)
+        for fn in preload:
+            self.load_network(fn)
+        if os.path.exists(address):
+            os.remove(address)
+        with Listener(address, family='AF_UNIX', authkey=authkey) as listener:
+            logger.info(f"Worker listening on {address}.")
+            while True:
+                self.reap(block=len(self.running) >= self.max_jobs)
+                try:
+                    conn = listener.accept()
+                except Exception:
+                    logger.warning(f"Rejected connection:\n{traceback.format_exc()}")
+                    continue
+                self.handle(conn)
+
+
+def submit(job, script, address=DEFAULT_ADDRESS):
+    """Run ``script`` with the snakemake object ``job`` in the worker at ``address``."""
+    with Client(address, family='AF_UNIX', authkey=read_authkey(address)) as conn:
+        conn.send((job, str(Path(script).resolve()), os.getcwd()))
+        try:
+            result = conn.recv()
+        except EOFError:
+            raise RuntimeError(f"Worker job {script} ended without reporting a result.")
+    if result['exitcode'] != 0:
+        raise RuntimeError(f"Worker job {script} failed with exit code {result['exitcode']}."
+                           + ('\n' + result['error'] if 'error' in result else ''))
+    return result
+
+
+if __name__ == "__main__":
+    if 'snakemake' in globals():
+        config = snakemake.config.get('worker', {})
+        submit(snakemake, snakemake.params.worker_script,
+               config.get('address') or DEFAULT_ADDRESS)
+    else:
+        parser = argparse.ArgumentParser(description="Serve pipeline scripts from a warm worker process.")
+        parser.add_argument('--address', default=DEFAULT_ADDRESS)
+        parser.add_argument('--max-jobs', type=int, default=4)
+        parser.add_argument('--max-networks', type=int, default=8)
+        parser.add_argument('--preload', nargs='*', default=[],
+                            help="networks to cache before the first job")
+        args = parser.parse_args()
+
+        logging.basicConfig(level=logging.INFO)
+        Worker(args.max_jobs, args.max_networks).serve(args.address, args.preload)